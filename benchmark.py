@@ -0,0 +1,524 @@
+"""
+Offline benchmarks for the detection pipeline and the image listing.
+
+Everything runs on synthetic data in a temporary CACHE_DIR and IMG_DIR, so no
+waveform server, SRTM download or production cache is touched:
+
+  - Stations on a ring around a synthetic volcano record infrasound pulses
+    from a known source, delayed by the distance over CEL, plus noise.
+  - The grids are built with define_grid, with a synthetic DEM (a Gaussian
+    cone) in place of SRTM, and written into the grid cache.
+  - Each stage of a window runs separately and is timed on its own:
+    process_waveforms, the grid search (full and adaptive), peak picking,
+    the detection insert and rendering. The insert goes to a SQLite
+    stand-in, or with --db postgres to the configured database as volcano
+    'benchmark' (removed afterwards).
+  - list_images and /imageBrowse run over a generated image tree with months
+    of images and empty days.
+
+The processing parameters (DECIMATION_RATE, AGC_WIN, PEAK_HEIGHT, STACK_METHOD
+and so on) come from the config, except that travel times always use the
+celerity method. Results are written as JSON so runs can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json
+    python benchmark.py --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import numpy
+import utm
+
+from obspy import Stream, Trace, UTCDateTime
+
+from web import config
+
+VOLC_NAME = 'benchmark'
+
+
+class Timings:
+    def __init__(self):
+        self.stages = defaultdict(list)
+
+    @contextmanager
+    def stage(self, name):
+        t_start = time.perf_counter()
+        yield
+        self.stages[name].append(time.perf_counter() - t_start)
+
+    def summary(self):
+        results = {}
+        for name, runs in self.stages.items():
+            ordered = sorted(runs)
+            results[name] = {
+                'runs': len(runs),
+                'total': sum(runs),
+                'min': ordered[0],
+                'median': statistics.median(ordered),
+                'mean': statistics.mean(ordered),
+                'p95': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+                'max': ordered[-1],
+            }
+        return results
+
+
+def use_temp_dirs(base):
+    """Point everything that writes to disk at base"""
+    config.CACHE_DIR = os.path.join(base, 'cache')
+    config.IMG_DIR = os.path.join(base, 'images')
+    config.IMAGE_CATALOG = os.path.join(base, 'images.sqlite')
+    config.WAVEFORM_CACHE = False
+    config.RENDER_QUEUE = False
+    config.QUEUE_DB = os.path.join(base, 'queue.sqlite')
+
+
+# %% Synthetic volcano and data
+
+def synthetic_volcano(args):
+    net_radius = int(args.station_dist * 1000 * 1.25)
+    return {
+        'lon': -161.893047,
+        'lat': 55.417833,
+        'x_radius_net': net_radius,
+        'y_radius_net': net_radius,
+        'spacing_net': args.spacing * 4,
+        'x_radius_search': args.radius,
+        'y_radius_search': args.radius,
+        'spacing_search': args.spacing,
+        'station': ','.join(f"BM{idx:02d}" for idx in range(args.stations)),
+        'freq_min': 0.5,
+        'freq_max': 7,
+        'smooth_win': 1,
+        'max_station_dist': args.station_dist + 1,
+    }
+
+
+def synthetic_dem(grid, height = 1500, width = 2000):
+    """A Gaussian cone height meters high at the grid center, in place of SRTM"""
+    x = grid.x.values - grid.x.values.mean()
+    y = grid.y.values - grid.y.values.mean()
+    elevation = height * numpy.exp(-(x[None, :] ** 2 + y[:, None] ** 2) / (2 * width ** 2))
+    return grid.copy(data = elevation.astype(float))
+
+
+def build_grids(volc_info):
+    """Write the network and search grids, with synthetic DEMs, into the grid cache"""
+    from rtm import define_grid
+
+    from infrasound.grid_cache import VolcGrids, save_array
+
+    grids = VolcGrids(VOLC_NAME, volc_info)
+    for cached in (grids.network, grids.search):
+        grid = define_grid(**cached.params, projected = True, plot_preview = False)
+        os.makedirs(cached.path, exist_ok = True)
+        save_array(os.path.join(cached.path, 'grid'), grid)
+        save_array(os.path.join(cached.path, 'dem'), synthetic_dem(grid))
+    return grids
+
+
+def ricker(t, freq):
+    arg = (numpy.pi * freq * t) ** 2
+    return (1 - 2 * arg) * numpy.exp(-arg)
+
+
+def synthetic_stream(volc_info, source_xy, event_times, starttime, endtime,
+                     sampling_rate = 50, amplitude = 10, noise = 0.5, seed = 0):
+    """
+    Pulses from source_xy (UTM meters) at each of event_times, arriving at
+    each station after distance / CEL seconds, plus Gaussian noise (Pa).
+    """
+    rng = numpy.random.default_rng(seed)
+    center_x, center_y, zone, letter = utm.from_latlon(volc_info['lat'], volc_info['lon'])
+    stations = volc_info['station'].split(',')
+    radius = (volc_info['max_station_dist'] - 1) * 1000
+    freq = (volc_info['freq_min'] + volc_info['freq_max']) / 4
+
+    npts = int((endtime - starttime) * sampling_rate)
+    t = numpy.arange(npts) / sampling_rate
+    st = Stream()
+    for idx, station in enumerate(stations):
+        angle = 2 * numpy.pi * idx / len(stations)
+        # Uneven radii, so the geometry isn't perfectly symmetric
+        sta_x = center_x + radius * (0.8 + 0.4 * idx / len(stations)) * numpy.cos(angle)
+        sta_y = center_y + radius * (0.8 + 0.4 * idx / len(stations)) * numpy.sin(angle)
+        dist = numpy.hypot(sta_x - source_xy[0], sta_y - source_xy[1])
+
+        data = rng.normal(0, noise, npts)
+        for event_time in event_times:
+            arrival = (event_time - starttime) + dist / config.CEL
+            data += amplitude * ricker(t - arrival, freq)
+
+        lat, lon = utm.to_latlon(sta_x, sta_y, zone, letter)
+        tr = Trace(data = data, header = {
+            'network': 'BM', 'station': station, 'location': '', 'channel': 'BDF',
+            'sampling_rate': sampling_rate, 'starttime': starttime,
+        })
+        tr.stats.latitude = lat
+        tr.stats.longitude = lon
+        tr.stats.elevation = 0
+        st.append(tr)
+
+    return st
+
+
+# %% Pipeline
+
+def detection_rows(S, peaks):
+    """Detection rows as _locate builds them"""
+    time_max, y_max, x_max, _, props = peaks
+    gc_x, gc_y, _, _ = utm.from_latlon(*reversed(S.grid_center))
+    rows = []
+    for d_time, lat, lon, value in zip(time_max, y_max, x_max, props['peak_heights']):
+        det_x, det_y, _, _ = utm.from_latlon(lat, lon)
+        rows.append((VOLC_NAME, float(value), d_time.datetime.replace(tzinfo = timezone.utc),
+                     float(numpy.hypot(det_x - gc_x, det_y - gc_y)), float(lon), float(lat)))
+    return rows
+
+
+def batch_windows(rows, starttime, endtime, count):
+    """count consecutive windows holding rows, shifted in time, as a backfill would write"""
+    window = timedelta(seconds = endtime - starttime)
+    start = starttime.datetime.replace(tzinfo = timezone.utc)
+    windows = []
+    for idx in range(count):
+        shift = window * (idx - count + 1)
+        windows.append((start + shift, start + shift + window,
+                        [(volc, value, d_time + shift, dist, lon, lat)
+                         for volc, value, d_time, dist, lon, lat in rows]))
+    return windows
+
+
+class SQLiteDetections:
+    """Stand-in for the detections table, written the way DetectionWriter writes Postgres"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS detections (
+                volc TEXT, value REAL, d_time TEXT, dist REAL, lon REAL, lat REAL
+            )
+        """)
+        self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS detections_volc_d_time_key ON detections (volc, d_time)")
+
+    def write(self, windows):
+        with self.conn:
+            for start, end, rows in windows:
+                times = [row[2].isoformat() for row in rows]
+                self.conn.execute(
+                    f"""DELETE FROM detections WHERE volc=? AND d_time>? AND d_time<=?
+                    AND d_time NOT IN ({','.join('?' * len(times))})""",
+                    (VOLC_NAME, start.isoformat(), end.isoformat(), *times)
+                )
+                self.conn.executemany(
+                    """INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (volc, d_time) DO UPDATE
+                    SET value=excluded.value, dist=excluded.dist, lon=excluded.lon, lat=excluded.lat""",
+                    [(volc, value, d_time.isoformat(), dist, lon, lat)
+                     for volc, value, d_time, dist, lon, lat in rows]
+                )
+
+
+def postgres_cleanup():
+    from infrasound import db
+
+    with db.connection() as conn:
+        cur = conn.cursor()
+        for table in ('detections', 'detection_updates', *db.ROLLUPS):
+            cur.execute(f"DELETE FROM {table} WHERE volc=%s", (VOLC_NAME, ))
+        conn.commit()
+
+
+def run_pipeline(args, base, timings):
+    from generate_images import infrasound_location
+    from infrasound.db import DetectionWriter
+    from infrasound.rendering import render_images
+    from infrasound.stacking import peak_coordinates
+    from infrasound.travel_times import TravelTimeStore
+
+    from rtm import calculate_time_buffer
+
+    volc_info = synthetic_volcano(args)
+
+    with timings.stage('grid_setup'):
+        grids = build_grids(volc_info)
+        search_grid = grids.search_grid
+        network_grid = grids.network_grid
+
+    endtime = UTCDateTime(2020, 1, 1, 0, 10)
+    starttime = endtime - args.window
+    time_buffer = calculate_time_buffer(network_grid, volc_info['max_station_dist'])
+
+    # A source offset from the center, firing a few times in the window
+    center_x, center_y, _, _ = utm.from_latlon(volc_info['lat'], volc_info['lon'])
+    source_xy = (center_x + args.radius / 4, center_y - args.radius / 5)
+    event_times = [starttime + args.window * frac for frac in (0.2, 0.5, 0.8)]
+    st = synthetic_stream(volc_info, source_xy, event_times, starttime - time_buffer,
+                          endtime + time_buffer)
+
+    generator = infrasound_location(endtime, starttime)
+    generator.TIME_METHOD = 'celerity'
+
+    st_proc = generator._process(st.copy(), volc_info)
+
+    with timings.stage('travel_times'):
+        store = TravelTimeStore(VOLC_NAME, grids.search, 'celerity', celerity = config.CEL,
+                                dem = grids.search_dem)
+        store.get(st_proc)
+
+    if args.db == 'postgres':
+        writer = DetectionWriter(batch_windows = args.db_windows + 1)
+    elif args.db == 'sqlite':
+        stand_in = SQLiteDetections(os.path.join(base, 'detections.sqlite'))
+
+    accuracy = None
+    try:
+        for run in range(args.repeat):
+            with timings.stage('process_waveforms'):
+                st_proc = generator._process(st.copy(), volc_info)
+
+            with timings.stage('grid_search'):
+                S = generator._stack(VOLC_NAME, grids, st_proc, starttime, endtime, len(st),
+                                     adaptive = False)
+
+            with timings.stage('grid_search_adaptive'):
+                generator._stack(VOLC_NAME, grids, st_proc, starttime, endtime, len(st),
+                                 adaptive = True)
+
+            with timings.stage('peak_picking'):
+                peaks = peak_coordinates(S, unproject = True, **generator._peak_kwargs())
+
+            rows = detection_rows(S, peaks)
+            windows = batch_windows(rows, starttime, endtime, args.db_windows)
+            if args.db == 'postgres':
+                with timings.stage('db_insert'):
+                    for start, end, window_rows in windows:
+                        writer.add(VOLC_NAME, window_rows, start, end)
+                    writer.flush()
+            elif args.db == 'sqlite':
+                with timings.stage('db_insert'):
+                    stand_in.write(windows)
+
+            if not args.no_render:
+                with timings.stage('render'):
+                    render_images(VOLC_NAME, volc_info, st, st_proc, S, grids.network_dem)
+
+            if accuracy is None:
+                errors = []
+                for row in rows:
+                    det_x, det_y, _, _ = utm.from_latlon(row[5], row[4])
+                    errors.append(float(numpy.hypot(det_x - source_xy[0], det_y - source_xy[1])))
+                accuracy = {
+                    'events': len(event_times),
+                    'detections': len(rows),
+                    'max_location_error': max(errors) if errors else None,
+                }
+    finally:
+        if args.db == 'postgres':
+            postgres_cleanup()
+
+    return {
+        'stations': len(st),
+        'samples_raw': st[0].stats.npts,
+        'samples_processed': st_proc[0].stats.npts,
+        'search_nodes': int(search_grid.size),
+        'network_nodes': int(network_grid.size),
+        'window': args.window,
+        'stack_method': generator.STACK_METHOD,
+        'db': args.db,
+        'accuracy': accuracy,
+    }
+
+
+# %% Image listing
+
+def build_image_tree(days, interval, seed = 0):
+    """
+    Empty image files every interval minutes for days days, with every
+    seventh day and a ten day stretch in the middle left empty. Returns the
+    image times and the gaps, as timestamps.
+    """
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1, tzinfo = timezone.utc)
+    gap_days = {day for day in range(days) if day % 7 == 6}
+    gap_days.update(range(days // 2, days // 2 + 10))
+
+    times = []
+    for day in range(days):
+        if day in gap_days:
+            continue
+
+        day_start = start + timedelta(days = day)
+        img_dir = os.path.join(config.IMG_DIR, VOLC_NAME, day_start.strftime('%Y/%m/%d'))
+        os.makedirs(img_dir, exist_ok = True)
+        for minute in range(0, 24 * 60, interval):
+            img_time = day_start + timedelta(minutes = minute)
+            tmstr = img_time.strftime('%Y%m%d_%H%M')
+            for suffix in ('combined.png', 'thumb.jpg'):
+                open(os.path.join(img_dir, f"{VOLC_NAME}_{tmstr}_{suffix}"), 'w').close()
+            times.append(img_time.timestamp())
+
+    # Any time in the middle of an empty day
+    gaps = [(start + timedelta(days = day, hours = rng.uniform(0, 24))).timestamp()
+            for day in sorted(gap_days) if day < days]
+    return times, gaps
+
+
+def run_images(args, timings):
+    from infrasound.image_catalog import open_catalog
+    from web import app
+    from web.main import list_images
+
+    with timings.stage('image_tree'):
+        times, gaps = build_image_tree(args.image_days, args.image_interval)
+
+    with timings.stage('catalog_rebuild'):
+        open_catalog().rebuild(VOLC_NAME)
+
+    rng = random.Random(1)
+
+    def as_datetime(timestamp):
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+
+    for _ in range(args.queries):
+        with timings.stage('list_images_latest'):
+            list_images(VOLC_NAME, args.image_count)
+
+    for stop in rng.sample(times, min(args.queries, len(times))):
+        with timings.stage('list_images_browse'):
+            list_images(VOLC_NAME, args.image_count, as_datetime(stop))
+
+    for stop in [rng.choice(gaps) for _ in range(args.queries)]:
+        with timings.stage('list_images_gap'):
+            list_images(VOLC_NAME, args.image_count, as_datetime(stop))
+
+    # Through the web app, with distinct stops so responses aren't cached
+    client = app.test_client()
+    for stop in rng.sample(times, min(args.queries, len(times))):
+        with timings.stage('image_browse_http'):
+            response = client.get('/imageBrowse', query_string = {
+                'volc': VOLC_NAME, 'count': args.image_count, 'stop': stop,
+            })
+        if response.status_code != 200:
+            raise RuntimeError(f"/imageBrowse returned {response.status_code}")
+
+    return {
+        'image_times': len(times),
+        'empty_days': len(gaps),
+        'image_count': args.image_count,
+    }
+
+
+# %% Results
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True,
+                                text = True, cwd = os.path.dirname(os.path.abspath(__file__)),
+                                check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(before_file, after_file):
+    with open(before_file) as f:
+        before = json.load(f)['stages']
+    with open(after_file) as f:
+        after = json.load(f)['stages']
+
+    print(f"{'stage':<24}{'before':>12}{'after':>12}{'change':>10}")
+    for name in sorted(set(before) | set(after)):
+        old = before.get(name, {}).get('median')
+        new = after.get(name, {}).get('median')
+        change = f"{(new - old) / old:+.1%}" if old and new is not None else ''
+        old_str = f"{old * 1000:.2f}ms" if old is not None else '-'
+        new_str = f"{new * 1000:.2f}ms" if new is not None else '-'
+        print(f"{name:<24}{old_str:>12}{new_str:>12}{change:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Offline benchmarks for the pipeline and image listing")
+    parser.add_argument('--scenarios', nargs = '+', choices = ('pipeline', 'images'),
+                        default = ['pipeline', 'images'])
+    parser.add_argument('--output', help = "Write the results to this JSON file")
+    parser.add_argument('--compare', nargs = 2, metavar = ('BEFORE', 'AFTER'),
+                        help = "Compare the median stage times of two result files, and exit")
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = "Runs of each pipeline stage")
+    parser.add_argument('--stations', type = int, default = 6)
+    parser.add_argument('--station-dist', type = float, default = 6,
+                        help = "Distance of the stations from the center, in km")
+    parser.add_argument('--radius', type = int, default = 1000,
+                        help = "Search grid radius, in meters")
+    parser.add_argument('--spacing', type = int, default = 25,
+                        help = "Search grid spacing, in meters")
+    parser.add_argument('--window', type = int, default = 600,
+                        help = "Window length, in seconds")
+    parser.add_argument('--db', choices = ('sqlite', 'postgres', 'none'), default = 'sqlite',
+                        help = "Where to insert detections (postgres uses the configured database)")
+    parser.add_argument('--db-windows', type = int, default = getattr(config, 'DB_BATCH_WINDOWS', 36),
+                        help = "Windows of detections written per insert")
+    parser.add_argument('--no-render', action = 'store_true', help = "Skip rendering")
+    parser.add_argument('--image-days', type = int, default = 120,
+                        help = "Days of images in the image tree")
+    parser.add_argument('--image-interval', type = int, default = 10,
+                        help = "Minutes between images")
+    parser.add_argument('--image-count', type = int, default = 4,
+                        help = "Images requested per listing")
+    parser.add_argument('--queries', type = int, default = 200,
+                        help = "Listings timed per image scenario")
+    parser.add_argument('--keep', action = 'store_true',
+                        help = "Keep the temporary directory")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        raise SystemExit(0)
+
+    base = tempfile.mkdtemp(prefix = 'infrasound-benchmark-')
+    use_temp_dirs(base)
+
+    timings = Timings()
+    results = {'environment': environment(), 'parameters': vars(args)}
+    try:
+        if 'pipeline' in args.scenarios:
+            results['pipeline'] = run_pipeline(args, base, timings)
+        if 'images' in args.scenarios:
+            results['images'] = run_images(args, timings)
+    finally:
+        if args.keep:
+            print("Benchmark files kept in", base)
+        else:
+            shutil.rmtree(base, ignore_errors = True)
+
+    results['stages'] = timings.summary()
+
+    for name, stats in results['stages'].items():
+        print(f"{name:<24} median {stats['median'] * 1000:10.2f}ms  ({stats['runs']} runs)")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2, default = str)
+        print("Results written to", args.output)
@@ -0,0 +1,27 @@
+"""
+Rebuild the image catalog from the images under IMG_DIR.
+
+Only needed once, for images written before the catalog existed, or after
+adding or removing images by hand; images rendered from then on are added
+as they are written.
+
+Example:
+    python catalog.py --volc pavlof semi
+"""
+import argparse
+import time
+
+from infrasound.image_catalog import open_catalog
+from web import config
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Rebuild the image catalog from disk")
+    parser.add_argument('--volc', nargs = '+', default = list(config.VOLCS),
+                        help = "Volcanoes to rebuild (default all)")
+    args = parser.parse_args()
+
+    catalog = open_catalog()
+    for volc in args.volc:
+        t_start = time.time()
+        count = catalog.rebuild(volc)
+        print(f"Cataloged {count} images for {volc} in {time.time() - t_start:.1f}s")
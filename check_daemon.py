@@ -0,0 +1,92 @@
+"""
+Check that the daemon saves every detection when its windows overlap, and
+when it falls behind and skips windows.
+
+The windows are run through LocationDaemon.process with a stand-in for the
+pipeline, which finds a detection every DETECTION_INTERVAL seconds and
+saves them the way DetectionWriter does (replacing whatever was saved in
+(SAVE_AFTER, end]). Exits non-zero if any check fails:
+
+    python check_daemon.py
+"""
+import sys
+
+from obspy import UTCDateTime
+
+import daemon
+
+from web import config
+
+DETECTION_INTERVAL = 30  # [s]
+
+START = UTCDateTime(2024, 1, 1)
+
+
+def detection_times(start, end):
+    """A detection every DETECTION_INTERVAL seconds in (start, end]"""
+    return {start + offset for offset in range(DETECTION_INTERVAL, int(end - start) + 1, DETECTION_INTERVAL)}
+
+
+class FakeLocation:
+    """Stands in for infrasound_location, saving to saved"""
+    saved = set()
+
+    def __init__(self, end, start):
+        self.ENDTIME = end
+        self.STARTTIME = start
+        self.SAVE_AFTER = None
+        self.waveforms = None
+
+    def prefetch(self, volcs):
+        pass
+
+    def gen_volc_image(self, volc_name, volc_info):
+        # As timestamps, since UTCDateTime isn't hashable
+        start, end = self.STARTTIME.timestamp, self.ENDTIME.timestamp
+        save_after = self.SAVE_AFTER.timestamp if self.SAVE_AFTER is not None else start
+        detections = detection_times(start, end)
+        FakeLocation.saved = ({d_time for d_time in FakeLocation.saved
+                               if not save_after < d_time <= end}
+                              | {d_time for d_time in detections if d_time > save_after})
+
+
+def check(name, window, step, window_ends):
+    """
+    Process windows ending at window_ends (seconds after START), and check
+    every detection in them is saved
+    """
+    FakeLocation.saved = set()
+    location_daemon = daemon.LocationDaemon(window, step, 0)
+    last_end = None
+    for window_end in window_ends:
+        location_daemon.process(START + window_end, last_end)
+        last_end = START + window_end
+
+    # Time more than a window behind the next window end is never processed
+    expected = set().union(*(detection_times(START.timestamp + window_end - window,
+                                             START.timestamp + window_end)
+                             for window_end in window_ends))
+    missing = sorted(expected - FakeLocation.saved)
+    if missing:
+        print(f"{name:<22} FAILED: {len(missing)} detections lost, from "
+              f"{UTCDateTime(missing[0])} to {UTCDateTime(missing[-1])}")
+        return False
+
+    print(f"{name:<22} OK")
+    return True
+
+
+if __name__ == "__main__":
+    daemon.infrasound_location = FakeLocation
+    config.VOLCS = {'check': {}}
+
+    results = [
+        check('overlapping', 600, 120, [600, 720, 840, 960]),
+        # Fell behind after 840, so 960-1200 were never run
+        check('skipped_windows', 600, 120, [600, 720, 840, 1320, 1440]),
+        # Fell more than a window behind
+        check('skipped_past_window', 600, 120, [600, 720, 2400]),
+        check('adjacent', 600, 600, [600, 1200, 2400]),
+    ]
+    if not all(results):
+        sys.exit(1)
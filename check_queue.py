@@ -0,0 +1,171 @@
+"""
+Check the work queue's claim, complete, retry and lease expiry behaviour.
+
+Runs against a temporary SQLite file, the stand-in used without Postgres,
+or with --postgres against a scratch schema in the configured database
+(which is dropped afterwards, so the real queue is never touched). Exits
+non-zero if any check fails:
+
+    python check_queue.py
+    python check_queue.py --postgres
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from obspy import UTCDateTime
+
+from infrasound import db
+from infrasound.work_queue import BACKFILL, DONE, FAILED, LEASED, LIVE, PENDING, WorkQueue
+
+# Short, so expiry can be checked without waiting long
+LEASE = 1  # [s]
+
+WINDOW_END = UTCDateTime(2024, 1, 1)
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(value, expected, what):
+    if value != expected:
+        raise CheckFailed(f"{what}: expected {expected!r}, got {value!r}")
+
+
+def status(queue, job):
+    with queue.connect() as conn:
+        cur = conn.cursor()
+        cur.execute(queue._sql("SELECT status, attempts, error FROM location_jobs WHERE id=%s"),
+                    (job.id, ))
+        return cur.fetchone()
+
+
+def check_priority(queue):
+    """Live windows are claimed before backfills, newest first"""
+    queue.enqueue('check', [WINDOW_END - 1200, WINDOW_END - 600], priority = BACKFILL)
+    queue.enqueue('check', [WINDOW_END], priority = LIVE)
+    claimed = [queue.claim('a') for _ in range(4)]
+    expect([job.window_end for job in claimed[:3]],
+           [WINDOW_END.timestamp, WINDOW_END.timestamp - 600, WINDOW_END.timestamp - 1200],
+           "claim order")
+    expect(claimed[3], None, "claim from an empty queue")
+
+
+def check_priority_bump(queue):
+    """Queuing a window again keeps it, at the higher of the two priorities"""
+    queue.enqueue('check', [WINDOW_END - 600], priority = BACKFILL)
+    queue.enqueue('check', [WINDOW_END], priority = BACKFILL)
+    queue.enqueue('check', [WINDOW_END - 600], priority = LIVE)
+    expect(queue.counts(), {PENDING: 2}, "counts")
+    expect(queue.claim('a').window_end, WINDOW_END.timestamp - 600, "bumped window")
+
+
+def check_complete(queue):
+    """A completed job is done, and not handed out again"""
+    queue.enqueue('check', [WINDOW_END])
+    job = queue.claim('a')
+    expect(status(queue, job)[:2], (LEASED, 1), "claimed job")
+    queue.complete(job, 'a')
+    expect(status(queue, job)[:2], (DONE, 1), "completed job")
+    expect(queue.claim('a'), None, "claim after completing")
+
+
+def check_retry(queue):
+    """A failed job is retried until it runs out of attempts"""
+    queue.enqueue('check', [WINDOW_END], max_attempts = 2)
+    job = queue.claim('a')
+    queue.fail(job, 'a', 'first')
+    expect(status(queue, job), (PENDING, 1, 'first'), "job failed once")
+
+    job = queue.claim('b')
+    expect(job.attempts, 2, "attempts on retry")
+    queue.fail(job, 'b', 'second')
+    expect(status(queue, job), (FAILED, 2, 'second'), "job failed on its last attempt")
+    expect(queue.claim('a'), None, "claim after the last attempt")
+
+
+def check_lease_expiry(queue):
+    """An expired lease is handed to another worker, and the first loses the job"""
+    queue.enqueue('check', [WINDOW_END], max_attempts = 2)
+    job = queue.claim('a')
+    expect(queue.claim('b'), None, "claim while leased")
+    expect(queue.heartbeat(job, 'a'), True, "heartbeat while leased")
+
+    time.sleep(LEASE * 1.5)
+    retry = queue.claim('b')
+    expect((retry.id, retry.attempts), (job.id, 2), "job claimed after the lease expired")
+    expect(queue.heartbeat(job, 'a'), False, "heartbeat after losing the lease")
+    queue.complete(job, 'a')
+    expect(status(queue, job)[0], LEASED, "status after the old owner completes")
+
+    # Expiring on the last attempt fails the job for good
+    time.sleep(LEASE * 1.5)
+    expect(queue.claim('c'), None, "claim after the last lease expired")
+    expect(status(queue, job), (FAILED, 2, 'Lease expired'), "job whose last lease expired")
+
+
+CHECKS = (check_priority, check_priority_bump, check_complete, check_retry, check_lease_expiry)
+
+
+@contextmanager
+def sqlite_queues():
+    """A function returning an empty SQLite backed queue"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = (os.path.join(tmp_dir, f"{idx}.sqlite") for idx in range(len(CHECKS)))
+
+        def new_queue():
+            path = next(paths)
+            return WorkQueue(lambda: db.sqlite_connection(path), dialect = 'sqlite', lease = LEASE)
+
+        yield new_queue
+
+
+@contextmanager
+def postgres_queues():
+    """A function returning an empty queue in a scratch schema"""
+    import psycopg
+
+    schema = f"check_queue_{os.getpid()}"
+
+    def connect():
+        return psycopg.connect(**db.connect_kwargs(), options = f"-c search_path={schema}")
+
+    def new_queue():
+        with psycopg.connect(**db.connect_kwargs(), autocommit = True) as conn:
+            conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+            conn.execute(f"CREATE SCHEMA {schema}")
+        return WorkQueue(connect, lease = LEASE)
+
+    try:
+        yield new_queue
+    finally:
+        with psycopg.connect(**db.connect_kwargs(), autocommit = True) as conn:
+            conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Check the work queue")
+    parser.add_argument('--postgres', action = 'store_true',
+                        help = "Run against a scratch schema in the configured database instead of SQLite")
+    args = parser.parse_args()
+
+    failed = 0
+    with (postgres_queues() if args.postgres else sqlite_queues()) as new_queue:
+        for check in CHECKS:
+            queue = new_queue()
+            queue.ensure_schema()
+            try:
+                check(queue)
+            except CheckFailed as e:
+                print(f"{check.__name__:<22} FAILED: {e}")
+                failed += 1
+            else:
+                print(f"{check.__name__:<22} OK")
+
+    if failed:
+        sys.exit(1)
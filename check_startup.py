@@ -0,0 +1,108 @@
+"""
+Check that the entry points still start quickly.
+
+generate_images.py runs from cron every ten minutes and regen.py starts a
+fresh interpreter for every backfill task, and uwsgi imports web.main for
+every worker it (re)spawns, so their import time is paid over and over.
+The plotting, DEM and geospatial stacks (rtm, matplotlib, xarray, ...) are
+only imported on the code paths that use them.
+
+Each entry point is imported in a fresh interpreter, and fails the check if
+it takes longer than its budget (the best of --repeat runs) or loads any of
+the modules it should only load on use. Exits non-zero on any failure:
+
+    python check_startup.py
+    python check_startup.py web.main --budget web.main=0.3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Only imported where they are used
+PIPELINE_DEFERRED = ('rtm', 'utm', 'matplotlib', 'cartopy', 'pygmt', 'rasterio', 'xarray',
+                     'pandas', 'scipy', 'PIL', 'psycopg', 'psycopg_pool', 'pyarrow', 'flask',
+                     'jinja2')
+WEB_DEFERRED = ('rtm', 'utm', 'matplotlib', 'cartopy', 'pygmt', 'rasterio', 'xarray', 'pandas',
+                'scipy', 'PIL', 'numpy', 'obspy', 'psycopg', 'psycopg_pool', 'pyarrow')
+
+# module: (budget in seconds, modules it shouldn't import)
+ENTRY_POINTS = {
+    'generate_images': (1.0, PIPELINE_DEFERRED),
+    # regen's parent process only manages the ledger
+    'regen': (0.75, PIPELINE_DEFERRED + ('generate_images', )),
+    # What uwsgi loads
+    'web.main': (0.75, WEB_DEFERRED),
+}
+
+PROBE = """
+import json, sys, time
+before = set(sys.modules)
+t_start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t_start
+print(json.dumps({{'seconds': elapsed, 'modules': sorted(set(sys.modules) - before)}}))
+"""
+
+
+def measure(module, repeat):
+    """Best import time of module, in s, and the modules it imported"""
+    times = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', PROBE.format(module = module)],
+                              cwd = os.path.dirname(os.path.abspath(__file__)),
+                              capture_output = True, text = True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        times.append(result['seconds'])
+
+    return min(times), result['modules']
+
+
+def check(module, budget, deferred, repeat):
+    try:
+        seconds, modules = measure(module, repeat)
+    except RuntimeError as e:
+        print(f"{module:<16} FAILED to import: {e}")
+        return False
+
+    loaded = sorted({name.split('.')[0] for name in modules} & set(deferred))
+    ok = seconds <= budget and not loaded
+    print(f"{module:<16} {seconds:.3f}s (budget {budget:.2f}s) {'OK' if ok else 'FAILED'}")
+    if loaded:
+        print(f"{'':<16} imports {', '.join(loaded)}, which should only be imported where used")
+
+    return ok
+
+
+def parse_budget(value):
+    module, _, seconds = value.partition('=')
+    if module not in ENTRY_POINTS or not seconds:
+        raise argparse.ArgumentTypeError(f"Expected MODULE=SECONDS, with MODULE one of {', '.join(ENTRY_POINTS)}")
+
+    return module, float(seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Check the import time of the entry points")
+    parser.add_argument('modules', nargs = '*', metavar = 'MODULE',
+                        help = f"Entry points to check: {', '.join(ENTRY_POINTS)} (default: all)")
+    parser.add_argument('--budget', type = parse_budget, action = 'append', default = [],
+                        metavar = 'MODULE=SECONDS', help = "Override the budget for an entry point")
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = "Imports of each entry point; the fastest is compared to the budget")
+    args = parser.parse_args()
+    for module in args.modules:
+        if module not in ENTRY_POINTS:
+            parser.error(f"Unknown entry point {module}")
+
+    budgets = {module: budget for module, (budget, _) in ENTRY_POINTS.items()}
+    budgets.update(args.budget)
+
+    results = [check(module, budgets[module], ENTRY_POINTS[module][1], args.repeat)
+               for module in args.modules or ENTRY_POINTS]
+    if not all(results):
+        sys.exit(1)
@@ -0,0 +1,98 @@
+"""
+Long-running alternative to running generate_images.py from cron.
+
+Stays resident so imports, grids, DEMs and travel time tables are only loaded
+once, and keeps recent waveforms in memory so each window only fetches the
+new data since the last one. Windows of DAEMON_WINDOW seconds are processed
+every DAEMON_STEP seconds, so overlapping windows (e.g. 10 minutes every 2
+minutes) give lower detection latency than the 10 minute cron cadence.
+"""
+import argparse
+import signal
+import threading
+import time
+import traceback
+
+from obspy import UTCDateTime
+
+from generate_images import infrasound_location, preload
+from infrasound.waveforms import WaveformBuffer
+from web import config
+
+
+class LocationDaemon:
+    def __init__(self, window, step, delay):
+        self.window = window  # [s] Length of each processing window
+        self.step = step  # [s] Time between the end of successive windows
+        self.delay = delay  # [s] How long after the end of a window to wait for data
+
+        # Enough for the window plus the time buffers on either side
+        self.waveforms = WaveformBuffer(window + 1800)
+        self.stopping = threading.Event()
+
+    def stop(self, *args):
+        print("Stopping after the current window")
+        self.stopping.set()
+
+    def latest_window_end(self):
+        """The end of the most recent window that should have data by now"""
+        now = UTCDateTime.now() - self.delay
+        return UTCDateTime(now.timestamp - (now.timestamp % self.step))
+
+    def run(self):
+        last_end = None
+        while not self.stopping.is_set():
+            window_end = self.latest_window_end()
+            if last_end is not None and window_end <= last_end:
+                # Wait for the next window
+                wait = (last_end + self.step + self.delay) - UTCDateTime.now()
+                self.stopping.wait(max(wait, 1))
+                continue
+
+            if last_end is not None and window_end - last_end > self.step:
+                skipped = int((window_end - last_end) / self.step) - 1
+                print(f"Falling behind. Skipping {skipped} window(s)")
+
+            self.process(window_end, last_end)
+            last_end = window_end
+
+    def process(self, window_end, last_end = None):
+        """Process the window ending at window_end. last_end is the end of the last window processed."""
+        t_start = time.monotonic()
+        generator = infrasound_location(window_end, window_end - self.window)
+        generator.waveforms = self.waveforms
+        if last_end is not None:
+            # Detections up to last_end were saved by the last window. The
+            # first window, and any after a gap, save everything they cover.
+            generator.SAVE_AFTER = max(last_end, window_end - self.window)
+
+        self.waveforms.start_run()
+        generator.prefetch(config.VOLCS)
+
+        for volc_name, volc_info in config.VOLCS.items():
+            if self.stopping.is_set():
+                break
+            try:
+                generator.gen_volc_image(volc_name, volc_info)
+            except Exception:
+                print(f"Error processing {volc_name} for window ending {window_end}:")
+                traceback.print_exc()
+
+        print(f"Window ending {window_end} processed in {time.monotonic() - t_start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Continuously generate infrasound location images and detections")
+    parser.add_argument('--window', type = float, default = getattr(config, 'DAEMON_WINDOW', 600),
+                        help = "Length of each processing window, in seconds")
+    parser.add_argument('--step', type = float, default = getattr(config, 'DAEMON_STEP', 600),
+                        help = "Time between windows, in seconds")
+    parser.add_argument('--delay', type = float, default = getattr(config, 'DAEMON_DELAY', 60),
+                        help = "Seconds after the end of a window to wait before processing it")
+    args = parser.parse_args()
+
+    preload()
+    daemon = LocationDaemon(args.window, args.step, args.delay)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
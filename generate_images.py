@@ -1,31 +1,24 @@
 # %% (1) Define grid
-import os
+import argparse
+import sys
+import time
 
 import numpy
-import psycopg
-import utm
-
-import matplotlib.pyplot as plt
 
+from contextlib import contextmanager
 from datetime import timezone
 
 from obspy import UTCDateTime
-from rtm import (
-    define_grid,
-    produce_dem,
-    process_waveforms,
-    grid_search,
-    plot_time_slice,
-    get_peak_coordinates,
-    plot_st,
-    calculate_time_buffer
-)
-
-try:
-    from waveform_collection.waveform_collection import gather_waveforms
-except ImportError:
-    from waveform_collection import gather_waveforms
 
+from infrasound.adaptive import adaptive_stack, compare_detections
+from infrasound.db import DetectionWriter
+from infrasound.grid_cache import VolcGrids
+from infrasound.rendering import RenderQueue, render_images
+from infrasound.run_stats import FAILED, OK, STOPPED, RunStats, Stopped
+from infrasound.runner import FINISHED, print_summary, run_volcanoes
+from infrasound.stacking import STACK_METHODS, peak_coordinates, stack_grid
+from infrasound.travel_times import TravelTimeStore
+from infrasound.waveforms import WaveformCache, gather_waveforms
 from web import config
 
 """
@@ -39,6 +32,26 @@ automatically download and use 1 arc-second STRM data.
 #EXTERNAL_FILE = 'DEM_WGS84.tif'
 
 
+def preload(render = None):
+    """
+    Import the processing (and, if rendering here, plotting) stacks now.
+    These are otherwise imported where they are first used, so commands that
+    don't process anything, like --enqueue, start quickly. Processes that
+    fork a child per run call this first, so each child doesn't import them
+    again.
+    """
+    import rtm
+    import scipy.signal
+    import utm
+    import xarray
+
+    if render is None:
+        render = config.SAVE_IMAGES and not getattr(config, 'RENDER_QUEUE', False)
+    if render:
+        import matplotlib.pyplot
+        import PIL.Image
+
+
 class infrasound_location:
     def __init__(self, end = None, start = None):
         self.SVDIR = config.IMG_DIR
@@ -53,38 +66,159 @@ class infrasound_location:
         print("End time set to:", self.ENDTIME)
         self.STARTTIME = start or self.ENDTIME - 10 * 60  # 10 minutes
 
-    def gen_volc_image(self, volc_name, volc_info, SAVE_DB = True):
-        NETWORK = config.NETWORK
-        SOURCE = config.SOURCE
-        LOCATION = config.LOCATION
-        CHANNEL = config.CHANNEL
-
-        LON_0 = volc_info['lon']  # [deg] Longitude of grid center
-        LAT_0 = volc_info['lat']  # [deg] Latitude of grid center
-        X_RADIUS_NET = volc_info['x_radius_net']  # [m] E-W grid radius (half of grid "width")
-        Y_RADIUS_NET = volc_info['y_radius_net']  # [m] N-S grid radius (half of grid "height")
-        SPACING_NET = volc_info['spacing_net']    # [m] Grid spacing
-
-        network_grid = define_grid(lon_0=LON_0, lat_0=LAT_0, x_radius=X_RADIUS_NET,
-                                   y_radius=Y_RADIUS_NET, spacing=SPACING_NET, projected=True,
-                                   plot_preview=False)
+        # Only save detections after this time to the DB (None for everything)
+        self.SAVE_AFTER = None
+        self.db_writer = DetectionWriter()
+
+        # Queue images for render.py rather than rendering them inline
+        if getattr(config, 'RENDER_QUEUE', False):
+            self.render_queue = RenderQueue()
+        else:
+            self.render_queue = None
+
+        # Local rolling cache in front of gather_waveforms. Not needed when
+        # reading from a local archive.
+        if getattr(config, 'WAVEFORM_CACHE', True) and config.SOURCE != 'SDS':
+            self.waveforms = WaveformCache()
+        else:
+            self.waveforms = None
+
+    def prefetch(self, volcs):
+        """Fetch waveforms for every station in volcs with a single request"""
+        if self.waveforms is None:
+            return
+
+        from rtm import calculate_time_buffer
+
+        stations = set()
+        time_buffer = 0
+        for volc_name, volc_info in volcs.items():
+            network_grid = VolcGrids(volc_name, volc_info).network_grid
+            volc_buffer = calculate_time_buffer(network_grid, volc_info['max_station_dist'])
+            time_buffer = max(time_buffer, volc_buffer)
+            stations.update(volc_info['station'].split(','))
+
+        self.waveforms.fetch(sorted(stations), self.STARTTIME - time_buffer,
+                             self.ENDTIME + time_buffer)
+
+    @contextmanager
+    def _recording(self, stats):
+        """Time the run with stats, and save them however it ends"""
+        self.stats = stats
+        try:
+            yield
+        except BaseException as e:
+            stats.finish(STOPPED if isinstance(e, Stopped) else FAILED, repr(e))
+            raise
+        else:
+            stats.finish(OK)
+        finally:
+            stats.save()
 
-        network_dem = produce_dem(network_grid, external_file=None, plot_output=False)
-
-        X_RADIUS_SEARCH = volc_info['x_radius_search']  # [m] E-W grid radius (half of grid "width")
-        Y_RADIUS_SEARCH = volc_info['y_radius_search']  # [m] N-S grid radius (half of grid "height")
-        SPACING_SEARCH = volc_info['spacing_search']    # [m] Grid spacing
-
-        search_grid = define_grid(lon_0=LON_0, lat_0=LAT_0, x_radius=X_RADIUS_SEARCH,
-                                  y_radius=Y_RADIUS_SEARCH, spacing=SPACING_SEARCH, projected=True,
-                                  plot_preview=False)
-
-        search_dem = produce_dem(search_grid, external_file=None, plot_output=False)
+    def gen_volc_image(self, volc_name, volc_info, SAVE_DB = True):
+        from rtm import calculate_time_buffer
+
+        with self._recording(RunStats(volc_name, self.ENDTIME, self.ENDTIME - self.STARTTIME)):
+            # Grids and DEMs are loaded from (or built once into) the on-disk cache.
+            # The DEMs are only loaded when first used.
+            with self.stats.stage('grids'):
+                grids = VolcGrids(volc_name, volc_info)
+                grids.prune()
+
+                network_grid = grids.network_grid
+
+            # %% (2) Grab and process the data
+
+            # Automatically determine appropriate time buffer in s
+            MAX_STATION_DIST = volc_info['max_station_dist']  # [km] Max. dist. from grid center to station (approx.)
+            time_buffer = calculate_time_buffer(network_grid, MAX_STATION_DIST)
+
+            with self.stats.stage('waveforms'):
+                st = self._get_waveforms(volc_info, self.STARTTIME - time_buffer,
+                                         self.ENDTIME + time_buffer)
+
+            with self.stats.stage('process'):
+                st.remove_sensitivity()
+
+                st_proc = self._process(st, volc_info)
+
+            self._locate(volc_name, volc_info, grids, st, st_proc, self.STARTTIME, self.ENDTIME,
+                         SAVE_DB)
+            with self.stats.stage('db'):
+                self.db_writer.flush()
+
+    def gen_volc_range(self, volc_name, volc_info, start, end, window = 600, SAVE_DB = True):
+        """
+        Process every window of window seconds between start and end, with a
+        single data fetch and processing pass over the whole span. Returns
+        the end times of the windows processed.
+
+        Only the processing (response removal, detrending, tapering,
+        filtering, envelope, smoothing, AGC and decimation) is shared across
+        the span. Each window is then sliced out with its time buffers,
+        normalized, stacked, searched for peaks, saved and rendered exactly
+        as gen_volc_image does. So the two only differ where the processed
+        waveforms do:
+          - within the taper, filter and AGC edge effects at the ends of
+            each window's buffers, which gen_volc_image has and this doesn't;
+          - in every value, by the ratio of the two normalizations, when
+            such an edge effect held a trace's maximum in gen_volc_image;
+          - by up to a sample, if window isn't a whole number of decimated
+            samples.
+        Detection locations away from the buffers are unaffected. check_range
+        reports the differences for a given window.
+        """
+        from rtm import calculate_time_buffer
+
+        with self._recording(RunStats(volc_name, end, end - start, kind = 'range')):
+            with self.stats.stage('grids'):
+                grids = VolcGrids(volc_name, volc_info)
+                grids.prune()
+
+                time_buffer = calculate_time_buffer(grids.network_grid, volc_info['max_station_dist'])
+
+            with self.stats.stage('waveforms'):
+                st = self._get_waveforms(volc_info, start - time_buffer, end + time_buffer)
+
+            with self.stats.stage('process'):
+                st.remove_sensitivity()
+
+                # Normalization depends on the data in each window, so is done per-window below
+                st_proc = self._process(st, volc_info, normalize = False)
+
+            processed = []
+            win_end = start + window
+            try:
+                while win_end <= end:
+                    win_start = win_end - window
+                    st_win = st.slice(win_start - time_buffer, win_end + time_buffer)
+                    with self.stats.stage('process'):
+                        st_proc_win = st_proc.slice(win_start - time_buffer, win_end + time_buffer).copy()
+                        st_proc_win.normalize()
+
+                    print("Processing window ending", win_end)
+                    self._locate(volc_name, volc_info, grids, st_win, st_proc_win, win_start, win_end,
+                                 SAVE_DB)
+                    processed.append(win_end)
+                    win_end += window
+            finally:
+                # Detections are written in batches of windows, not once per window
+                with self.stats.stage('db'):
+                    self.db_writer.flush()
+
+        return processed
+
+    def _get_waveforms(self, volc_info, starttime, endtime):
+        STATION = volc_info['station']
+        if self.waveforms is not None:
+            return self.waveforms.get_stream(STATION, starttime, endtime)
 
-        # %% (2) Grab and process the data
+        return gather_waveforms(source=config.SOURCE, network=config.NETWORK, station=STATION,
+                                location=config.LOCATION, channel=config.CHANNEL,
+                                starttime=starttime, endtime=endtime)
 
-        # Data collection parameters
-        STATION = volc_info['station']
+    def _process(self, st, volc_info, normalize = True):
+        from rtm import process_waveforms
 
         FREQ_MIN = volc_info['freq_min']  # [Hz] Lower bandpass corner
         FREQ_MAX = volc_info['freq_max']   # [Hz] Upper bandpass corner
@@ -92,18 +226,6 @@ class infrasound_location:
         DECIMATION_RATE = config.DECIMATION_RATE    # [Hz] New sampling rate to use for decimation
         SMOOTH_WIN = volc_info['smooth_win']        # [s] Smoothing window duration
 
-        # Automatically determine appropriate time buffer in s
-        MAX_STATION_DIST = volc_info['max_station_dist']  # [km] Max. dist. from grid center to station (approx.)
-        time_buffer = calculate_time_buffer(network_grid, MAX_STATION_DIST)
-
-        st = gather_waveforms(source=SOURCE, network=NETWORK, station=STATION,
-                              location=LOCATION, channel=CHANNEL, starttime=self.STARTTIME,
-                              endtime=self.ENDTIME, time_buffer=time_buffer)
-
-        st.remove_sensitivity()
-
-        nsta = len(st)
-
         AGC_WIN = config.AGC_WIN
         #AGC_PARAMS = None
         AGC_PARAMS = dict(win_sec=AGC_WIN, method='walker')
@@ -111,59 +233,203 @@ class infrasound_location:
         st_proc = process_waveforms(st, freqmin=FREQ_MIN, freqmax=FREQ_MAX,
                                     envelope=True, smooth_win=SMOOTH_WIN,
                                     agc_params=AGC_PARAMS,
-                                    decimation_rate=DECIMATION_RATE, normalize=True,
+                                    decimation_rate=DECIMATION_RATE, normalize=normalize,
                                     plot_steps=False)
+        return st_proc
+
+    def _save_detections(self, volc_name, db_data, save_after, endtime):
+        """
+        Replace any detections already saved for (save_after, endtime] with
+        db_data, so re-running a window doesn't create duplicates. Written
+        when self.db_writer is flushed.
+        """
+        save_after = save_after.datetime.replace(tzinfo = timezone.utc)
+        endtime = endtime.datetime.replace(tzinfo = timezone.utc)
+        db_data = [row for row in db_data if save_after < row[2] <= endtime]
+
+        ##### DEBUG
+        if db_data:
+            print("Saving detections to DB:", db_data)
+
+        self.db_writer.add(volc_name, db_data, save_after, endtime)
+
+    def _peak_kwargs(self):
+        return {
+            'height': config.PEAK_HEIGHT,
+            'min_time': config.AGC_WIN,
+            'prominence': config.PROMINANCE,
+        }
+
+    def _stack(self, volc_name, grids, st_proc, starttime, endtime, nsta, adaptive = None):
+        """Grid search for a single window, normalized to the number of stations"""
+        search_grid = grids.search_grid
+        if adaptive is None:
+            adaptive = getattr(config, 'ADAPTIVE_SEARCH', False)
 
         # %% (3) Perform grid search
-        TIME_KWARGS = {'celerity': config.CEL, 'dem': search_dem}
+        if self.TIME_METHOD == 'fdtd':
+            TIME_KWARGS = getattr(config, 'FDTD_KWARGS', {})
+        else:
+            TIME_KWARGS = {'celerity': config.CEL, 'dem': grids.search_dem}
 
         # STACK_METHOD = 'semblance'  # Choose either 'sum', 'product', or 'semblance'
         #TIME_KWARGS = {'celerity': 338, 'dem': network_dem, 'window': 10}
 
-        S = grid_search(processed_st=st_proc, grid=search_grid, time_method=self.TIME_METHOD,
-                        starttime=self.STARTTIME, endtime=self.ENDTIME,
-                        stack_method=self.STACK_METHOD, **TIME_KWARGS)
-
-        # Normalize to number of stations
-        S.data = S.data / nsta
+        if self.STACK_METHOD in STACK_METHODS:
+            # Travel times are computed once per station and grid, and loaded from disk after that.
+            tt_store = TravelTimeStore(volc_name, grids.search, self.TIME_METHOD, **TIME_KWARGS)
+            tt_store.prune()
+            travel_times = tt_store.get(st_proc)
+
+            if adaptive:
+                # Stacks are normalized to the number of stations as they are computed
+                S, stacked = adaptive_stack(
+                    st_proc, search_grid, travel_times, starttime, endtime, nsta,
+                    self._peak_kwargs(),
+                    factor=getattr(config, 'ADAPTIVE_FACTOR', 4),
+                    radius=getattr(config, 'ADAPTIVE_RADIUS', 2),
+                    height_factor=getattr(config, 'ADAPTIVE_HEIGHT_FACTOR', 0.8),
+                    max_fraction=getattr(config, 'ADAPTIVE_MAX_FRACTION', 0.5),
+                    stack_method=self.STACK_METHOD, time_method=self.TIME_METHOD,
+                    celerity=TIME_KWARGS.get('celerity')
+                )
+                print(f"Adaptive search stacked {stacked:.1%} of {volc_name} grid nodes")
+            else:
+                S = stack_grid(st_proc, search_grid, travel_times, starttime, endtime,
+                               stack_method=self.STACK_METHOD, time_method=self.TIME_METHOD,
+                               celerity=TIME_KWARGS.get('celerity'), scale=1 / nsta)
+        else:
+            from rtm import grid_search
+
+            S = grid_search(processed_st=st_proc, grid=search_grid, time_method=self.TIME_METHOD,
+                            starttime=starttime, endtime=endtime,
+                            stack_method=self.STACK_METHOD, **TIME_KWARGS)
+
+            # Normalize to number of stations
+            S.data = S.data / nsta
+
+        return S
+
+    def check_adaptive(self, volc_name, volc_info):
+        """
+        Run both the full and the coarse-to-fine search on this window, and
+        report how closely the adaptive detections match the full ones.
+        """
+        from rtm import calculate_time_buffer
+
+        grids = VolcGrids(volc_name, volc_info)
+        time_buffer = calculate_time_buffer(grids.network_grid, volc_info['max_station_dist'])
+        st = self._get_waveforms(volc_info, self.STARTTIME - time_buffer,
+                                 self.ENDTIME + time_buffer)
+        st.remove_sensitivity()
+        st_proc = self._process(st, volc_info)
+
+        detections = {}
+        elapsed = {}
+        for adaptive in (False, True):
+            t_start = time.monotonic()
+            S = self._stack(volc_name, grids, st_proc, self.STARTTIME, self.ENDTIME, len(st),
+                            adaptive = adaptive)
+            elapsed[adaptive] = time.monotonic() - t_start
+
+            time_max, y_max, x_max, peaks, props = peak_coordinates(
+                S, unproject=False, **self._peak_kwargs()
+            )
+            detections[adaptive] = list(zip(time_max, x_max, y_max, props['peak_heights']))
+
+        summary = compare_detections(detections[False], detections[True])
+        summary['full_seconds'] = elapsed[False]
+        summary['adaptive_seconds'] = elapsed[True]
+        print(f"{volc_name}: {summary}")
+        return summary
+
+    def check_range(self, volc_name, volc_info, windows = 3):
+        """
+        Process the windows number of windows ending at this one both as
+        gen_volc_range does, from a single processing pass over the span, and
+        as gen_volc_image does, one window at a time, and report how closely
+        the detections match. Detections within 2 s of each other (the
+        compare_detections default) are counted as the same detection.
+        """
+        from rtm import calculate_time_buffer
+
+        grids = VolcGrids(volc_name, volc_info)
+        time_buffer = calculate_time_buffer(grids.network_grid, volc_info['max_station_dist'])
+        window = self.ENDTIME - self.STARTTIME
+        start = self.STARTTIME - (windows - 1) * window
+
+        st = self._get_waveforms(volc_info, start - time_buffer, self.ENDTIME + time_buffer)
+        st.remove_sensitivity()
+        st_proc = self._process(st, volc_info, normalize = False)
+
+        detections = {'window': [], 'range': []}
+        for idx in range(windows):
+            win_start = start + idx * window
+            win_end = win_start + window
+
+            st_win = st.slice(win_start - time_buffer, win_end + time_buffer).copy()
+            st_proc_range = st_proc.slice(win_start - time_buffer, win_end + time_buffer).copy()
+            st_proc_range.normalize()
+
+            for kind, st_proc_win in (('window', self._process(st_win, volc_info)),
+                                      ('range', st_proc_range)):
+                S = self._stack(volc_name, grids, st_proc_win, win_start, win_end, len(st_win))
+                time_max, y_max, x_max, peaks, props = peak_coordinates(
+                    S, unproject=False, **self._peak_kwargs()
+                )
+                detections[kind].extend(zip(time_max, x_max, y_max, props['peak_heights']))
+
+        summary = compare_detections(detections['window'], detections['range'])
+        summary['window'] = summary.pop('full')
+        summary['range'] = summary.pop('adaptive')
+        print(f"{volc_name}: {summary}")
+        return summary
+
+    def _locate(self, volc_name, volc_info, grids, st, st_proc, starttime, endtime, SAVE_DB):
+        """Grid search, detection and plotting for a single window"""
+        nsta = len(st)
 
-        PK_HT = config.PEAK_HEIGHT
-        MIN_TIME = AGC_WIN
-        PROM = config.PROMINANCE
+        with self.stats.stage('grid_search'):
+            S = self._stack(volc_name, grids, st_proc, starttime, endtime, nsta)
 
         # Find and save any detections
-        time_max, y_max, x_max, peaks, props = get_peak_coordinates(
-            S, global_max=False,
-            height=PK_HT,
-            min_time=MIN_TIME,
-            prominence=PROM,
-            unproject=True
-        )
+        with self.stats.stage('peaks'):
+            time_max, y_max, x_max, peaks, props = peak_coordinates(
+                S, unproject=True, **self._peak_kwargs()
+            )
 
         det_times = [x.datetime.replace(tzinfo = timezone.utc) for x in time_max]
         det_lon = numpy.asarray(x_max)
         det_lat = numpy.asarray(y_max)
         det_values = props['peak_heights']
 
-        if len(det_values) > 0 and SAVE_DB and nsta >= 3:
-            det_volc = [volc_name] * len(det_values)
-            gc_x, gc_y, _, _ = utm.from_latlon(*reversed(S.grid_center))
-            det_x, det_y, _, _ = utm.from_latlon(det_lat, det_lon)
+        self.stats.info.update(stations = nsta, grid_nodes = int(S.x.size * S.y.size),
+                               samples = st_proc[0].stats.npts if len(st_proc) else 0)
+        self.stats.info['windows'] += 1
+        self.stats.info['detections'] += len(det_values)
 
-            # Distance to center in meters (a^2+b^2=c^2)
-            det_dist = numpy.sqrt(numpy.square(det_x - gc_x) + numpy.square(det_y - gc_y))
+        if SAVE_DB and nsta >= 3:
+            db_data = []
+            if len(det_values) > 0:
+                import utm
 
-            db_data = list(zip(det_volc, det_values, det_times, det_dist, det_lon.tolist(), det_lat.tolist()))
+                det_volc = [volc_name] * len(det_values)
+                gc_x, gc_y, _, _ = utm.from_latlon(*reversed(S.grid_center))
+                det_x, det_y, _, _ = utm.from_latlon(det_lat, det_lon)
 
-            ##### DEBUG
-            print("Saving detections to DB:", db_data)
+                # Distance to center in meters (a^2+b^2=c^2)
+                det_dist = numpy.sqrt(numpy.square(det_x - gc_x) + numpy.square(det_y - gc_y))
 
-            with psycopg.connect(host = config.PG_SERVER, dbname = config.PG_DB,
-                                 user = config.PG_USER) as db_conn:
-                curr = db_conn.cursor()
-                curr.executemany("INSERT INTO detections (volc,value,d_time,dist,lon,lat) VALUES (%s,%s,%s,%s,%s,%s)",
-                                 db_data)
-                db_conn.commit()
+                db_data = list(zip(det_volc, det_values, det_times, det_dist, det_lon.tolist(), det_lat.tolist()))
+
+            # Each window owns the detections in (start, end], so the shared
+            # boundary with the previous window is only saved once. With
+            # overlapping windows, only the part of the window not already
+            # covered by the previous window is saved.
+            save_after = self.SAVE_AFTER if self.SAVE_AFTER is not None else starttime
+            # Also flushes, every DB_BATCH_WINDOWS windows
+            with self.stats.stage('db'):
+                self._save_detections(volc_name, db_data, save_after, endtime)
 
         # fig_rec = plot_record_section(st_proc, origin_time=time_max,
                 # source_location=(y_max, x_max),
@@ -172,86 +438,54 @@ class infrasound_location:
         # fig_rec.axes[0].set_ylim(bottom=6)  # Start at this distance (km) from source
 
         if self.ISAVE:
-            from matplotlib import rcParams
-            # %% (4) Plot
-
-            # This should be the default, but go ahead and be explicit about it anyway just to be sure.
-            rcParams.update({'font.size': 10})
-
-            fig_st = plot_st(st, filt=[FREQ_MIN, FREQ_MAX], equal_scale=False,
-                             remove_response=False, label_waveforms=True)
-
-            fig_slice = plot_time_slice(S, st_proc, label_stations=True, dem=network_dem,
-                                        plot_peak=True, xy_grid=X_RADIUS_NET, cont_int = 50,
-                                        annot_int = 500)
-
-            fig_st.set_dpi(200)
-            fig_slice.set_dpi(200)
-
-            # Adjust fig_slice to get rid of excess white space
-            fig_slice.set_size_inches(8, 10.465)
-            fig_slice.subplots_adjust(top = .945, bottom = .06, hspace = .2)
-
-            colorbar = fig_slice.get_children()[-1]
-            cb_pos = colorbar.get_position()
-            cb_pos.y1 = 0.9405
-            cb_pos.y0 = 0.347
-            cb_pos.x0 = .915
-            cb_pos.x1 = .935
-            colorbar.set_position(cb_pos)
-            ax = fig_slice.axes[0]
-            im = ax.get_images()
-            im[0].set_clim(.4, 1)
-
-            img_time = st_proc[0].stats.starttime
-            tmstr = UTCDateTime.strftime(img_time, '%Y%m%d_%H%M')
-            year = UTCDateTime.strftime(img_time, '%Y')
-            month = UTCDateTime.strftime(img_time, '%m')
-            day = UTCDateTime.strftime(img_time, '%d')
-            img_dir = os.path.join(self.SVDIR, volc_name, year, month, day)
-            os.makedirs(img_dir, exist_ok = True)
-
-            rcParams.update({'font.size': 10})
-
-            combined_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_combined.png')
-
-            c1 = fig_slice.canvas
-            c2 = fig_st.canvas
-
-            c1.draw()
-            c2.draw()
-
-            a1 = numpy.array(c1.buffer_rgba())
-            a2 = numpy.array(c2.buffer_rgba())
-
-            a = numpy.vstack((a1, a2))
-
-            dpi = 800
-            height = fig_slice.get_figheight() + fig_st.get_figheight()
-            fig_c, ax_c = plt.subplots(figsize=(8, height), dpi = dpi)
-            fig_c.subplots_adjust(0, 0, 1, 1)
-            ax_c.set_axis_off()
-            ax_c.matshow(a)
-
-            fig_c.savefig(combined_file, dpi = 200, pad_inches = 0.04, bbox_inches='tight')
-            plt.close('all')
-
-            # wfs_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_wfs.png')
-            # slice_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_slice.png')
-            # # recsec_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_recsec.png')
-
-            # fig_st.savefig(wfs_file, dpi=200,
-            # bbox_inches='tight', pad_inches=0.04)
-
-            # # fig_slice.set_size_inches(5,5)
-            # fig_slice.savefig(slice_file, dpi=200,
-            # bbox_inches='tight', pad_inches=0.04)
-
-            # fig_rec.savefig(recsec_file, dpi=200,
-            # bbox_inches='tight', pad_inches=0.1)
+            with self.stats.stage('render'):
+                if self.render_queue is not None:
+                    # Rendered by render.py, so the next volcano doesn't wait on plotting
+                    self.render_queue.submit(volc_name, volc_info, grids.network, st, st_proc, S)
+                else:
+                    render_images(volc_name, volc_info, st, st_proc, S, grids.network_dem)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generate infrasound location images and detections")
+    parser.add_argument('--workers', type = int, default = getattr(config, 'PARALLEL_WORKERS', 1),
+                        help = "Number of volcanoes to process at once")
+    parser.add_argument('--timeout', type = float, default = getattr(config, 'VOLC_TIMEOUT', None),
+                        help = "Wall-clock limit, in seconds, for each volcano")
+    parser.add_argument('--enqueue', action = 'store_true',
+                        help = "Add this window to the work queue for worker.py instead of processing it here")
+    parser.add_argument('--check-adaptive', action = 'store_true',
+                        help = "Compare the coarse-to-fine search against the full search for this window")
+    parser.add_argument('--check-range', action = 'store_true',
+                        help = "Compare processing this and the previous two windows as one span against processing each alone")
+    args = parser.parse_args()
+
     generator = infrasound_location()
-    for volc_name, volc_info in config.VOLCS.items():
-        generator.gen_volc_image(volc_name, volc_info)
+    if args.check_adaptive:
+        for volc_name, volc_info in config.VOLCS.items():
+            generator.check_adaptive(volc_name, volc_info)
+        sys.exit(0)
+
+    if args.check_range:
+        for volc_name, volc_info in config.VOLCS.items():
+            generator.check_range(volc_name, volc_info)
+        sys.exit(0)
+
+    if args.enqueue:
+        from infrasound.work_queue import LIVE, open_queue
+
+        queue = open_queue()
+        for volc_name in config.VOLCS:
+            queue.enqueue(volc_name, [generator.ENDTIME],
+                          window_len = int(generator.ENDTIME - generator.STARTTIME), priority = LIVE)
+        print(f"Queued {len(config.VOLCS)} volcanoes for window ending {generator.ENDTIME}")
+        sys.exit(0)
+
+    preload()
+    generator.prefetch(config.VOLCS)
+    results = run_volcanoes(generator, config.VOLCS, workers = args.workers,
+                            timeout = args.timeout)
+    print_summary(results)
+
+    if any(status != FINISHED for _, status, _ in results):
+        sys.exit(1)
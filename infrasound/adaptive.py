@@ -0,0 +1,153 @@
+"""
+Coarse-to-fine grid search.
+
+The window is first stacked on a coarse grid made of every factor'th node of
+the search grid, using the same (cached) travel times. Peaks found on the
+coarse stack are then refined by stacking every node of the search grid within
+a few coarse cells of each peak. Nodes outside the refined boxes keep the
+value of the nearest coarse node, so the result has the same shape as a full
+search and can go through peak finding and plot_time_slice unchanged.
+
+Stacking cost scales with the number of nodes stacked, so for factor 4 and a
+handful of candidates this is roughly 1/16 of the cost of the full search.
+When the refined boxes cover most of the grid (a noisy window with many
+candidates), the full grid is stacked in one pass instead.
+"""
+import numpy
+
+from infrasound.stacking import (
+    STACK_METHODS,
+    allocate_cube,
+    chunk_length,
+    peak_coordinates,
+    peak_trace,
+    stack_dataarray,
+    stack_nodes,
+    time_axis
+)
+
+
+def coarse_indexes(size, factor):
+    """The coarse node nearest to each fine node along one axis"""
+    coarse_size = (size - 1) // factor + 1
+    return numpy.clip(numpy.round(numpy.arange(size) / factor).astype(int), 0, coarse_size - 1)
+
+
+def refine_mask(shape, centers, factor, radius):
+    """Fine grid nodes within radius coarse cells of any of centers (fine y, x indexes)"""
+    mask = numpy.zeros(shape, dtype = bool)
+    reach = radius * factor
+    for iy, ix in centers:
+        mask[max(iy - reach, 0):iy + reach + 1, max(ix - reach, 0):ix + reach + 1] = True
+    return mask
+
+
+def adaptive_stack(processed_st, grid, travel_times, starttime, endtime, norm,
+                   peak_kwargs, factor = 4, radius = 2, height_factor = 0.8,
+                   max_fraction = 0.5, stack_method = 'sum', time_method = None, celerity = None,
+                   dtype = None, budget = None):
+    """
+    Coarse-to-fine equivalent of stack_grid.
+
+    norm is what the stack is divided by (the number of stations), and
+    peak_kwargs the height, min_time and prominence used for peak finding.
+    Candidates on the coarse grid only need to reach height_factor times the
+    detection height, since the coarse nodes may miss the true peak. If the
+    coarse and refined nodes together would be more than max_fraction of the
+    grid, the whole grid is stacked instead. Returns a (time, y, x) DataArray
+    over the full grid, and the number of nodes stacked as a fraction of the
+    grid (more than 1 when the coarse stack was followed by a full one).
+    """
+    if stack_method not in STACK_METHODS:
+        raise ValueError(f"Unsupported stack method: {stack_method}")
+
+    sampling_rate = processed_st[0].stats.sampling_rate
+    times = time_axis(starttime, endtime, sampling_rate)
+    npts = times.size
+
+    travel_times = numpy.asarray(travel_times)
+    nsta, ny, nx = travel_times.shape
+
+    # Coarse stack, on every factor'th node
+    coarse_grid = grid.isel(y = slice(None, None, factor), x = slice(None, None, factor))
+    coarse_grid.attrs = dict(grid.attrs, spacing = grid.attrs['spacing'] * factor)
+    coarse_tt = travel_times[:, ::factor, ::factor]
+    ncy, ncx = coarse_tt.shape[1:]
+    coarse = stack_nodes(processed_st, coarse_tt.reshape(nsta, -1), starttime, npts,
+                         stack_method, 1 / norm, dtype, budget)
+
+    S_coarse = stack_dataarray(coarse, coarse_grid, times, stack_method, time_method, celerity)
+
+    peak_kwargs = dict(peak_kwargs)
+    if peak_kwargs.get('height') is not None:
+        peak_kwargs['height'] = peak_kwargs['height'] * height_factor
+
+    _, _, _, peaks, _ = peak_coordinates(S_coarse, **peak_kwargs)
+
+    # Always refine the global maximum too, since that's the slice plotted
+    values, nodes = peak_trace(coarse, budget)
+    peak_times = set(numpy.atleast_1d(peaks).tolist())
+    peak_times.add(int(numpy.argmax(values)))
+
+    centers = []
+    for peak in sorted(peak_times):
+        cy, cx = numpy.unravel_index(int(nodes[peak]), (ncy, ncx))
+        centers.append((cy * factor, cx * factor))
+
+    mask = refine_mask((ny, nx), centers, factor, radius)
+    # The coarse nodes already have their exact values
+    mask[::factor, ::factor] = False
+    mask = mask.ravel()
+
+    coarse_fraction = ncy * ncx / (ny * nx)
+    stacked = coarse_fraction + mask.sum() / (ny * nx)
+    if stacked > max_fraction:
+        stack = stack_nodes(processed_st, travel_times.reshape(nsta, -1), starttime, npts,
+                            stack_method, 1 / norm, dtype, budget)
+        return (stack_dataarray(stack, grid, times, stack_method, time_method, celerity),
+                coarse_fraction + 1)
+
+    # Fill from the nearest coarse node, then stack the refined boxes in full
+    nearest = (coarse_indexes(ny, factor)[:, None] * ncx + coarse_indexes(nx, factor)).ravel()
+    composite = allocate_cube((npts, ny * nx), coarse.dtype, budget)
+    chunk = chunk_length(ny * nx, coarse.dtype, budget)
+    for t0 in range(0, npts, chunk):
+        numpy.take(coarse[t0:t0 + chunk], nearest, axis = 1, out = composite[t0:t0 + chunk])
+
+    composite[:, mask] = stack_nodes(processed_st, travel_times.reshape(nsta, -1)[:, mask],
+                                     starttime, npts, stack_method, 1 / norm, dtype, budget)
+
+    return stack_dataarray(composite, grid, times, stack_method, time_method, celerity), stacked
+
+
+def compare_detections(full, adaptive, time_tolerance = 2):
+    """
+    Match the detections from the full search to those from the adaptive
+    search. full and adaptive are lists of (time, x, y, value) with time a
+    UTCDateTime and x/y in meters. Returns a dict summarizing the agreement.
+    """
+    matched = []
+    missed = 0
+    unused = list(adaptive)
+    for d_time, x, y, value in full:
+        close = [det for det in unused if abs(det[0] - d_time) <= time_tolerance]
+        if not close:
+            missed += 1
+            continue
+
+        det = min(close, key = lambda det: abs(det[0] - d_time))
+        unused.remove(det)
+        matched.append((numpy.hypot(det[1] - x, det[2] - y), abs(det[3] - value)))
+
+    dist = numpy.array([m[0] for m in matched])
+    value = numpy.array([m[1] for m in matched])
+    return {
+        'full': len(full),
+        'adaptive': len(adaptive),
+        'matched': len(matched),
+        'missed': missed,
+        'extra': len(unused),
+        'max_dist': float(dist.max()) if dist.size else 0.0,
+        'mean_dist': float(dist.mean()) if dist.size else 0.0,
+        'max_value_diff': float(value.max()) if value.size else 0.0,
+    }
@@ -0,0 +1,265 @@
+"""
+Local SDS (SeisComP Data Structure) miniSEED archive as a data source.
+
+Day files are memory-mapped and the fixed headers of all records are read in
+bulk with numpy, so only the records that overlap the requested window are
+decoded. Stations with gaps in the archive are fetched from the remote FDSN
+source instead. The result matches what gather_waveforms returns.
+"""
+import glob
+import io
+import mmap
+import os
+
+import numpy
+
+from obspy import Stream, UTCDateTime, read, read_inventory
+
+from web import config
+
+# Anything within this many seconds of midnight may be in the previous day's file
+FILE_BORDER = 60
+
+# miniSEED 2 fixed section of data header, followed by blockette 1000
+_HEADER = [
+    ('sequence', 'S6'), ('quality', 'S1'), ('reserved', 'S1'),
+    ('station', 'S5'), ('location', 'S2'), ('channel', 'S3'), ('network', 'S2'),
+    ('year', 'u2'), ('day', 'u2'), ('hour', 'u1'), ('minute', 'u1'),
+    ('second', 'u1'), ('unused', 'u1'), ('fract', 'u2'),
+    ('nsamp', 'u2'), ('rate_factor', 'i2'), ('rate_multiplier', 'i2'),
+    ('activity_flags', 'u1'), ('io_flags', 'u1'), ('quality_flags', 'u1'),
+    ('num_blockettes', 'u1'), ('time_correction', 'i4'),
+    ('data_offset', 'u2'), ('blockette_offset', 'u2'),
+    ('blockette_type', 'u2'), ('next_blockette', 'u2'),
+    ('encoding', 'u1'), ('word_order', 'u1'), ('reclen_exponent', 'u1'),
+    ('blockette_reserved', 'u1'),
+]
+HEADER_BE = numpy.dtype([(name, '>' + fmt if fmt[0] in 'ui' else fmt) for name, fmt in _HEADER])
+HEADER_LE = HEADER_BE.newbyteorder('<')
+
+_inventories = {}
+
+
+class UnsupportedFile(Exception):
+    """The file can't be read record by record, and should be read with obspy instead"""
+
+
+def record_headers(buf):
+    """
+    Return the headers of every record in buf as a numpy record array, along
+    with the record length. All records must have the same length, and start
+    with blockette 1000.
+    """
+    if len(buf) < HEADER_BE.itemsize:
+        raise UnsupportedFile("File too short")
+
+    start = bytes(buf[:HEADER_BE.itemsize])
+    first = numpy.frombuffer(start, dtype = HEADER_BE)[0]
+    header = HEADER_BE if 1900 <= first['year'] <= 2100 else HEADER_LE
+    first = numpy.frombuffer(start, dtype = header)[0]
+    if first['blockette_offset'] != 48 or first['blockette_type'] != 1000:
+        raise UnsupportedFile("First blockette is not blockette 1000")
+
+    reclen = 2 ** int(first['reclen_exponent'])
+    if len(buf) % reclen:
+        raise UnsupportedFile("File size is not a multiple of the record length")
+
+    # Read the header at the start of each record through a strided view, and
+    # copy them out so nothing keeps a reference to buf.
+    headers = numpy.ndarray(shape = (len(buf) // reclen, ), dtype = header,
+                            buffer = buf, strides = (reclen, )).copy()
+
+    if (numpy.any(headers['blockette_type'] != 1000)
+            or numpy.any(headers['reclen_exponent'] != first['reclen_exponent'])):
+        raise UnsupportedFile("Mixed record lengths")
+
+    return headers, reclen
+
+
+def record_times(headers):
+    """Return the start and end time of each record in ns since the epoch"""
+    years = (headers['year'].astype('int64') - 1970).astype('datetime64[Y]')
+    days = years.astype('datetime64[D]') + (headers['day'].astype('int64') - 1)
+    seconds = (headers['hour'].astype('int64') * 3600
+               + headers['minute'].astype('int64') * 60
+               + headers['second'].astype('int64'))
+    start = (days.astype('datetime64[ns]').astype('int64')
+             + seconds * 1000000000
+             + headers['fract'].astype('int64') * 100000)
+
+    # Time correction, unless the "time correction applied" flag is set
+    apply_correction = (headers['activity_flags'] & 0x02) == 0
+    start += numpy.where(apply_correction, headers['time_correction'].astype('int64') * 100000, 0)
+
+    factor = headers['rate_factor'].astype('float64')
+    multiplier = headers['rate_multiplier'].astype('float64')
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        rate = numpy.select(
+            [(factor > 0) & (multiplier > 0), (factor > 0) & (multiplier < 0),
+             (factor < 0) & (multiplier > 0), (factor < 0) & (multiplier < 0)],
+            [factor * multiplier, -factor / multiplier,
+             -multiplier / factor, 1 / (factor * multiplier)],
+            default = 0)
+        duration = numpy.where(rate > 0, headers['nsamp'] / rate * 1e9, 0)
+
+    return start, start + duration.astype('int64'), rate
+
+
+def read_day_file(path, starttime, endtime):
+    """Read only the records of path that overlap starttime-endtime"""
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return Stream()
+
+    with buf:
+        try:
+            headers, reclen = record_headers(buf)
+        except UnsupportedFile:
+            data = None
+        else:
+            start, end, rate = record_times(headers)
+            overlaps = (rate > 0) & (end >= starttime.ns) & (start <= endtime.ns)
+            data = b''.join(buf[idx * reclen:(idx + 1) * reclen]
+                            for idx in numpy.flatnonzero(overlaps))
+
+    if data is None:
+        return read(path, format = 'MSEED', starttime = starttime, endtime = endtime)
+
+    if not data:
+        return Stream()
+
+    return read(io.BytesIO(data), format = 'MSEED')
+
+
+class SDSArchive:
+    def __init__(self, root = None):
+        self.root = root or config.SDS_ROOT
+
+    def day_files(self, network, station, location, channel, starttime, endtime):
+        day = UTCDateTime((starttime - FILE_BORDER).date)
+        files = []
+        while day <= endtime:
+            pattern = os.path.join(self.root, str(day.year), network, station,
+                                   f"{channel}.D",
+                                   f"{network}.{station}.{location}.{channel}.D."
+                                   f"{day.year}.{day.julday:03d}")
+            files.extend(sorted(glob.glob(pattern)))
+            day += 86400
+        return files
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime):
+        # SDS uses an empty string for an empty location code
+        location = location.replace('-', '')
+
+        st = Stream()
+        for path in self.day_files(network, station, location, channel, starttime, endtime):
+            st += read_day_file(path, starttime, endtime)
+
+        # Join adjacent records, but leave any gaps as separate traces
+        st.merge(method = -1)
+        st.trim(starttime, endtime)
+        return st
+
+
+def _complete(st, starttime, endtime):
+    """True if st has no gaps and covers starttime-endtime"""
+    if len(st) == 0 or st.get_gaps():
+        return False
+
+    for tr in st:
+        if tr.stats.starttime > starttime + tr.stats.delta:
+            return False
+        if tr.stats.endtime < endtime - tr.stats.delta:
+            return False
+
+    return True
+
+
+def get_inventory(network, station, location, channel, starttime, endtime):
+    inventory_file = getattr(config, 'SDS_INVENTORY', None)
+    key = inventory_file or (network, station, location, channel)
+    try:
+        return _inventories[key]
+    except KeyError:
+        pass
+
+    if inventory_file:
+        inv = read_inventory(inventory_file)
+    else:
+        from obspy.clients.fdsn import Client
+
+        client = Client(getattr(config, 'SDS_FALLBACK_SOURCE', 'IRIS'))
+        inv = client.get_stations(network=network, station=station, location=location,
+                                  channel=channel, starttime=starttime, endtime=endtime,
+                                  level='response')
+
+    _inventories[key] = inv
+    return inv
+
+
+def attach_metadata(st, inv):
+    for tr in st:
+        try:
+            coords = inv.get_coordinates(tr.id, tr.stats.starttime)
+            tr.stats.latitude = coords['latitude']
+            tr.stats.longitude = coords['longitude']
+            tr.stats.elevation = coords['elevation']
+            tr.stats.response = inv.get_response(tr.id, tr.stats.starttime)
+        except Exception as e:
+            print(f"No metadata for {tr.id}:", e)
+
+
+def gather_sds_waveforms(network, station, location, channel, starttime, endtime,
+                         time_buffer = 0, merge_fill_value = 0, trim_fill_value = 0,
+                         **kwargs):
+    """
+    Drop-in replacement for gather_waveforms that reads from the local SDS
+    archive, and falls back to the remote source for any station with gaps.
+    """
+    from infrasound.waveforms import gather_remote_waveforms
+
+    starttime = starttime - time_buffer
+    endtime = endtime + time_buffer
+
+    archive = SDSArchive()
+    inv = None
+
+    st = Stream()
+    for sta in station.split(','):
+        sta_st = archive.get_waveforms(network, sta, location, channel, starttime, endtime)
+        if _complete(sta_st, starttime, endtime):
+            if inv is None:
+                inv = get_inventory(network, station, location, channel, starttime, endtime)
+            attach_metadata(sta_st, inv)
+            st += sta_st
+            continue
+
+        print(f"Archive data for {sta} incomplete, fetching from remote source")
+        try:
+            remote_st = gather_remote_waveforms(
+                source=getattr(config, 'SDS_FALLBACK_SOURCE', 'IRIS'), network=network,
+                station=sta, location=location, channel=channel, starttime=starttime,
+                endtime=endtime, merge_fill_value=None, trim_fill_value=None
+            )
+        except Exception as e:
+            print(f"Unable to fetch {sta} from remote source:", e)
+            remote_st = Stream()
+
+        if len(remote_st) == 0 and len(sta_st) > 0:
+            # Better partial archive data than nothing at all
+            if inv is None:
+                inv = get_inventory(network, station, location, channel, starttime, endtime)
+            attach_metadata(sta_st, inv)
+            remote_st = sta_st
+
+        st += remote_st
+
+    # Remote data may have masked gaps
+    st = st.split()
+    st.merge(fill_value = merge_fill_value)
+    st.trim(starttime, endtime, pad = True, fill_value = trim_fill_value)
+    st.sort()
+    return st
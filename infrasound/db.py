@@ -0,0 +1,364 @@
+"""
+Shared PostgreSQL access for generate_images.py, the queue workers and the
+web interface.
+
+Connections come from a psycopg_pool pool, created lazily once per process
+(so forked children never share their parent's connections). If
+psycopg_pool isn't installed, or DB_POOL is off, each use gets its own
+connection instead.
+
+Detections are written with multi-row upserts keyed on (volc, d_time), so
+re-running a window, overlapping windows and backfills never duplicate rows.
+The unique index that relies on is added by setup_db.py, which is run once
+before anything writes detections, since any duplicate rows saved before it
+existed have to be removed first.
+
+Hourly and daily per-volcano rollups (detection count, max value and mean
+distance) are kept in detections_hourly and detections_daily. Every write
+recomputes just the buckets it touched, in the same transaction, so the
+rollups always match the raw table. rollups.py rebuilds them from scratch.
+
+Each write also sends a NOTIFY_CHANNEL notification per volcano and time
+span written, which the web interface relays to browsers as events.
+"""
+import json
+import os
+
+from contextlib import contextmanager
+from datetime import timedelta
+
+from web import config
+
+# Columns of the detections table, in the order rows are passed around
+DETECTION_COLUMNS = ('volc', 'value', 'd_time', 'dist', 'lon', 'lat')
+
+# Notified with {volc, start, end} (UTC) when detections are written
+NOTIFY_CHANNEL = 'infrasound_detections'
+
+# Rollup table -> bucket length
+ROLLUPS = {
+    'detections_hourly': 'hour',
+    'detections_daily': 'day',
+}
+
+_pool = None
+_pool_pid = None
+_schema_checked = False
+
+
+def connect_kwargs():
+    return {
+        'host': config.PG_SERVER,
+        'dbname': config.PG_DB,
+        'user': config.PG_USER,
+        'password': getattr(config, 'PG_PASS', None),
+    }
+
+
+def get_pool():
+    """This process's connection pool, or None if pooling isn't available"""
+    global _pool, _pool_pid
+
+    if not getattr(config, 'DB_POOL', True):
+        return None
+
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+
+    try:
+        from psycopg_pool import ConnectionPool
+    except ImportError:
+        return None
+
+    _pool = ConnectionPool(kwargs = connect_kwargs(),
+                           min_size = getattr(config, 'DB_POOL_MIN', 1),
+                           max_size = getattr(config, 'DB_POOL_MAX', 4),
+                           open = True)
+    _pool_pid = os.getpid()
+    return _pool
+
+
+@contextmanager
+def connection():
+    """
+    A connection, from the pool if there is one. As with psycopg's own
+    context managers, the transaction is committed when the block exits
+    normally, and rolled back if it raises.
+    """
+    pool = get_pool()
+    if pool is not None:
+        with pool.connection() as conn:
+            yield conn
+        return
+
+    import psycopg
+
+    with psycopg.connect(**connect_kwargs()) as conn:
+        yield conn
+
+
+@contextmanager
+def sqlite_connection(path, timeout = 60):
+    """
+    A connection to a SQLite file standing in for the database, which (unlike
+    sqlite3's own context manager) is also closed when the block exits.
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(path, timeout = timeout)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def has_unique_index(cur):
+    cur.execute("SELECT 1 FROM pg_indexes WHERE tablename='detections' AND indexname='detections_volc_d_time_key'")
+    return cur.fetchone() is not None
+
+
+def add_unique_index(conn, delete_duplicates = False):
+    """
+    Add the unique index on detections (volc, d_time) that the upserts rely
+    on (it also serves range queries). Rows sharing a volc and d_time have
+    to be removed first: all but one of each are deleted if
+    delete_duplicates is set, otherwise a RuntimeError is raised if there
+    are any. Returns the number of rows deleted.
+    """
+    cur = conn.cursor()
+    if has_unique_index(cur):
+        return 0
+
+    cur.execute("SELECT count(*) - count(DISTINCT (volc, d_time)) FROM detections")
+    duplicates = cur.fetchone()[0]
+    if duplicates and not delete_duplicates:
+        raise RuntimeError(f"detections has {duplicates} duplicate (volc, d_time) rows")
+
+    deleted = 0
+    if duplicates:
+        cur.execute("""
+            DELETE FROM detections a USING detections b
+            WHERE a.volc=b.volc AND a.d_time=b.d_time AND a.ctid < b.ctid
+        """)
+        deleted = cur.rowcount
+
+    cur.execute("CREATE UNIQUE INDEX detections_volc_d_time_key ON detections (volc, d_time)")
+    conn.commit()
+    return deleted
+
+
+def ensure_schema(conn):
+    """
+    Create the rollup, detection_updates and run_stats tables if they don't
+    exist yet. Called by the code writing to them; the web interface only
+    reads. Raises a RuntimeError if setup_db.py hasn't added the unique index
+    on detections yet.
+    """
+    global _schema_checked
+    if _schema_checked:
+        return
+
+    cur = conn.cursor()
+    if not has_unique_index(cur):
+        raise RuntimeError("detections has no unique index on (volc, d_time). Run setup_db.py to add it.")
+
+    for table in ROLLUPS:
+        cur.execute("SELECT to_regclass(%s)", (table, ))
+        if cur.fetchone()[0] is not None:
+            continue
+
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                volc TEXT NOT NULL,
+                bucket TIMESTAMPTZ NOT NULL,
+                count INTEGER NOT NULL,
+                max_value DOUBLE PRECISION,
+                mean_dist DOUBLE PRECISION,
+                PRIMARY KEY (volc, bucket)
+            )
+        """)
+        conn.commit()
+        print(f"Created {table}. Run rollups.py to fill it from existing detections.")
+
+    # When each volcano's detections last changed, for HTTP caching
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS detection_updates (
+            volc TEXT PRIMARY KEY,
+            updated TIMESTAMPTZ NOT NULL
+        )
+    """)
+
+    # Per-run timing and resource use, from infrasound.run_stats
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS run_stats (
+            id BIGSERIAL PRIMARY KEY,
+            volc TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            window_end TIMESTAMPTZ NOT NULL,
+            window_len DOUBLE PRECISION,
+            started TIMESTAMPTZ NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            wall DOUBLE PRECISION,
+            cpu DOUBLE PRECISION,
+            max_rss_mb DOUBLE PRECISION,
+            stations INTEGER,
+            grid_nodes INTEGER,
+            samples INTEGER,
+            windows INTEGER,
+            detections INTEGER,
+            stages JSONB,
+            host TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS run_stats_volc_started ON run_stats (volc, started DESC)")
+    # For pruning, and for /metrics, which only looks at the last day
+    cur.execute("CREATE INDEX IF NOT EXISTS run_stats_started ON run_stats (started)")
+    conn.commit()
+
+    _schema_checked = True
+
+
+def last_update(volc_name):
+    """When the detections for volc_name last changed, or None if not known"""
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT updated FROM detection_updates WHERE volc=%s", (volc_name, ))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def bucket_range(unit, start, end):
+    """The start of the first bucket touched by start-end, and the end of the last"""
+    if unit == 'hour':
+        first = start.replace(minute = 0, second = 0, microsecond = 0)
+        last = end.replace(minute = 0, second = 0, microsecond = 0) + timedelta(hours = 1)
+    else:
+        first = start.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+        last = end.replace(hour = 0, minute = 0, second = 0, microsecond = 0) + timedelta(days = 1)
+    return first, last
+
+
+def refresh_rollups(cur, volc_name, start = None, end = None):
+    """
+    Recompute the rollup buckets for volc_name that overlap start-end (UTC
+    datetimes), or all of them if start and end are None.
+    """
+    for table, unit in ROLLUPS.items():
+        if start is None:
+            first, last = None, None
+        else:
+            first, last = bucket_range(unit, start, end)
+
+        time_filter = """d_time >= COALESCE(%s::timestamptz, '-infinity')
+                      AND d_time < COALESCE(%s::timestamptz, 'infinity')"""
+        cur.execute(
+            f"""DELETE FROM {table} WHERE volc=%s
+            AND bucket >= COALESCE(%s::timestamptz, '-infinity')
+            AND bucket < COALESCE(%s::timestamptz, 'infinity')""",
+            (volc_name, first, last)
+        )
+        cur.execute(
+            f"""INSERT INTO {table} (volc, bucket, count, max_value, mean_dist)
+            SELECT volc, date_trunc('{unit}', d_time, 'UTC'), count(*), max(value), avg(dist)
+            FROM detections WHERE volc=%s AND {time_filter}
+            GROUP BY 1, 2""",
+            (volc_name, first, last)
+        )
+
+
+def rebuild_rollups(volcs = None):
+    """Rebuild the rollups for volcs (default all volcanoes with detections), one transaction each"""
+    with connection() as conn:
+        ensure_schema(conn)
+        cur = conn.cursor()
+        if volcs is None:
+            cur.execute("SELECT DISTINCT volc FROM detections")
+            volcs = sorted(row[0] for row in cur)
+
+        for volc in volcs:
+            refresh_rollups(cur, volc)
+            conn.commit()
+            yield volc
+
+
+def _merge_spans(windows):
+    """Merge the (volc, start, end) of windows into non-overlapping spans per volcano"""
+    spans = []
+    for volc, start, end in sorted(windows):
+        if spans and spans[-1][0] == volc and start <= spans[-1][2]:
+            spans[-1] = (volc, spans[-1][1], max(end, spans[-1][2]))
+        else:
+            spans.append((volc, start, end))
+    return spans
+
+
+def upsert_detections(cur, rows, batch_size = 1000):
+    """Insert rows of DETECTION_COLUMNS, replacing any existing row for the same (volc, d_time)"""
+    placeholders = f"({','.join(['%s'] * len(DETECTION_COLUMNS))})"
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        values = ','.join([placeholders] * len(batch))
+        cur.execute(
+            f"""INSERT INTO detections ({','.join(DETECTION_COLUMNS)}) VALUES {values}
+            ON CONFLICT (volc, d_time) DO UPDATE
+            SET value=EXCLUDED.value, dist=EXCLUDED.dist, lon=EXCLUDED.lon, lat=EXCLUDED.lat""",
+            [value for row in batch for value in row]
+        )
+
+
+class DetectionWriter:
+    """
+    Collects the detections for one or more windows and writes them in a
+    single transaction. Each window owns the detections in (start, end], so
+    any rows previously saved in that range but not found this time are
+    removed.
+    """
+
+    def __init__(self, batch_windows = None):
+        # Flush automatically after this many windows
+        self.batch_windows = batch_windows or getattr(config, 'DB_BATCH_WINDOWS', 36)
+        self.windows = []  # (volc, start, end, rows)
+
+    def add(self, volc_name, rows, start, end):
+        rows = [(volc, float(value), d_time, float(dist), float(lon), float(lat))
+                for volc, value, d_time, dist, lon, lat in rows]
+        self.windows.append((volc_name, start, end, rows))
+        if len(self.windows) >= self.batch_windows:
+            self.flush()
+
+    def flush(self):
+        if not self.windows:
+            return
+
+        windows, self.windows = self.windows, []
+
+        # A single upsert can't touch the same row twice, so the last window wins
+        rows = {(row[0], row[2]): row for _, _, _, window_rows in windows for row in window_rows}
+        rows = list(rows.values())
+
+        with connection() as conn:
+            ensure_schema(conn)
+            cur = conn.cursor()
+            cur.executemany(
+                """DELETE FROM detections WHERE volc=%s AND d_time>%s AND d_time<=%s
+                AND NOT d_time = ANY(%s)""",
+                [(volc, start, end, [row[2] for row in window_rows])
+                 for volc, start, end, window_rows in windows]
+            )
+            upsert_detections(cur, rows)
+            for volc, start, end in _merge_spans([window[:3] for window in windows]):
+                refresh_rollups(cur, volc, start, end)
+                # Delivered to listeners (the web interface) when this commits
+                cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, json.dumps({
+                    'volc': volc,
+                    'start': start.strftime('%Y-%m-%d %H:%M:%S'),
+                    'end': end.strftime('%Y-%m-%d %H:%M:%S'),
+                })))
+            cur.executemany(
+                """INSERT INTO detection_updates (volc, updated) VALUES (%s, now())
+                ON CONFLICT (volc) DO UPDATE SET updated=EXCLUDED.updated""",
+                [(volc, ) for volc in sorted({window[0] for window in windows})]
+            )
+            conn.commit()
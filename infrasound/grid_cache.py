@@ -0,0 +1,175 @@
+"""
+Persistent on-disk cache for the grids and DEMs used by gen_volc_image.
+
+Grids and DEMs only depend on the grid parameters in config.VOLCS, so they are
+built once, saved as .npy files (which can be memory-mapped) and loaded on
+later runs. Entries are keyed by a hash of the parameters, so changing a
+volcano's config entry automatically results in a new entry being built.
+"""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy
+
+from web import config
+
+# Bump this if the on-disk layout changes to invalidate existing entries
+CACHE_VERSION = 1
+
+# Entries already loaded by this process, keyed by (key, kind)
+_loaded = {}
+
+
+def cache_dir():
+    return os.path.join(getattr(config, 'CACHE_DIR', '/tmp/infrasound_cache'), 'grids')
+
+
+def grid_key(lon_0, lat_0, x_radius, y_radius, spacing, projected = True,
+             external_file = None):
+    params = {
+        'version': CACHE_VERSION,
+        'lon_0': float(lon_0),
+        'lat_0': float(lat_0),
+        'x_radius': float(x_radius),
+        'y_radius': float(y_radius),
+        'spacing': float(spacing),
+        'projected': bool(projected),
+        'external_file': external_file,
+    }
+    blob = json.dumps(params, sort_keys = True).encode()
+    return hashlib.sha1(blob).hexdigest()[:16]
+
+
+def save_array(path, arr: 'xarray.DataArray'):
+    """Save a DataArray as a .npy file of values plus a pickle of its metadata"""
+    numpy.save(f"{path}.npy", numpy.asarray(arr.values))
+    meta = {
+        'dims': arr.dims,
+        'coords': {name: (coord.dims, coord.values) for name, coord in arr.coords.items()},
+        'attrs': dict(arr.attrs),
+        'name': arr.name,
+    }
+    with open(f"{path}.pkl", 'wb') as f:
+        pickle.dump(meta, f)
+
+
+def load_array(path) -> 'xarray.DataArray':
+    # Imported here so importing this module doesn't pull in xarray (and pandas)
+    import xarray
+
+    # Copy-on-write so any in-place changes never make it back to the cache
+    values = numpy.load(f"{path}.npy", mmap_mode = 'c')
+    with open(f"{path}.pkl", 'rb') as f:
+        meta = pickle.load(f)
+
+    return xarray.DataArray(values, dims = meta['dims'], coords = meta['coords'],
+                            attrs = meta['attrs'], name = meta['name'])
+
+
+class CachedGrid:
+    """
+    A single grid and its DEM, loaded lazily from the on-disk cache and built
+    (once) if not already present.
+    """
+
+    def __init__(self, volc_name, lon_0, lat_0, x_radius, y_radius, spacing,
+                 external_file = None):
+        self.volc_name = volc_name
+        self.params = dict(lon_0 = lon_0, lat_0 = lat_0, x_radius = x_radius,
+                           y_radius = y_radius, spacing = spacing)
+        self.external_file = external_file
+        self.key = grid_key(lon_0, lat_0, x_radius, y_radius, spacing,
+                            external_file = external_file)
+        self.path = os.path.join(cache_dir(), volc_name, self.key)
+
+    @property
+    def grid(self) -> 'xarray.DataArray':
+        return self._get('grid')
+
+    @property
+    def dem(self) -> 'xarray.DataArray':
+        return self._get('dem')
+
+    def _get(self, kind):
+        try:
+            return _loaded[(self.key, kind)]
+        except KeyError:
+            pass
+
+        if not os.path.isfile(os.path.join(self.path, f"{kind}.npy")):
+            self._build()
+
+        arr = load_array(os.path.join(self.path, kind))
+        _loaded[(self.key, kind)] = arr
+        return arr
+
+    def _build(self):
+        from rtm import define_grid, produce_dem
+
+        print(f"Building grid cache entry {self.key} for {self.volc_name}")
+        grid = define_grid(**self.params, projected=True, plot_preview=False)
+        dem = produce_dem(grid, external_file=self.external_file, plot_output=False)
+
+        volc_dir = os.path.dirname(self.path)
+        os.makedirs(volc_dir, exist_ok = True)
+
+        # Build in a temporary directory and rename into place, so other
+        # processes never see a partially written entry.
+        tmp_dir = tempfile.mkdtemp(dir = volc_dir, prefix = '.tmp-')
+        try:
+            save_array(os.path.join(tmp_dir, 'grid'), grid)
+            save_array(os.path.join(tmp_dir, 'dem'), dem)
+            os.rename(tmp_dir, self.path)
+        except OSError:
+            # Another process beat us to it. Use theirs.
+            if not os.path.isdir(self.path):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+
+
+class VolcGrids:
+    """The network and search grids/DEMs for a single volcano"""
+
+    def __init__(self, volc_name, volc_info, external_file = None):
+        self.volc_name = volc_name
+        self.network = CachedGrid(volc_name, volc_info['lon'], volc_info['lat'],
+                                  volc_info['x_radius_net'], volc_info['y_radius_net'],
+                                  volc_info['spacing_net'], external_file)
+        self.search = CachedGrid(volc_name, volc_info['lon'], volc_info['lat'],
+                                 volc_info['x_radius_search'], volc_info['y_radius_search'],
+                                 volc_info['spacing_search'], external_file)
+
+    @property
+    def network_grid(self):
+        return self.network.grid
+
+    @property
+    def network_dem(self):
+        return self.network.dem
+
+    @property
+    def search_grid(self):
+        return self.search.grid
+
+    @property
+    def search_dem(self):
+        return self.search.dem
+
+    def prune(self):
+        """Remove any cache entries for this volcano that are no longer in use"""
+        volc_dir = os.path.join(cache_dir(), self.volc_name)
+        keep = {self.network.key, self.search.key}
+        try:
+            entries = os.listdir(volc_dir)
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry in keep or entry.startswith('.tmp-'):
+                continue
+            shutil.rmtree(os.path.join(volc_dir, entry), ignore_errors = True)
@@ -0,0 +1,212 @@
+"""
+Catalog of the images under IMG_DIR, so the web interface can find them
+without listing directories.
+
+Each image time of each volcano gets a row in a table keyed on
+(volc, img_time), holding the file names the web interface shows for it:
+the combined image and its thumbnail, or for older images without a combined
+image, all the PNG files for that time. Finding the images before a time,
+and the first one after it, is then an index seek however far apart the
+images are.
+
+render_images adds each image as it is written. catalog.py rebuilds the
+catalog from the files on disk, for images written before it existed or
+added by hand.
+
+The catalog is kept in the PostgreSQL database already used for detections,
+so images rendered on any host are listed by the web interface. A SQLite
+file can be used instead (IMAGE_CATALOG), as a stand-in for running on a
+single host without Postgres.
+"""
+import os
+import re
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from infrasound import db
+from web import config
+
+# <volc>_<YYYYmmdd>_<HHMM>_<kind>.<ext>
+FILE_PATTERN = re.compile(r'^(?P<volc>.+)_(?P<date>\d{8})_(?P<time>\d{4})_(?P<kind>[^.]+)\.(?P<ext>png|jpg)$')
+
+
+SCHEMA = {
+    'postgres': [
+        """CREATE TABLE IF NOT EXISTS image_catalog (
+            volc TEXT NOT NULL,
+            img_time BIGINT NOT NULL,  -- epoch seconds
+            files TEXT NOT NULL,
+            PRIMARY KEY (volc, img_time)
+        )""",
+        # When each volcano's images last changed, for HTTP caching
+        """CREATE TABLE IF NOT EXISTS image_updates (
+            volc TEXT PRIMARY KEY,
+            updated DOUBLE PRECISION NOT NULL
+        )""",
+    ],
+    'sqlite': [
+        "PRAGMA journal_mode=WAL",
+        """CREATE TABLE IF NOT EXISTS image_catalog (
+            volc TEXT NOT NULL,
+            img_time INTEGER NOT NULL,
+            files TEXT NOT NULL,
+            PRIMARY KEY (volc, img_time)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS image_updates (
+            volc TEXT PRIMARY KEY,
+            updated REAL NOT NULL
+        )""",
+    ],
+}
+
+
+def parse_image_name(filename):
+    """(volc, image time as a timestamp, kind, extension) for an image file name, or None"""
+    match = FILE_PATTERN.match(filename)
+    if match is None:
+        return None
+
+    img_time = datetime.strptime(f"{match['date']}T{match['time']}", "%Y%m%dT%H%M")
+    img_time = img_time.replace(tzinfo = timezone.utc).timestamp()
+    return match['volc'], int(img_time), match['kind'], match['ext']
+
+
+def file_group(names):
+    """
+    The files to show for one image time: the combined image and its
+    thumbnail if there is a combined image, otherwise all the PNGs.
+    """
+    names = sorted(names)
+    for name in names:
+        if name.endswith('_combined.png'):
+            group = [name, ]
+            thumb = name.replace('_combined.png', '_thumb.jpg')
+            if thumb in names:
+                group.append(thumb)
+            return group
+
+    return [name for name in names if name.endswith('.png')]
+
+
+class ImageCatalog:
+    def __init__(self, connect = db.connection, dialect = 'postgres'):
+        # connect is a function returning a context manager yielding a
+        # DB-API connection, committed when the block exits
+        self.connect = connect
+        self.dialect = dialect
+        self._schema_checked = False
+
+    def _sql(self, sql):
+        if self.dialect == 'sqlite':
+            sql = sql.replace('%s', '?')
+        return sql
+
+    def ensure_schema(self):
+        """Create the tables. Called before writing; the web interface only reads."""
+        if self._schema_checked:
+            return
+
+        with self.connect() as conn:
+            for statement in SCHEMA[self.dialect]:
+                conn.execute(statement)
+        self._schema_checked = True
+
+    def add(self, image_file):
+        """Add (or update) the image time of image_file, from the files now in its directory"""
+        img_dir, name = os.path.split(image_file)
+        volc, img_time, _, _ = parse_image_name(name)
+        prefix = name.rsplit('_', 1)[0] + '_'
+        names = [entry for entry in os.listdir(img_dir)
+                 if entry.startswith(prefix) and parse_image_name(entry) is not None]
+
+        self.ensure_schema()
+        with self.connect() as conn:
+            self._store(conn.cursor(), volc, [(img_time, file_group(names))])
+
+    def _store(self, cur, volc, entries):
+        cur.executemany(
+            self._sql("""INSERT INTO image_catalog (volc, img_time, files) VALUES (%s, %s, %s)
+            ON CONFLICT (volc, img_time) DO UPDATE SET files=excluded.files"""),
+            [(volc, img_time, ','.join(files)) for img_time, files in entries if files]
+        )
+        cur.execute(
+            self._sql("""INSERT INTO image_updates (volc, updated) VALUES (%s, %s)
+            ON CONFLICT (volc) DO UPDATE SET updated=excluded.updated"""),
+            (volc, time.time())
+        )
+
+    def rebuild(self, volc):
+        """Replace the entries for volc with the images found under IMG_DIR. Returns the count."""
+        names = defaultdict(list)
+        for img_dir, _, files in os.walk(os.path.join(config.IMG_DIR, volc)):
+            for name in files:
+                parsed = parse_image_name(name)
+                if parsed is not None and parsed[0] == volc:
+                    names[parsed[1]].append(name)
+
+        entries = [(img_time, file_group(group)) for img_time, group in names.items()]
+        self.ensure_schema()
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute(self._sql("DELETE FROM image_catalog WHERE volc=%s"), (volc, ))
+            self._store(cur, volc, entries)
+        return len(entries)
+
+    def before(self, volc, stop_time = None, limit = 1):
+        """
+        Up to limit (img_time, files) at or before stop_time (a timestamp, or
+        None for the newest), newest first
+        """
+        if stop_time is None:
+            stop_time = 2 ** 62
+
+        with self.connect() as conn:
+            rows = conn.execute(
+                self._sql("""SELECT img_time, files FROM image_catalog
+                WHERE volc=%s AND img_time <= %s
+                ORDER BY img_time DESC LIMIT %s"""),
+                (volc, int(stop_time), limit)
+            ).fetchall()
+        return [(img_time, files.split(',')) for img_time, files in rows]
+
+    def after(self, volc, start_time):
+        """The time of the first image after start_time (a timestamp), or None"""
+        with self.connect() as conn:
+            row = conn.execute(
+                self._sql("SELECT min(img_time) FROM image_catalog WHERE volc=%s AND img_time > %s"),
+                (volc, start_time)
+            ).fetchone()
+        return row[0]
+
+    def last_update(self, volc):
+        """When the images for volc last changed (a timestamp), or None if not known"""
+        with self.connect() as conn:
+            row = conn.execute(self._sql("SELECT updated FROM image_updates WHERE volc=%s"),
+                               (volc, )).fetchone()
+        return row[0] if row else None
+
+    def updates(self):
+        """When the images for each volcano last changed, as {volc: timestamp}"""
+        with self.connect() as conn:
+            return dict(conn.execute("SELECT volc, updated FROM image_updates").fetchall())
+
+
+def open_catalog():
+    """
+    The catalog configured in config: the PostgreSQL detections database, or
+    a SQLite file if IMAGE_CATALOG is set (for running on a single host
+    without Postgres).
+    """
+    path = getattr(config, 'IMAGE_CATALOG', None)
+    if not path:
+        return ImageCatalog()
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+    # Renderer processes write concurrently, so wait for the lock
+    catalog = ImageCatalog(lambda: db.sqlite_connection(path, timeout = 30), dialect = 'sqlite')
+    # A local file, so it's created here rather than by setup_db.py
+    catalog.ensure_schema()
+    return catalog
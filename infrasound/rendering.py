@@ -0,0 +1,293 @@
+"""
+Image rendering, decoupled from detection.
+
+Plotting takes longer than the grid search, so rather than rendering inline,
+gen_volc_image can write everything the plots need (the raw and processed
+streams, a reduced copy of the stack, and a reference to the cached DEM)
+into a job directory in a spool, and move on to the next volcano. render.py runs a pool of
+processes that pick up jobs from the spool and render them. Failed jobs are
+retried from the saved data, without rerunning the grid search.
+
+Spool layout, under CACHE_DIR/render:
+    pending/<job>   Waiting to be rendered (or retried)
+    active/<job>    Being rendered
+    failed/<job>    Gave up after RENDER_ATTEMPTS tries
+
+Only one render.py should run against a spool at a time.
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from obspy import UTCDateTime
+
+from infrasound.grid_cache import CachedGrid, load_array, save_array
+from infrasound.image_catalog import open_catalog
+from infrasound.stacking import peak_trace
+from web import config
+
+PENDING = 'pending'
+ACTIVE = 'active'
+FAILED = 'failed'
+
+
+def spool_dir():
+    return os.path.join(getattr(config, 'CACHE_DIR', '/tmp/infrasound_cache'), 'render')
+
+
+def image_dir(volc_name, img_time):
+    year = UTCDateTime.strftime(img_time, '%Y')
+    month = UTCDateTime.strftime(img_time, '%m')
+    day = UTCDateTime.strftime(img_time, '%d')
+    return os.path.join(config.IMG_DIR, volc_name, year, month, day)
+
+
+def _save_atomic(img, path, **kwargs):
+    # The web interface lists files as soon as they appear, so never show it a partial one
+    tmp_file = f"{path}.tmp"
+    img.save(tmp_file, **kwargs)
+    os.replace(tmp_file, path)
+
+
+def save_combined(rgba, combined_file):
+    """
+    Write the stacked figure buffers straight to combined_file, with the same
+    8 pixel white border savefig(dpi=200, pad_inches=0.04) used to add. Also
+    writes any extra formats in IMAGE_FORMATS, and a JPEG thumbnail
+    IMAGE_THUMB_WIDTH pixels wide for the browser.
+    """
+    from PIL import Image
+
+    pad = 8
+    img = Image.fromarray(rgba, 'RGBA').convert('RGB')  # The figures are opaque
+    combined = Image.new('RGB', (img.width + 2 * pad, img.height + 2 * pad), 'white')
+    combined.paste(img, (pad, pad))
+
+    _save_atomic(combined, combined_file, format = 'PNG',
+                 compress_level = getattr(config, 'IMAGE_PNG_COMPRESS', 6))
+
+    base = os.path.splitext(combined_file)[0]
+    quality = getattr(config, 'IMAGE_QUALITY', 85)
+    for fmt in getattr(config, 'IMAGE_FORMATS', []):
+        fmt = fmt.lower()
+        if fmt == 'webp':
+            _save_atomic(combined, f"{base}.webp", format = 'WEBP', quality = quality, method = 4)
+        elif fmt in ('jpg', 'jpeg'):
+            _save_atomic(combined, f"{base}.jpg", format = 'JPEG', quality = quality,
+                         optimize = True)
+        else:
+            print(f"Unsupported image format {fmt}")
+
+    thumb_width = getattr(config, 'IMAGE_THUMB_WIDTH', 700)
+    if thumb_width:
+        thumb_height = round(combined.height * thumb_width / combined.width)
+        thumb = combined.resize((thumb_width, thumb_height), Image.LANCZOS)
+        thumb_file = combined_file.replace('_combined.png', '_thumb.jpg')
+        _save_atomic(thumb, thumb_file, format = 'JPEG', quality = quality, optimize = True)
+
+
+def render_stack(S, samples = None):
+    """
+    The part of the stack S that the plots use, as float32: the time slices
+    at which the maximum over the grid peaks within each of at most samples
+    blocks of time. Every slice kept is exact, including the one at the
+    stack maximum, and the maximum over the grid through time keeps its
+    peaks.
+    """
+    samples = samples or getattr(config, 'RENDER_STACK_SAMPLES', 600)
+    values, _ = peak_trace(S.data)
+    block = -(-values.size // samples)
+    indexes = [start + int(values[start:start + block].argmax())
+               for start in range(0, values.size, block)]
+    return S.isel(time = indexes).astype('float32')
+
+
+def render_images(volc_name, volc_info, st, st_proc, S, dem):
+    """Plot the waveforms and time slice, and save the combined image"""
+    import matplotlib.pyplot as plt
+
+    from matplotlib import rcParams
+    from rtm import plot_st, plot_time_slice
+
+    X_RADIUS_NET = volc_info['x_radius_net']  # [m] E-W grid radius (half of grid "width")
+    FREQ_MIN = volc_info['freq_min']  # [Hz] Lower bandpass corner
+    FREQ_MAX = volc_info['freq_max']   # [Hz] Upper bandpass corner
+
+    # %% (4) Plot
+
+    # This should be the default, but go ahead and be explicit about it anyway just to be sure.
+    rcParams.update({'font.size': 10})
+
+    fig_st = plot_st(st, filt=[FREQ_MIN, FREQ_MAX], equal_scale=False,
+                     remove_response=False, label_waveforms=True)
+
+    fig_slice = plot_time_slice(S, st_proc, label_stations=True, dem=dem,
+                                plot_peak=True, xy_grid=X_RADIUS_NET, cont_int = 50,
+                                annot_int = 500)
+
+    fig_st.set_dpi(200)
+    fig_slice.set_dpi(200)
+
+    # Adjust fig_slice to get rid of excess white space
+    fig_slice.set_size_inches(8, 10.465)
+    fig_slice.subplots_adjust(top = .945, bottom = .06, hspace = .2)
+
+    colorbar = fig_slice.get_children()[-1]
+    cb_pos = colorbar.get_position()
+    cb_pos.y1 = 0.9405
+    cb_pos.y0 = 0.347
+    cb_pos.x0 = .915
+    cb_pos.x1 = .935
+    colorbar.set_position(cb_pos)
+    ax = fig_slice.axes[0]
+    im = ax.get_images()
+    im[0].set_clim(.4, 1)
+
+    img_time = st_proc[0].stats.starttime
+    tmstr = UTCDateTime.strftime(img_time, '%Y%m%d_%H%M')
+    img_dir = image_dir(volc_name, img_time)
+    os.makedirs(img_dir, exist_ok = True)
+
+    rcParams.update({'font.size': 10})
+
+    combined_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_combined.png')
+
+    c1 = fig_slice.canvas
+    c2 = fig_st.canvas
+
+    c1.draw()
+    c2.draw()
+
+    a1 = numpy.asarray(c1.buffer_rgba())
+    a2 = numpy.asarray(c2.buffer_rgba())
+
+    a = numpy.vstack((a1, a2))
+    save_combined(a, combined_file)
+    plt.close('all')
+
+    open_catalog().add(combined_file)
+
+    # wfs_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_wfs.png')
+    # slice_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_slice.png')
+    # # recsec_file = os.path.join(img_dir, f'{volc_name}_{tmstr}_recsec.png')
+
+    # fig_st.savefig(wfs_file, dpi=200,
+    # bbox_inches='tight', pad_inches=0.04)
+
+    # # fig_slice.set_size_inches(5,5)
+    # fig_slice.savefig(slice_file, dpi=200,
+    # bbox_inches='tight', pad_inches=0.04)
+
+    # fig_rec.savefig(recsec_file, dpi=200,
+    # bbox_inches='tight', pad_inches=0.1)
+
+    return combined_file
+
+
+class RenderQueue:
+    def __init__(self, path = None, attempts = None, retry_delay = None):
+        self.path = path or spool_dir()
+        self.attempts = attempts or getattr(config, 'RENDER_ATTEMPTS', 3)
+        self.retry_delay = retry_delay or getattr(config, 'RENDER_RETRY_DELAY', 60)  # [s]
+        for state in (PENDING, ACTIVE, FAILED):
+            os.makedirs(os.path.join(self.path, state), exist_ok = True)
+
+    def _dir(self, state, job = ''):
+        return os.path.join(self.path, state, job)
+
+    def submit(self, volc_name, volc_info, grid: CachedGrid, st, st_proc, S):
+        """Save everything needed to render a window, and queue it. Returns the job name."""
+        tmstr = UTCDateTime.strftime(st_proc[0].stats.starttime, '%Y%m%d_%H%M')
+        job = f"{time.time_ns()}_{volc_name}_{tmstr}"
+
+        # Write to a temp directory and rename into place, so a renderer never
+        # sees a partially written job.
+        tmp_dir = tempfile.mkdtemp(dir = self.path, prefix = '.tmp-')
+        try:
+            with open(os.path.join(tmp_dir, 'streams.pkl'), 'wb') as f:
+                pickle.dump((st, st_proc), f)
+            # The full stack can be gigabytes, which only the time slices are plotted from
+            save_array(os.path.join(tmp_dir, 'stack'), render_stack(S))
+
+            meta = {
+                'volc_name': volc_name,
+                'volc_info': volc_info,
+                # The DEM is loaded from the grid cache (and rebuilt if needed)
+                'dem': (grid.volc_name, grid.params, grid.external_file),
+                'attempts': 0,
+                'retry_after': 0,
+                'error': None,
+            }
+            self._write_meta(tmp_dir, meta)
+            os.rename(tmp_dir, self._dir(PENDING, job))
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+            raise
+
+        return job
+
+    def _read_meta(self, job_dir):
+        with open(os.path.join(job_dir, 'meta.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def _write_meta(self, job_dir, meta):
+        tmp_file = os.path.join(job_dir, '.meta.pkl.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(meta, f)
+        os.replace(tmp_file, os.path.join(job_dir, 'meta.pkl'))
+
+    def claim(self):
+        """Move the oldest job that is ready to run to active. Returns its name, or None."""
+        now = time.time()
+        for job in sorted(os.listdir(self._dir(PENDING))):
+            try:
+                if self._read_meta(self._dir(PENDING, job))['retry_after'] > now:
+                    continue
+                # Atomic, so only one renderer gets each job
+                os.rename(self._dir(PENDING, job), self._dir(ACTIVE, job))
+            except OSError:
+                continue
+            return job
+
+        return None
+
+    def complete(self, job):
+        shutil.rmtree(self._dir(ACTIVE, job), ignore_errors = True)
+
+    def fail(self, job, error):
+        job_dir = self._dir(ACTIVE, job)
+        meta = self._read_meta(job_dir)
+        meta['attempts'] += 1
+        meta['error'] = error
+        meta['retry_after'] = time.time() + self.retry_delay * meta['attempts']
+        self._write_meta(job_dir, meta)
+
+        state = PENDING if meta['attempts'] < self.attempts else FAILED
+        os.rename(job_dir, self._dir(state, job))
+        return state
+
+    def requeue_active(self):
+        """Put jobs left active by a renderer that was killed back in the queue"""
+        for job in os.listdir(self._dir(ACTIVE)):
+            os.rename(self._dir(ACTIVE, job), self._dir(PENDING, job))
+
+    def counts(self):
+        return {state: len(os.listdir(self._dir(state))) for state in (PENDING, ACTIVE, FAILED)}
+
+
+def render_job(job_dir):
+    """Render a job written by RenderQueue.submit. Returns the image file."""
+    with open(os.path.join(job_dir, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    with open(os.path.join(job_dir, 'streams.pkl'), 'rb') as f:
+        st, st_proc = pickle.load(f)
+
+    S = load_array(os.path.join(job_dir, 'stack'))
+    volc_name, params, external_file = meta['dem']
+    dem = CachedGrid(volc_name, **params, external_file = external_file).dem
+
+    return render_images(meta['volc_name'], meta['volc_info'], st, st_proc, S, dem)
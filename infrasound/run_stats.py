@@ -0,0 +1,194 @@
+"""
+Per-stage timing and resource use for each run of the pipeline.
+
+A RunStats is created for every gen_volc_image (one window) or
+gen_volc_range (a span of windows) call, and each stage of the run is
+timed with it:
+
+    grids        Loading (or building) the grids
+    waveforms    Fetching the waveforms
+    process      Removing the response and processing the waveforms
+    grid_search  Stacking (summed over windows for a range)
+    peaks        Peak picking
+    db           Writing the detections
+    render       Rendering, or queueing the render
+
+For each stage the wall and CPU time are recorded, along with the resident
+memory at its end and the run's peak resident memory up to then. On Linux
+the kernel's peak is reset when the run starts, so a worker or daemon that
+handled a bigger run earlier doesn't report that run's peak again. When
+the run finishes (or fails, or is stopped by the runner) the record is
+printed as a single "run_stats {...}" JSON line and saved to the run_stats
+table, which the web interface serves at /metrics and /getRunStats. Records
+older than RUN_STATS_DAYS are deleted as new ones are saved.
+"""
+import json
+import os
+import platform
+import resource
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from web import config
+
+OK = 'ok'
+FAILED = 'failed'
+STOPPED = 'stopped'
+
+
+class Stopped(BaseException):
+    """Raised in a run stopped by the runner, so it can record its stats on the way out"""
+
+
+def rss_mb():
+    """Current resident memory, in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def max_rss_mb():
+    """Peak resident memory of this process so far, in MB"""
+    # KB on Linux, bytes on macOS
+    scale = 2 ** 20 if platform.system() == 'Darwin' else 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory read by peak_rss_mb. Returns False if the kernel doesn't support it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident memory since reset_peak_rss, in MB, or None if not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class RunStats:
+    def __init__(self, volc_name, window_end, window_len, kind = 'window'):
+        self.volc_name = volc_name
+        self.window_end = window_end  # UTCDateTime
+        self.window_len = float(window_len)  # [s]
+        self.kind = kind  # 'window' or 'range'
+        self.started = datetime.now(timezone.utc)
+        self.status = None
+        self.error = None
+        self.stages = {}
+        # Filled in by the pipeline
+        self.info = {'stations': None, 'grid_nodes': None, 'samples': None,
+                     'windows': 0, 'detections': 0}
+
+        # Without a reset, the process's peak is only this run's if it rose during the run
+        self._peak_reset = reset_peak_rss()
+        self._max_rss_start = max_rss_mb()
+
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._wall = None
+        self._cpu = None
+
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'count': 0})
+            stage['wall'] += time.perf_counter() - wall_start
+            stage['cpu'] += time.process_time() - cpu_start
+            stage['count'] += 1
+            stage['rss_mb'] = rss_mb()
+            stage['max_rss_mb'] = self.max_rss_mb()
+
+    def max_rss_mb(self):
+        """
+        Peak resident memory of this run so far, in MB. Where the peak can't
+        be reset, a run that stayed below an earlier run's peak gets the
+        highest resident memory seen at the end of its stages instead.
+        """
+        if self._peak_reset:
+            peak = peak_rss_mb()
+            if peak is not None:
+                return peak
+
+        peak = max_rss_mb()
+        if peak > self._max_rss_start:
+            return peak
+
+        return max([stage['rss_mb'] for stage in self.stages.values() if stage.get('rss_mb')]
+                   + [rss_mb() or 0])
+
+    def finish(self, status, error = None):
+        self.status = status
+        self.error = error
+        self._wall = time.perf_counter() - self._wall_start
+        self._cpu = time.process_time() - self._cpu_start
+
+    def record(self):
+        return {
+            'volc': self.volc_name,
+            'kind': self.kind,
+            'window_end': self.window_end.datetime.replace(tzinfo = timezone.utc).isoformat(),
+            'window_len': self.window_len,
+            'started': self.started.isoformat(),
+            'status': self.status,
+            'error': self.error,
+            'wall': self._wall,
+            'cpu': self._cpu,
+            'max_rss_mb': self.max_rss_mb(),
+            **self.info,
+            'stages': self.stages,
+            'host': platform.node(),
+            'pid': os.getpid(),
+        }
+
+    def save(self):
+        """
+        Log the record, and save it to run_stats if RUN_STATS is set, pruning
+        records older than RUN_STATS_DAYS. Never raises.
+        """
+        record = self.record()
+        print("run_stats", json.dumps(record, default = str), flush = True)
+
+        if not getattr(config, 'RUN_STATS', True):
+            return
+
+        try:
+            from infrasound import db
+
+            with db.connection() as conn:
+                db.ensure_schema(conn)
+                conn.execute(
+                    """INSERT INTO run_stats (volc, kind, window_end, window_len, started,
+                        status, error, wall, cpu, max_rss_mb, stations, grid_nodes, samples,
+                        windows, detections, stages, host)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                    (record['volc'], record['kind'], record['window_end'], record['window_len'],
+                     record['started'], record['status'], record['error'], record['wall'],
+                     record['cpu'], record['max_rss_mb'], record['stations'],
+                     record['grid_nodes'], record['samples'], record['windows'],
+                     record['detections'], json.dumps(record['stages']), record['host'])
+                )
+                conn.execute("DELETE FROM run_stats WHERE started < now() - make_interval(days => %s)",
+                             (getattr(config, 'RUN_STATS_DAYS', 30), ))
+                conn.commit()
+        except Exception as e:
+            print("Unable to save run stats:", repr(e))
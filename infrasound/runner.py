@@ -0,0 +1,91 @@
+"""
+Run gen_volc_image for several volcanoes in parallel, each in its own process.
+
+Every volcano gets a separate process with a wall-clock timeout, so a crash
+or hang in one volcano can't block or kill the others.
+"""
+import multiprocessing
+import signal
+import sys
+import time
+import traceback
+
+from infrasound.run_stats import Stopped
+
+FINISHED = 'finished'
+FAILED = 'failed'
+TIMED_OUT = 'timed out'
+
+
+def _stopped(signum, frame):
+    raise Stopped(f"Stopped by signal {signum}")
+
+
+def _run_one(generator, volc_name, volc_info, kwargs):
+    # Lets the run record its stats when it is stopped for taking too long
+    signal.signal(signal.SIGTERM, _stopped)
+    try:
+        generator.gen_volc_image(volc_name, volc_info, **kwargs)
+    except Exception:
+        print(f"Error processing {volc_name}:", file = sys.stderr)
+        traceback.print_exc()
+        sys.exit(1)
+
+
+def _stop(proc):
+    proc.terminate()
+    proc.join(5)
+    if proc.is_alive():
+        proc.kill()
+        proc.join()
+
+
+def run_volcanoes(generator, volcs: dict, workers = 1, timeout = None, **kwargs):
+    """
+    Run generator.gen_volc_image for each volcano in volcs, with at most
+    workers running at once. Any volcano still running after timeout seconds
+    is killed. Returns a list of (volc_name, status, elapsed seconds).
+    """
+    ctx = multiprocessing.get_context('fork')
+    pending = list(volcs.items())
+    running = {}
+    results = []
+
+    while pending or running:
+        while pending and len(running) < workers:
+            volc_name, volc_info = pending.pop(0)
+            proc = ctx.Process(target = _run_one, name = volc_name,
+                               args = (generator, volc_name, volc_info, kwargs))
+            proc.start()
+            running[volc_name] = (proc, time.monotonic())
+
+        time.sleep(0.25)
+
+        for volc_name, (proc, started) in list(running.items()):
+            elapsed = time.monotonic() - started
+            if proc.is_alive():
+                if timeout is None or elapsed < timeout:
+                    continue
+
+                _stop(proc)
+                status = TIMED_OUT
+            else:
+                proc.join()
+                status = FINISHED if proc.exitcode == 0 else FAILED
+
+            del running[volc_name]
+            results.append((volc_name, status, elapsed))
+
+    return results
+
+
+def print_summary(results):
+    print("****************RUN SUMMARY**************")
+    for volc_name, status, elapsed in results:
+        print(f"{volc_name:<20} {status:<10} {elapsed:8.1f}s")
+
+    counts = {status: 0 for status in (FINISHED, FAILED, TIMED_OUT)}
+    for _, status, _ in results:
+        counts[status] += 1
+
+    print(", ".join(f"{count} {status}" for status, count in counts.items()))
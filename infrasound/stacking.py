@@ -0,0 +1,223 @@
+"""
+Delay-and-stack grid search using precomputed travel time tables.
+
+This is equivalent to rtm's grid_search for the 'sum' and 'product' stack
+methods, but takes the travel times as an argument rather than computing them,
+and shifts all grid nodes for a station at once rather than looping over nodes.
+
+The time axis is stacked in chunks sized to fit within STACK_MEMORY_MB, and
+the result is kept on disk (memory-mapped) rather than in memory if it would
+take up more than half of that. With STACK_FLOAT32 the stack is computed and
+stored in single precision, halving memory use again.
+"""
+import os
+import tempfile
+
+import numpy
+
+from numpy.lib.stride_tricks import sliding_window_view
+from obspy import UTCDateTime
+
+from web import config
+
+# Stack methods supported here. Anything else goes through rtm's grid_search.
+STACK_METHODS = ('sum', 'product')
+
+
+def stack_memory_budget():
+    return int(getattr(config, 'STACK_MEMORY_MB', 512) * 2 ** 20)
+
+
+def stack_dtype():
+    return numpy.float32 if getattr(config, 'STACK_FLOAT32', False) else numpy.float64
+
+
+def time_axis(starttime, endtime, sampling_rate):
+    npts = int(round((endtime - starttime) * sampling_rate)) + 1
+    offsets = numpy.round(numpy.arange(npts) * 1e9 / sampling_rate).astype('int64')
+    return (starttime.ns + offsets).astype('datetime64[ns]')
+
+
+def station_shifts(tr, travel_times, starttime):
+    """
+    The index into tr.data of the first output sample for each grid node,
+    i.e. the travel time plus the offset between the trace start and starttime
+    """
+    sampling_rate = tr.stats.sampling_rate
+    offset = (starttime - tr.stats.starttime) + travel_times.ravel()
+    return numpy.round(offset * sampling_rate).astype('int64')
+
+
+def pad_trace(data, shifts, npts, dtype = None):
+    """
+    Zero-pad data so that every window of npts samples starting at shifts is
+    inside the result, converted to dtype (default data's). Returns the padded
+    data and the index of data[0] in it, negated.
+    """
+    lo = min(0, int(shifts.min()))
+    hi = max(data.size, int(shifts.max()) + npts)
+    padded = numpy.zeros(hi - lo, dtype = dtype or data.dtype)
+    padded[-lo:data.size - lo] = data
+    return padded, lo
+
+
+def allocate_cube(shape, dtype, budget = None):
+    """
+    An uninitialized array of shape. Kept in memory if it takes up no more
+    than half of budget, otherwise backed by an (already deleted) temp file.
+    """
+    budget = budget or stack_memory_budget()
+    nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    if nbytes <= budget // 2:
+        return numpy.empty(shape, dtype = dtype)
+
+    tmp_dir = os.path.join(getattr(config, 'CACHE_DIR', '/tmp/infrasound_cache'), 'tmp')
+    os.makedirs(tmp_dir, exist_ok = True)
+    with tempfile.TemporaryFile(dir = tmp_dir) as f:
+        # The mapping stays valid after the file is closed
+        return numpy.memmap(f, dtype = dtype, mode = 'w+', shape = shape)
+
+
+def chunk_length(nnodes, dtype, budget = None):
+    """Time samples per chunk so the working arrays take half of budget"""
+    budget = budget or stack_memory_budget()
+    per_sample = 2 * nnodes * numpy.dtype(dtype).itemsize  # Accumulator + one station
+    return max(1, (budget // 2) // per_sample)
+
+
+def stack_nodes(processed_st, travel_times, starttime, npts, stack_method = 'sum',
+                scale = 1, dtype = None, budget = None):
+    """
+    Shift and stack processed_st for each of a set of grid nodes.
+
+    travel_times is a (station, node) array of travel times in seconds, in
+    the same order as processed_st. The stack is multiplied by scale. Returns
+    a (time, node) array.
+    """
+    dtype = dtype or stack_dtype()
+    nnodes = travel_times.shape[1]
+    stack = allocate_cube((npts, nnodes), dtype, budget)
+
+    stations = []
+    for tr, tr_times in zip(processed_st, travel_times):
+        shifts = station_shifts(tr, numpy.asarray(tr_times), starttime)
+        # Converted as it is copied in, rather than in a separate copy first
+        padded, lo = pad_trace(tr.data, shifts, npts, dtype)
+        stations.append((padded, shifts - lo))
+
+    chunk = chunk_length(nnodes, dtype, budget)
+    for t0 in range(0, npts, chunk):
+        n = min(chunk, npts - t0)
+        acc = None
+        for padded, starts in stations:
+            # The window of length n for each node. sliding_window_view is a
+            # view of padded, but picking the nodes' windows copies them, so
+            # the first station's copy can be accumulated into in place.
+            windows = sliding_window_view(padded, n)[starts + t0]
+            if acc is None:
+                acc = windows
+            elif stack_method == 'sum':
+                acc += windows
+            else:
+                acc *= windows
+
+        if scale != 1:
+            acc *= scale
+
+        stack[t0:t0 + n] = acc.T
+
+    return stack
+
+
+def stack_dataarray(stack, grid, times, stack_method, time_method = None, celerity = None):
+    """Wrap a (time, node) stack over grid as a (time, y, x) DataArray"""
+    import xarray
+
+    stack = stack.reshape(times.size, grid.y.size, grid.x.size)
+
+    S = xarray.DataArray(stack, coords = [('time', times), ('y', grid.y.values),
+                                          ('x', grid.x.values)],
+                         attrs = dict(grid.attrs))
+    S.attrs['time_method'] = time_method
+    S.attrs['stack_method'] = stack_method
+    if celerity is not None:
+        S.attrs['celerity'] = celerity
+
+    return S
+
+
+def stack_grid(processed_st, grid, travel_times, starttime, endtime,
+               stack_method = 'sum', time_method = None, celerity = None,
+               scale = 1, dtype = None, budget = None):
+    """
+    Shift and stack processed_st for each node of grid.
+
+    travel_times is an array of (station, y, x) travel times in seconds, in
+    the same order as processed_st. Returns an (time, y, x) DataArray like the
+    one returned by rtm's grid_search, multiplied by scale.
+    """
+    if stack_method not in STACK_METHODS:
+        raise ValueError(f"Unsupported stack method: {stack_method}")
+
+    sampling_rate = processed_st[0].stats.sampling_rate
+    times = time_axis(starttime, endtime, sampling_rate)
+
+    travel_times = numpy.asarray(travel_times)
+    travel_times = travel_times.reshape(travel_times.shape[0], -1)
+    stack = stack_nodes(processed_st, travel_times, starttime, times.size, stack_method,
+                        scale, dtype, budget)
+
+    return stack_dataarray(stack, grid, times, stack_method, time_method, celerity)
+
+
+def peak_trace(stack, budget = None):
+    """
+    The maximum over all nodes of a (time, ...) stack at each time, and the
+    (flattened) index of the node it is at, reading the stack a chunk at a time.
+    """
+    npts = stack.shape[0]
+    stack = stack.reshape(npts, -1)
+    values = numpy.empty(npts, dtype = stack.dtype)
+    nodes = numpy.empty(npts, dtype = 'int64')
+
+    chunk = chunk_length(stack.shape[1], stack.dtype, budget)
+    for t0 in range(0, npts, chunk):
+        block = numpy.asarray(stack[t0:t0 + chunk])
+        nodes[t0:t0 + chunk] = block.argmax(axis = 1)
+        values[t0:t0 + chunk] = block[numpy.arange(block.shape[0]), nodes[t0:t0 + chunk]]
+
+    return values, nodes
+
+
+def peak_coordinates(S, height = None, min_time = None, prominence = None, unproject = False):
+    """
+    Equivalent of rtm's get_peak_coordinates(S, global_max=False, ...), but
+    finds the maximum at each time a chunk at a time rather than making
+    copies of the whole stack. Returns time_max, y_max, x_max, peaks, props.
+    """
+    from scipy.signal import find_peaks
+
+    values, nodes = peak_trace(S.data)
+
+    distance = None
+    if min_time:
+        time_step = (S.time.data[1] - S.time.data[0]).astype('int64') / 1e9
+        distance = max(min_time / time_step, 1)
+
+    peaks, props = find_peaks(values, height = height, distance = distance,
+                              prominence = prominence)
+
+    y_idx, x_idx = numpy.unravel_index(nodes[peaks], (S.y.size, S.x.size))
+    time_max = [UTCDateTime(str(S.time.values[peak])) for peak in peaks]
+    y_max = S.y.values[y_idx].tolist()
+    x_max = S.x.values[x_idx].tolist()
+
+    if unproject:
+        import utm
+
+        latlon = [utm.to_latlon(x, y, S.UTM['zone'], northern = not S.UTM['southern_hemisphere'])
+                  for y, x in zip(y_max, x_max)]
+        y_max = [lat for lat, _ in latlon]
+        x_max = [lon for _, lon in latlon]
+
+    return time_max, y_max, x_max, peaks, props
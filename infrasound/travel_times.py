@@ -0,0 +1,148 @@
+"""
+Precomputed station-to-grid travel time tables.
+
+Travel times only depend on the grid, the station location and the travel time
+method/parameters, so each station's table is computed once, saved as a .npy
+file and memory-mapped on later runs. Tables are stored per station, so adding
+or removing a station only requires computing the tables for that station.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+
+from infrasound.grid_cache import CachedGrid
+from web import config
+
+# Bump this if the on-disk layout changes to invalidate existing tables
+CACHE_VERSION = 1
+
+# Tables already loaded by this process, keyed by file name
+_loaded = {}
+
+
+def cache_dir():
+    return os.path.join(getattr(config, 'CACHE_DIR', '/tmp/infrasound_cache'), 'travel_times')
+
+
+def _kwarg_digest(value):
+    # Arrays (such as the DEM) are identified by a hash of their contents
+    if hasattr(value, 'values') and hasattr(value, 'dims'):
+        value = value.values
+    if isinstance(value, numpy.ndarray):
+        return hashlib.sha1(numpy.ascontiguousarray(value).tobytes()).hexdigest()
+    return value
+
+
+def attach_utm(st, grid):
+    """Add UTM coordinates to each trace, as rtm does when calculating travel times"""
+    utm_info = grid.attrs.get('UTM')
+    if not utm_info:
+        return
+
+    import utm
+
+    for tr in st:
+        utm_x, utm_y, _, _ = utm.from_latlon(tr.stats.latitude, tr.stats.longitude,
+                                             force_zone_number=utm_info['zone'])
+        tr.stats.utm_x = utm_x
+        tr.stats.utm_y = utm_y
+        tr.stats.utm_zone = utm_info['zone']
+
+
+class TravelTimeStore:
+    def __init__(self, volc_name, search: CachedGrid, time_method, **time_kwargs):
+        self.volc_name = volc_name
+        self.search = search
+        self.time_method = time_method
+        self.time_kwargs = time_kwargs
+        self.path = os.path.join(cache_dir(), volc_name, search.key)
+
+        params = {name: _kwarg_digest(value) for name, value in time_kwargs.items()}
+        self._base_params = {
+            'version': CACHE_VERSION,
+            'grid': search.key,
+            'time_method': time_method,
+            'time_kwargs': params,
+        }
+
+    def station_key(self, tr):
+        params = dict(self._base_params,
+                      id = tr.id,
+                      latitude = float(tr.stats.latitude),
+                      longitude = float(tr.stats.longitude),
+                      elevation = float(tr.stats.get('elevation', 0)))
+        blob = json.dumps(params, sort_keys = True, default = str).encode()
+        return hashlib.sha1(blob).hexdigest()[:16]
+
+    def _station_file(self, tr):
+        return os.path.join(self.path, f"{tr.id}-{self.station_key(tr)}.npy")
+
+    def get(self, st):
+        """
+        Return the travel times for each trace in st as an array with
+        dimensions (station, y, x), in the same order as st.
+        """
+        grid = self.search.grid
+        attach_utm(st, grid)
+
+        files = [self._station_file(tr) for tr in st]
+        missing = [tr for tr, file in zip(st, files) if not os.path.isfile(file)]
+        if missing:
+            self._build(st.__class__(traces = missing))
+
+        return numpy.stack([self._load(file) for file in files])
+
+    def _load(self, file):
+        try:
+            return _loaded[file]
+        except KeyError:
+            pass
+
+        table = numpy.load(file, mmap_mode = 'r')
+        _loaded[file] = table
+        return table
+
+    def _build(self, st):
+        from rtm.travel_time import celerity_travel_time, fdtd_travel_time
+
+        print(f"Computing {self.time_method} travel times for {self.volc_name}:",
+              ', '.join(tr.id for tr in st))
+
+        grid = self.search.grid
+        if self.time_method == 'celerity':
+            travel_times = celerity_travel_time(grid, st, **self.time_kwargs)
+        elif self.time_method == 'fdtd':
+            travel_times = fdtd_travel_time(grid, st, **self.time_kwargs)
+        else:
+            raise ValueError(f"Unknown time method: {self.time_method}")
+
+        os.makedirs(self.path, exist_ok = True)
+        for tr, times in zip(st, travel_times.values):
+            file = self._station_file(tr)
+            self._remove_stale(tr.id)
+
+            tmp_file = f"{file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                numpy.save(f, numpy.asarray(times))
+            os.replace(tmp_file, file)
+
+    def _remove_stale(self, tr_id):
+        # Tables for an older location/configuration of this station
+        for entry in os.listdir(self.path):
+            if entry.startswith(f"{tr_id}-") and entry.endswith('.npy'):
+                os.remove(os.path.join(self.path, entry))
+
+    def prune(self):
+        """Remove tables for grids this volcano no longer uses"""
+        volc_dir = os.path.dirname(self.path)
+        try:
+            entries = os.listdir(volc_dir)
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry != self.search.key:
+                shutil.rmtree(os.path.join(volc_dir, entry), ignore_errors = True)
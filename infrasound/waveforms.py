@@ -0,0 +1,349 @@
+"""
+Waveform acquisition with a local rolling miniSEED cache.
+
+All stations needed for a run are fetched with a single gather_waveforms
+request, written to the cache as one miniSEED "chunk" file, and each volcano's
+Stream is then sliced out of the cache. Later requests only fetch the parts of
+the requested window that have not already been downloaded, so consecutive
+runs just fetch the new tail of data, and backfills of already downloaded
+windows don't touch the network at all.
+"""
+import fcntl
+import json
+import os
+import pickle
+
+from contextlib import contextmanager
+
+from obspy import Stream, UTCDateTime, read
+
+from web import config
+
+
+def gather_remote_waveforms(**kwargs):
+    try:
+        from waveform_collection.waveform_collection import gather_waveforms
+    except ImportError:
+        from waveform_collection import gather_waveforms
+
+    return gather_waveforms(**kwargs)
+
+
+def gather_waveforms(source, **kwargs):
+    """gather_waveforms, with source 'SDS' reading from the local archive"""
+    if source == 'SDS':
+        from infrasound.archive import gather_sds_waveforms
+        return gather_sds_waveforms(**kwargs)
+
+    return gather_remote_waveforms(source=source, **kwargs)
+
+
+def _subtract(start, end, covered):
+    """Return the parts of (start, end) not in any of the covered intervals"""
+    gaps = []
+    for c_start, c_end in sorted(covered):
+        if c_end <= start:
+            continue
+        if c_start >= end:
+            break
+        if c_start > start:
+            gaps.append((start, c_start))
+        start = max(start, c_end)
+        if start >= end:
+            break
+
+    if start < end:
+        gaps.append((start, end))
+
+    return gaps
+
+
+class WaveformCache:
+    # Stats copied from the fetched traces and re-attached when reading from the cache
+    METADATA = ('latitude', 'longitude', 'elevation', 'response')
+
+    def __init__(self, path = None, retention = None, settle = None):
+        cache_root = getattr(config, 'CACHE_DIR', '/tmp/infrasound_cache')
+        self.path = path or os.path.join(cache_root, 'waveforms')
+
+        # How long to keep downloaded data, in days after it was downloaded
+        self.retention = retention or getattr(config, 'WAVEFORM_CACHE_DAYS', 2)
+
+        # Data newer than this many seconds may still be arriving at the data
+        # center, so a later run fetches it again rather than considering it
+        # complete.
+        if settle is None:
+            settle = getattr(config, 'WAVEFORM_CACHE_SETTLE', 300)
+        self.settle = settle
+
+        # Chunks fetched by this instance, which is created for each run (and
+        # inherited by the processes it forks). The run uses these in full,
+        # unsettled tail included, rather than fetching the tail again for
+        # every volcano.
+        self._run_files = set()
+
+    @property
+    def _index_file(self):
+        return os.path.join(self.path, 'index.json')
+
+    @property
+    def _metadata_file(self):
+        return os.path.join(self.path, 'metadata.pkl')
+
+    @contextmanager
+    def _lock(self):
+        os.makedirs(self.path, exist_ok = True)
+        with open(os.path.join(self.path, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self._index_file) as f:
+                return json.load(f)['chunks']
+        except FileNotFoundError:
+            return []
+
+    def _write_index(self, chunks):
+        tmp_file = f"{self._index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({'chunks': chunks}, f)
+        os.replace(tmp_file, self._index_file)
+
+    def _read_metadata(self):
+        try:
+            with open(self._metadata_file, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_metadata(self, metadata):
+        tmp_file = f"{self._metadata_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(metadata, f)
+        os.replace(tmp_file, self._metadata_file)
+
+    def missing(self, stations, starttime, endtime, chunks = None):
+        """
+        Return a list of (start, end, stations) for the parts of the window
+        not yet in the cache, merged so each interval is a single request.
+        """
+        if chunks is None:
+            chunks = self._read_index()
+
+        start, end = starttime.ns, endtime.ns
+        requests = []
+        for station in stations:
+            covered = [(c['start'], c['end'] if c['file'] in self._run_files else c['covered'])
+                       for c in chunks if station in c['stations']]
+            for gap in _subtract(start, end, covered):
+                requests.append((gap, station))
+
+        if not requests:
+            return []
+
+        # Fetch from the earliest gap to the end of the latest gap for every
+        # station with a gap, as a single request.
+        gap_start = min(gap[0] for gap, _ in requests)
+        gap_end = max(gap[1] for gap, _ in requests)
+        gap_stations = sorted({station for _, station in requests})
+        return [(UTCDateTime(ns = gap_start), UTCDateTime(ns = gap_end), gap_stations)]
+
+    def fetch(self, stations, starttime, endtime):
+        """Download anything in the window not already in the cache"""
+        with self._lock():
+            chunks = self._read_index()
+            for gap_start, gap_end, gap_stations in self.missing(stations, starttime, endtime, chunks):
+                print(f"Fetching {', '.join(gap_stations)} from {gap_start} to {gap_end}")
+                try:
+                    st = gather_waveforms(source=config.SOURCE, network=config.NETWORK,
+                                          station=','.join(gap_stations),
+                                          location=config.LOCATION, channel=config.CHANNEL,
+                                          starttime=gap_start, endtime=gap_end,
+                                          merge_fill_value=None, trim_fill_value=None)
+                except Exception as e:
+                    print("Unable to fetch waveforms:", e)
+                    continue
+
+                chunk = self._add_chunk(st, gap_start, gap_end)
+                chunks.append(chunk)
+                self._run_files.add(chunk['file'])
+
+            chunks = self._prune(chunks)
+            self._write_index(chunks)
+
+    def _add_chunk(self, st, starttime, endtime):
+        filename = f"{starttime.ns}_{endtime.ns}.mseed"
+
+        metadata = self._read_metadata()
+        for tr in st:
+            metadata[tr.id] = {key: tr.stats[key] for key in self.METADATA if key in tr.stats}
+        self._write_metadata(metadata)
+
+        # Only keep actual data in the cache. Gaps are filled when reading.
+        st = st.split()
+        if len(st) > 0:
+            tmp_file = os.path.join(self.path, f".{filename}.tmp")
+            st.write(tmp_file, format = 'MSEED')
+            os.replace(tmp_file, os.path.join(self.path, filename))
+
+        # Anything too recent may still be incomplete, so is not marked as
+        # covered, and will be requested again by the next run.
+        covered = min(endtime, UTCDateTime.now() - self.settle)
+
+        return {
+            'file': filename,
+            'start': starttime.ns,
+            'end': endtime.ns,
+            'covered': max(covered, starttime).ns,
+            'fetched': UTCDateTime.now().ns,
+            # Stations that returned no data will be requested again next time
+            'stations': sorted({tr.stats.station for tr in st}),
+        }
+
+    def _prune(self, chunks):
+        cutoff = (UTCDateTime.now() - self.retention * 86400).ns
+        keep = []
+        for chunk in chunks:
+            # Expire by download time rather than data time, so backfilled
+            # data is kept around as long as recent data.
+            if chunk.get('fetched', chunk['end']) >= cutoff:
+                keep.append(chunk)
+                continue
+
+            try:
+                os.remove(os.path.join(self.path, chunk['file']))
+            except FileNotFoundError:
+                pass
+
+        return keep
+
+    def get_stream(self, stations, starttime, endtime):
+        """
+        Return a Stream for stations (a comma separated string, as in
+        config.VOLCS) covering the window, fetching anything missing first.
+        The result is merged and padded the same way as gather_waveforms.
+        """
+        if isinstance(stations, str):
+            stations = stations.split(',')
+
+        self.fetch(stations, starttime, endtime)
+
+        chunks = sorted(self._read_index(), key = lambda c: c['start'])
+        metadata = self._read_metadata()
+
+        st = Stream()
+        for station in stations:
+            station_chunks = [c for c in chunks if station in c['stations']
+                              and c['start'] < endtime.ns and c['end'] > starttime.ns]
+            for idx, chunk in enumerate(station_chunks):
+                # Newer data for the uncovered tail of a chunk supersedes it
+                chunk_end = chunk['end']
+                if idx + 1 < len(station_chunks):
+                    chunk_end = min(chunk_end, station_chunks[idx + 1]['start'])
+
+                chunk_start = UTCDateTime(ns = chunk['start'])
+                chunk_end = UTCDateTime(ns = chunk_end)
+                try:
+                    chunk_st = read(os.path.join(self.path, chunk['file']), format = 'MSEED',
+                                    starttime = max(starttime, chunk_start),
+                                    endtime = min(endtime, chunk_end))
+                except FileNotFoundError:
+                    continue
+
+                chunk_st = chunk_st.select(station = station)
+                chunk_st.trim(max(starttime, chunk_start), min(endtime, chunk_end),
+                              nearest_sample = False)
+                st += chunk_st
+
+        st.merge(fill_value = 0)
+        st.trim(starttime, endtime, pad = True, fill_value = 0)
+
+        for tr in st:
+            for key, value in metadata.get(tr.id, {}).items():
+                tr.stats[key] = value
+
+        st.sort()
+        return st
+
+
+class WaveformBuffer:
+    """
+    In-memory rolling buffer of recent waveforms for the long-running daemon.
+    Same interface as WaveformCache, but only the new tail of data is ever
+    fetched, and nothing is written to disk. The buffer outlives each run, so
+    start_run is called at the start of each window: data fetched since then
+    is used as is, and older data only up to where it had settled.
+    """
+
+    def __init__(self, length, settle = None):
+        # How much data to keep, in seconds
+        self.length = length
+
+        if settle is None:
+            settle = getattr(config, 'WAVEFORM_CACHE_SETTLE', 300)
+        self.settle = settle
+
+        self.data = {}  # station -> Stream
+        self.covered = {}  # station -> time up to which data is complete
+        self.fetched = {}  # station -> time up to which data was fetched this run
+
+    def start_run(self):
+        self.fetched = {}
+
+    def _available(self, sta, default):
+        return self.fetched.get(sta, self.covered.get(sta, default))
+
+    def fetch(self, stations, starttime, endtime):
+        need = [sta for sta in stations if self._available(sta, starttime) < endtime]
+        if not need:
+            return
+
+        fetch_start = min(max(starttime, self._available(sta, starttime)) for sta in need)
+        print(f"Fetching {', '.join(need)} from {fetch_start} to {endtime}")
+        try:
+            st = gather_waveforms(source=config.SOURCE, network=config.NETWORK,
+                                  station=','.join(need), location=config.LOCATION,
+                                  channel=config.CHANNEL, starttime=fetch_start,
+                                  endtime=endtime, merge_fill_value=None,
+                                  trim_fill_value=None)
+        except Exception as e:
+            print("Unable to fetch waveforms:", e)
+            return
+
+        st = st.split()
+        covered = max(fetch_start, min(endtime, UTCDateTime.now() - self.settle))
+        oldest = endtime - self.length
+        for sta in need:
+            sta_st = st.select(station = sta)
+            if len(sta_st) == 0:
+                continue
+
+            # Replace anything we already had after fetch_start with the new data
+            old_st = self.data.get(sta, Stream())
+            old_st.trim(endtime = fetch_start, nearest_sample = False)
+            sta_st = old_st + sta_st
+            sta_st.merge(method = -1)
+            sta_st.trim(starttime = oldest, nearest_sample = False)
+
+            self.data[sta] = sta_st
+            self.covered[sta] = covered
+            self.fetched[sta] = endtime
+
+    def get_stream(self, stations, starttime, endtime):
+        if isinstance(stations, str):
+            stations = stations.split(',')
+
+        self.fetch(stations, starttime, endtime)
+
+        st = Stream()
+        for sta in stations:
+            st += self.data.get(sta, Stream()).slice(starttime, endtime).copy()
+
+        st.merge(fill_value = 0)
+        st.trim(starttime, endtime, pad = True, fill_value = 0)
+        st.sort()
+        return st
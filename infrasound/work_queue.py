@@ -0,0 +1,247 @@
+"""
+Distributed work queue of (volcano, window) tasks.
+
+Tasks live in the location_jobs table of the PostgreSQL database already used
+for detections. Workers lease one task at a time using SELECT ... FOR UPDATE
+SKIP LOCKED, so any number of worker processes or hosts can pull from the
+same queue without blocking each other. Leases are extended by a heartbeat
+while the task runs, and tasks whose lease expires (because the worker died)
+are handed out again. Live windows have a higher priority than backfills.
+
+SQLite can be used as a local stand-in for development and testing. It has
+no SKIP LOCKED, so claims are serialized with BEGIN IMMEDIATE instead.
+"""
+import socket
+import os
+import threading
+import time
+
+from collections import namedtuple
+
+from infrasound import db
+from web import config
+
+# Priorities. Higher runs first.
+LIVE = 100
+BACKFILL = 0
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+Job = namedtuple('Job', ['id', 'volc', 'window_end', 'window_len', 'save_db', 'attempts'])
+
+SCHEMA = {
+    'postgres': [
+        """CREATE TABLE IF NOT EXISTS location_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            volc TEXT NOT NULL,
+            window_end DOUBLE PRECISION NOT NULL,  -- epoch seconds
+            window_len INTEGER NOT NULL DEFAULT 600,
+            priority INTEGER NOT NULL DEFAULT 0,
+            save_db BOOLEAN NOT NULL DEFAULT true,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            lease_owner TEXT,
+            lease_expires DOUBLE PRECISION,
+            error TEXT,
+            updated DOUBLE PRECISION,
+            UNIQUE (volc, window_end, window_len)
+        )""",
+        """CREATE INDEX IF NOT EXISTS location_jobs_claim_idx
+            ON location_jobs (priority DESC, window_end DESC)
+            WHERE status IN ('pending', 'leased')""",
+    ],
+    'sqlite': [
+        """CREATE TABLE IF NOT EXISTS location_jobs (
+            id INTEGER PRIMARY KEY,
+            volc TEXT NOT NULL,
+            window_end REAL NOT NULL,
+            window_len INTEGER NOT NULL DEFAULT 600,
+            priority INTEGER NOT NULL DEFAULT 0,
+            save_db BOOLEAN NOT NULL DEFAULT 1,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            lease_owner TEXT,
+            lease_expires REAL,
+            error TEXT,
+            updated REAL,
+            UNIQUE (volc, window_end, window_len)
+        )""",
+        """CREATE INDEX IF NOT EXISTS location_jobs_claim_idx
+            ON location_jobs (priority DESC, window_end DESC)""",
+    ],
+}
+
+
+def worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, connect = db.connection, dialect = 'postgres', lease = None):
+        # connect is a function returning a context manager yielding a DB-API
+        # connection, which closes it when the block exits
+        self.connect = connect
+        self.dialect = dialect
+        self.lease = lease or getattr(config, 'QUEUE_LEASE', 120)  # [s]
+
+    def _sql(self, sql):
+        if self.dialect == 'sqlite':
+            sql = sql.replace('%s', '?')
+        return sql
+
+    def ensure_schema(self):
+        with self.connect() as conn:
+            for statement in SCHEMA[self.dialect]:
+                conn.execute(statement)
+            conn.commit()
+
+    def enqueue(self, volc, window_ends, window_len = 600, priority = BACKFILL,
+                save_db = True, max_attempts = 3):
+        """
+        Add a task for each window end (UTCDateTime). Windows already queued
+        keep their status, but are bumped to the higher of the two priorities.
+        """
+        rows = [(volc, float(win_end.timestamp), window_len, priority, save_db, max_attempts, time.time())
+                for win_end in window_ends]
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.executemany(self._sql("""
+                INSERT INTO location_jobs
+                    (volc, window_end, window_len, priority, save_db, max_attempts, updated)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (volc, window_end, window_len) DO UPDATE
+                SET priority = CASE WHEN excluded.priority > location_jobs.priority
+                               THEN excluded.priority ELSE location_jobs.priority END
+            """), rows)
+            conn.commit()
+
+    def claim(self, owner):
+        """Lease the next task for owner. Returns a Job, or None if there is nothing to do."""
+        now = time.time()
+        skip_locked = 'FOR UPDATE SKIP LOCKED' if self.dialect == 'postgres' else ''
+        with self.connect() as conn:
+            if self.dialect == 'sqlite':
+                conn.isolation_level = None
+                conn.execute("BEGIN IMMEDIATE")
+
+            cur = conn.cursor()
+
+            # Tasks whose worker died on their last attempt
+            cur.execute(self._sql("""
+                UPDATE location_jobs SET status=%s, error='Lease expired', updated=%s
+                WHERE status=%s AND lease_expires < %s AND attempts >= max_attempts
+            """), (FAILED, now, LEASED, now))
+
+            cur.execute(self._sql(f"""
+                UPDATE location_jobs
+                SET status=%s, lease_owner=%s, lease_expires=%s, attempts=attempts+1, updated=%s
+                WHERE id = (
+                    SELECT id FROM location_jobs
+                    WHERE (status=%s OR (status=%s AND lease_expires < %s))
+                    AND attempts < max_attempts
+                    ORDER BY priority DESC, window_end DESC
+                    LIMIT 1
+                    {skip_locked}
+                )
+                RETURNING id, volc, window_end, window_len, save_db, attempts
+            """), (LEASED, owner, now + self.lease, now, PENDING, LEASED, now))
+            row = cur.fetchone()
+            conn.commit()
+
+        if row is None:
+            return None
+
+        return Job(row[0], row[1], row[2], row[3], bool(row[4]), row[5])
+
+    def heartbeat(self, job, owner):
+        """Extend the lease on job. Returns False if owner no longer holds it."""
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute(self._sql("""
+                UPDATE location_jobs SET lease_expires=%s, updated=%s
+                WHERE id=%s AND lease_owner=%s AND status=%s
+            """), (time.time() + self.lease, time.time(), job.id, owner, LEASED))
+            conn.commit()
+            return cur.rowcount > 0
+
+    def complete(self, job, owner):
+        self._finish(job, owner, DONE, None)
+
+    def fail(self, job, owner, error):
+        # Back in the queue if there are attempts left, otherwise failed for good
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute(self._sql("""
+                UPDATE location_jobs
+                SET status = CASE WHEN attempts < max_attempts THEN %s ELSE %s END,
+                    error=%s, lease_owner=NULL, lease_expires=NULL, updated=%s
+                WHERE id=%s AND lease_owner=%s
+            """), (PENDING, FAILED, error, time.time(), job.id, owner))
+            conn.commit()
+
+    def _finish(self, job, owner, status, error):
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute(self._sql("""
+                UPDATE location_jobs
+                SET status=%s, error=%s, lease_owner=NULL, lease_expires=NULL, updated=%s
+                WHERE id=%s AND lease_owner=%s
+            """), (status, error, time.time(), job.id, owner))
+            conn.commit()
+
+    def counts(self):
+        with self.connect() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT status, count(*) FROM location_jobs GROUP BY status")
+            return dict(cur.fetchall())
+
+
+class Heartbeat(threading.Thread):
+    """Keep extending the lease on a job while it runs, up to max_runtime seconds"""
+
+    def __init__(self, queue, job, owner, max_runtime = None):
+        super().__init__(daemon = True)
+        self.queue = queue
+        self.job = job
+        self.owner = owner
+        self.max_runtime = max_runtime
+        self.finished = threading.Event()
+
+    def run(self):
+        started = time.monotonic()
+        while not self.finished.wait(self.queue.lease / 3):
+            if self.max_runtime is not None and time.monotonic() - started > self.max_runtime:
+                # Stop extending the lease so another worker can pick the job up
+                print(f"Job {self.job.id} exceeded {self.max_runtime}s, releasing lease")
+                return
+            try:
+                if not self.queue.heartbeat(self.job, self.owner):
+                    print(f"Lost lease on job {self.job.id}")
+                    return
+            except Exception as e:
+                print(f"Heartbeat for job {self.job.id} failed:", e)
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+def open_queue(lease = None):
+    """
+    The queue configured in config: the PostgreSQL detections database, or a
+    SQLite file if QUEUE_DB is set (for running locally without Postgres).
+    """
+    path = getattr(config, 'QUEUE_DB', None)
+    if path:
+        queue = WorkQueue(lambda: db.sqlite_connection(path, timeout = 60), dialect = 'sqlite',
+                          lease = lease)
+    else:
+        queue = WorkQueue(lease = lease)
+
+    queue.ensure_schema()
+    return queue
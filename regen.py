@@ -1,42 +1,214 @@
-from generate_images import infrasound_location
+"""
+Resumable backfill runner.
+
+Every (volcano, window) to process is recorded in a SQLite ledger along with
+its status, so an interrupted backfill picks up where it left off, windows
+already done are skipped, and failures are retried a limited number of times.
+
+Example:
+    python regen.py --start 2023-02-12 --end 2023-02-13 --volc pavlof semi
+"""
+import argparse
+import os
+import sqlite3
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+
 from obspy import UTCDateTime
+
 from web import config
 
-from concurrent.futures import ProcessPoolExecutor
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def runRange(volc_name, RUN_START, RUN_END, WINDOW, SAVE_DB):
+    # Only the worker processes need the processing stack
+    from generate_images import infrasound_location
+
+    generator = infrasound_location(RUN_END, RUN_START)
+    return generator.gen_volc_range(volc_name, config.VOLCS[volc_name], RUN_START, RUN_END,
+                                    WINDOW, SAVE_DB)
+
+
+class Ledger:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                volc TEXT NOT NULL,
+                window_end INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL,
+                PRIMARY KEY (volc, window_end)
+            )
+        """)
+        self.conn.commit()
+
+    def add(self, volcs, start, end, window):
+        """Add a task for every window ending from start through end, inclusive"""
+        window_ends = []
+        win_end = start
+        while win_end <= end:
+            window_ends.append(int(win_end.timestamp))
+            win_end += window
+
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO tasks (volc, window_end) VALUES (?, ?)",
+            [(volc, win_end) for volc in volcs for win_end in window_ends]
+        )
+        # Anything left running was interrupted
+        self.conn.execute("UPDATE tasks SET status=? WHERE status=?", (PENDING, RUNNING))
+        self.conn.commit()
 
+    def counts(self, volcs, start, end):
+        placeholders = ','.join('?' * len(volcs))
+        cur = self.conn.execute(
+            f"""SELECT status, count(*) FROM tasks
+            WHERE volc IN ({placeholders}) AND window_end BETWEEN ? AND ?
+            GROUP BY status""",
+            (*volcs, int(start.timestamp), int(end.timestamp))
+        )
+        return dict(cur.fetchall())
 
-def runDate(RUN_END):
-    missed = []
-    generator = infrasound_location(RUN_END)
-    for volc_name, volc_info in config.VOLCS.items():
-        try:
-            generator.gen_volc_image(volc_name, volc_info, False)
-        except Exception as e:
-            print(e)
-            missed.append(RUN_END)
-            pass
+    def batches(self, volcs, start, end, window, max_attempts, batch_size):
+        """
+        Group the tasks that still need to run into runs of consecutive
+        windows for a single volcano. Tasks that have already failed are run
+        one window at a time, so one bad window doesn't sink the others.
+        """
+        placeholders = ','.join('?' * len(volcs))
+        cur = self.conn.execute(
+            f"""SELECT volc, window_end, attempts FROM tasks
+            WHERE volc IN ({placeholders}) AND window_end BETWEEN ? AND ?
+            AND status IN (?, ?) AND attempts < ?
+            ORDER BY volc, window_end""",
+            (*volcs, int(start.timestamp), int(end.timestamp), PENDING, FAILED, max_attempts)
+        )
 
-    return missed
+        batches = []
+        for volc, tasks in groupby(cur.fetchall(), key = lambda task: task[0]):
+            batch = []
+            for _, win_end, attempts in tasks:
+                contiguous = batch and win_end == batch[-1] + window
+                if batch and (not contiguous or len(batch) >= batch_size or attempts > 0):
+                    batches.append((volc, batch))
+                    batch = []
+                batch.append(win_end)
+                if attempts > 0:
+                    batches.append((volc, batch))
+                    batch = []
+            if batch:
+                batches.append((volc, batch))
+
+        return batches
+
+    def mark(self, volc, window_ends, status, error = None, attempt = False):
+        self.conn.executemany(
+            f"""UPDATE tasks SET status=?, error=?, updated=?
+            {', attempts=attempts+1' if attempt else ''}
+            WHERE volc=? AND window_end=?""",
+            [(status, error, time.time(), volc, win_end) for win_end in window_ends]
+        )
+        self.conn.commit()
+
+
+def run_backfill(ledger, volcs, start, end, window, workers, max_attempts, batch_size, save_db):
+    ledger.add(volcs, start, end, window)
+    total = sum(ledger.counts(volcs, start, end).values())
+    t_start = time.monotonic()
+    completed = 0
+
+    with ProcessPoolExecutor(max_workers = workers, max_tasks_per_child = 1) as executor:
+        while True:
+            batches = ledger.batches(volcs, start, end, window, max_attempts, batch_size)
+            if not batches:
+                break
+
+            futures = {}
+            for volc, window_ends in batches:
+                ledger.mark(volc, window_ends, RUNNING, attempt = True)
+                run_start = UTCDateTime(window_ends[0] - window)
+                run_end = UTCDateTime(window_ends[-1])
+                future = executor.submit(runRange, volc, run_start, run_end, window, save_db)
+                futures[future] = (volc, window_ends)
+
+            for future in as_completed(futures):
+                volc, window_ends = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    traceback.print_exception(e)
+                    ledger.mark(volc, window_ends, FAILED, error = repr(e))
+                    status = FAILED
+                else:
+                    ledger.mark(volc, window_ends, DONE)
+                    completed += len(window_ends)
+                    status = DONE
+
+                counts = ledger.counts(volcs, start, end)
+                elapsed = time.monotonic() - t_start
+                rate = completed / elapsed * 60 if elapsed > 0 else 0
+                remaining = total - counts.get(DONE, 0)
+                eta = remaining / rate if rate > 0 else float('nan')
+                print(f"[{counts.get(DONE, 0)}/{total}] {volc} "
+                      f"{UTCDateTime(window_ends[0])} - {UTCDateTime(window_ends[-1])} {status}. "
+                      f"{rate:.1f} windows/min, ~{eta:.0f} min remaining")
+
+    return ledger.counts(volcs, start, end)
 
 
 if __name__ == "__main__":
-    missed = []
-    futures = []
-    # 2022-11-24T03:00:00.000000Z
-    START = UTCDateTime(2023, 2, 12, 0, 0, 0)
-    STOP = UTCDateTime(2023, 2, 13, 0, 0, 0)
-    RUN_END = START
-    with ProcessPoolExecutor(max_workers = 5, max_tasks_per_child=1) as executor:
-        while RUN_END <= STOP:
-            future = executor.submit(runDate, RUN_END)
-            #runDate(RUN_END)
-            RUN_END = RUN_END + (10 * 60)
-
-    for future in futures:
-        missed += future.result()
+    parser = argparse.ArgumentParser(description = "Backfill infrasound location images and detections")
+    parser.add_argument('--start', required = True, type = UTCDateTime,
+                        help = "End time of the first window to process")
+    parser.add_argument('--end', required = True, type = UTCDateTime,
+                        help = "End time of the last window to process")
+    parser.add_argument('--volc', nargs = '+', choices = list(config.VOLCS), default = list(config.VOLCS),
+                        help = "Volcanoes to process (default: all)")
+    parser.add_argument('--window', type = int, default = 10 * 60,
+                        help = "Window length in seconds")
+    parser.add_argument('--workers', type = int, default = 5,
+                        help = "Number of tasks to run at once")
+    parser.add_argument('--attempts', type = int, default = 3,
+                        help = "Maximum attempts for each window before giving up on it")
+    parser.add_argument('--batch', type = int, default = 36,
+                        help = "Number of consecutive windows processed as a single task")
+    parser.add_argument('--save-db', action = 'store_true',
+                        help = "Save detections to the database")
+    parser.add_argument('--ledger', default = getattr(config, 'BACKFILL_LEDGER', None)
+                        or os.path.join(getattr(config, 'CACHE_DIR', '/tmp/infrasound_cache'), 'backfill.sqlite'),
+                        help = "SQLite file recording the status of each window")
+    parser.add_argument('--queue', action = 'store_true',
+                        help = "Add the windows to the work queue for worker.py instead of running them here")
+    args = parser.parse_args()
 
-    print("****************RUN COMPLETE**************")
-#    print(missed)
+    if args.queue:
+        from infrasound.work_queue import BACKFILL, open_queue
 
+        queue = open_queue()
+        window_ends = []
+        win_end = args.start
+        while win_end <= args.end:
+            window_ends.append(win_end)
+            win_end += args.window
+        for volc in args.volc:
+            queue.enqueue(volc, window_ends, window_len = args.window, priority = BACKFILL,
+                          save_db = args.save_db, max_attempts = args.attempts)
+        print(f"Queued {len(window_ends) * len(args.volc)} windows")
+        raise SystemExit(0)
 
+    ledger = Ledger(args.ledger)
+    counts = run_backfill(ledger, args.volc, args.start, args.end, args.window, args.workers,
+                          args.attempts, args.batch, args.save_db)
 
+    print("****************RUN COMPLETE**************")
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
@@ -0,0 +1,77 @@
+"""
+Image renderer. Renders the jobs queued by generate_images.py (with
+RENDER_QUEUE set) in a pool of worker processes, retrying failed jobs later
+from the saved data.
+"""
+import argparse
+import os
+import signal
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from infrasound.rendering import ACTIVE, PENDING, RenderQueue, render_job
+from web import config
+
+
+class Renderer:
+    def __init__(self, queue, workers, idle = 5):
+        self.queue = queue
+        self.workers = workers
+        self.idle = idle  # [s] How long to wait when the queue is empty
+        self.stopping = threading.Event()
+
+    def stop(self, *args):
+        print("Stopping after the current jobs")
+        self.stopping.set()
+
+    def run(self, once = False):
+        """Render jobs until stopped, or until the queue is empty if once is set"""
+        self.queue.requeue_active()
+
+        # Matplotlib leaks a little with every figure, so recycle workers now and then
+        with ProcessPoolExecutor(max_workers = self.workers, max_tasks_per_child = 50) as executor:
+            running = {}
+            while not self.stopping.is_set() or running:
+                while not self.stopping.is_set() and len(running) < self.workers:
+                    job = self.queue.claim()
+                    if job is None:
+                        break
+                    job_dir = os.path.join(self.queue.path, ACTIVE, job)
+                    running[executor.submit(render_job, job_dir)] = (job, time.monotonic())
+
+                if not running:
+                    if once:
+                        break
+                    self.stopping.wait(self.idle)
+                    continue
+
+                done, _ = wait(running, timeout = self.idle, return_when = FIRST_COMPLETED)
+                for future in done:
+                    job, started = running.pop(future)
+                    elapsed = time.monotonic() - started
+                    try:
+                        image = future.result()
+                    except Exception as e:
+                        state = self.queue.fail(job, repr(e))
+                        retry = "will retry" if state == PENDING else "giving up"
+                        print(f"Rendering {job} failed after {elapsed:.1f}s ({retry}):", repr(e))
+                    else:
+                        self.queue.complete(job)
+                        print(f"Rendered {image} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Render queued infrasound location images")
+    parser.add_argument('--workers', type = int, default = getattr(config, 'RENDER_WORKERS', 2),
+                        help = "Number of images to render at once")
+    parser.add_argument('--once', action = 'store_true',
+                        help = "Exit once the queue is empty")
+    args = parser.parse_args()
+
+    renderer = Renderer(RenderQueue(), args.workers)
+    signal.signal(signal.SIGTERM, renderer.stop)
+    signal.signal(signal.SIGINT, renderer.stop)
+    renderer.run(args.once)
+    print(", ".join(f"{count} {state}" for state, count in renderer.queue.counts().items()))
@@ -0,0 +1,25 @@
+"""
+Rebuild the hourly and daily detection rollups from the detections table.
+
+Only needed once, for detections saved before the rollups existed (or after
+editing the detections table by hand); generate_images.py and regen.py keep
+them up to date from then on.
+
+Example:
+    python rollups.py --volc pavlof semi
+"""
+import argparse
+import time
+
+from infrasound import db
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Rebuild the detection rollup tables")
+    parser.add_argument('--volc', nargs = '+',
+                        help = "Volcanoes to rebuild (default all with detections)")
+    args = parser.parse_args()
+
+    t_start = time.time()
+    for volc in db.rebuild_rollups(args.volc):
+        print(f"Rebuilt rollups for {volc}")
+    print(f"Done in {time.time() - t_start:.1f}s")
@@ -0,0 +1,42 @@
+"""
+Set up the database: add the unique index on detections (volc, d_time) that
+the detection upserts rely on, and create the rollup, detection_updates,
+run_stats and image catalog tables. Run once before running generate_images.py (or anything
+else that writes detections), and again after upgrading from a version
+without the index.
+
+Detections saved before the index existed may include duplicate rows (the
+same volcano and time). These are reported, and only deleted (keeping one of
+each) with --delete-duplicates.
+
+Example:
+    python setup_db.py --delete-duplicates
+"""
+import argparse
+import sys
+
+from infrasound import db
+from infrasound.image_catalog import ImageCatalog
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Create the database indexes and tables")
+    parser.add_argument('--delete-duplicates', action = 'store_true',
+                        help = "Delete duplicate detections so the unique index can be added")
+    args = parser.parse_args()
+
+    with db.connection() as conn:
+        if db.has_unique_index(conn.cursor()):
+            print("Unique index on detections (volc, d_time) already exists")
+        else:
+            try:
+                deleted = db.add_unique_index(conn, args.delete_duplicates)
+            except RuntimeError as e:
+                print(f"{e}. Run again with --delete-duplicates to keep one of each.")
+                sys.exit(1)
+            print(f"Deleted {deleted} duplicate detections")
+            print("Created unique index on detections (volc, d_time)")
+
+        db.ensure_schema(conn)
+
+    ImageCatalog().ensure_schema()
+    print("Tables are up to date")
@@ -1,5 +1,11 @@
-import flask
+# The Flask app is created by web.main, which is only imported when web.app is
+# first used. That way the pipeline scripts, which import web.config, don't
+# load Flask and the views.
 
-app = flask.Flask(__name__)
 
-from . import main
+def __getattr__(name):
+    if name == 'app':
+        from .main import app
+        return app
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
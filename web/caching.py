@@ -0,0 +1,115 @@
+"""
+Conditional responses and response caching for the JSON API.
+
+The data only changes when generate_images.py (or a backfill) writes
+detections or images, so each cached view is given a function returning
+when the data for the requested volcano last changed. That is used as the
+Last-Modified time and, together with the request URL, to make the ETag.
+Requests carrying a matching If-None-Match or If-Modified-Since get a 304
+without running the view, and other requests for an unchanged URL are served
+from a small per-process cache.
+
+The last change times themselves are cached for HTTP_CACHE_TTL seconds, so
+a busy server looks them up at most that often per volcano.
+"""
+import functools
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import flask
+
+from werkzeug.http import is_resource_modified
+
+from . import config
+
+
+class TTLCache:
+    """A thread safe, size limited cache whose entries expire after ttl seconds"""
+
+    def __init__(self, ttl, size = 256):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                return default
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+
+
+_versions = TTLCache(getattr(config, 'HTTP_CACHE_TTL', 5))
+_responses = TTLCache(getattr(config, 'HTTP_RESPONSE_TTL', 600),
+                      getattr(config, 'HTTP_CACHE_SIZE', 256))
+
+
+def _as_datetime(value):
+    if isinstance(value, (int, float)):
+        value = datetime.fromtimestamp(value, timezone.utc)
+    # HTTP dates only have whole seconds
+    return value.replace(microsecond = 0)
+
+
+def cached(last_update):
+    """
+    Cache a view, and answer conditional requests for it. last_update(volcano)
+    returns when the data for volcano last changed (a datetime or timestamp),
+    or None if that isn't known, in which case the view runs uncached. The
+    volcano comes from the route, or the volc argument.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            volcano = kwargs.get('volcano') or flask.request.args.get('volc')
+
+            version_key = (view.__name__, volcano)
+            updated = _versions.get(version_key)
+            if updated is None:
+                updated = last_update(volcano)
+                if updated is None:
+                    return view(*args, **kwargs)
+                updated = _as_datetime(updated)
+                _versions.set(version_key, updated)
+
+            url = flask.request.full_path
+            etag = hashlib.sha1(f"{url}|{updated.isoformat()}".encode()).hexdigest()
+
+            if not is_resource_modified(flask.request.environ, etag = etag,
+                                        last_modified = updated):
+                response = flask.Response(status = 304)
+            else:
+                cached_response = _responses.get(etag)
+                if cached_response is None:
+                    response = flask.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    _responses.set(etag, (response.get_data(), response.mimetype))
+                else:
+                    data, mimetype = cached_response
+                    response = flask.Response(data, mimetype = mimetype)
+
+            response.set_etag(etag)
+            response.last_modified = updated
+            response.cache_control.public = True
+            response.cache_control.max_age = getattr(config, 'HTTP_MAX_AGE', 30)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -6,15 +6,101 @@ SAVE_IMAGES = True
 TIME_BUFFER = 10
 AGC_PARAMS = None
 TIME_METHOD = 'celerity'  # Choose either 'celerity' or 'fdtd'
+# Arguments for rtm's fdtd_travel_time, only used when TIME_METHOD is 'fdtd'
+FDTD_KWARGS = {'FILENAME_ROOT': 'fdtd', 'FDTD_DIR': '/path/to/fdtd/output'}
 STACK_METHOD = 'sum'  # Choose either 'sum', 'product', or 'semblance'
 NETWORK = 'AV'
-SOURCE = 'IRIS'
+SOURCE = 'IRIS'  # An FDSN data center, or 'SDS' to read from a local SDS archive
 LOCATION = '*'
 CHANNEL = 'BDF'
 DECIMATION_RATE = 20
 
 DETECT_THREASHOLD = .4
 
+# Directory for cached grids, DEMs and other precomputed data. Safe to delete;
+# anything missing will be rebuilt on the next run.
+CACHE_DIR = "/tmp/infrasound_cache"
+
+# Number of volcanoes to process at once, and the maximum time (in seconds)
+# any one volcano is allowed to take before it is killed (None for no limit).
+PARALLEL_WORKERS = 2
+VOLC_TIMEOUT = 480
+
+# Keep a local rolling cache of downloaded waveforms, so overlapping windows
+# and stations shared between volcanoes are only downloaded once.
+WAVEFORM_CACHE = True
+WAVEFORM_CACHE_DAYS = 2  # How long to keep cached data
+WAVEFORM_CACHE_SETTLE = 300  # [s] Data newer than this is refetched on the next run
+
+# Local SeisComP SDS archive, used when SOURCE is 'SDS'. Station metadata is
+# read from SDS_INVENTORY (StationXML) if given, otherwise from the fallback
+# FDSN source, which is also used for stations with gaps in the archive.
+SDS_ROOT = "/data/seiscomp/archive"
+SDS_INVENTORY = None
+SDS_FALLBACK_SOURCE = 'IRIS'
+
+# Settings for daemon.py, which can be run instead of generate_images.py from
+# cron. Windows of DAEMON_WINDOW seconds are processed every DAEMON_STEP
+# seconds, DAEMON_DELAY seconds after the end of the window.
+DAEMON_WINDOW = 600
+DAEMON_STEP = 120
+DAEMON_DELAY = 60
+
+# SQLite file regen.py uses to track which backfill windows are done.
+# Defaults to backfill.sqlite in CACHE_DIR.
+BACKFILL_LEDGER = None
+
+# Memory budget for stacking, in MB. The time axis is stacked in chunks to stay
+# within it, and stacks too big for it are kept in a temporary file under
+# CACHE_DIR rather than in memory.
+STACK_MEMORY_MB = 512
+# Compute and store stacks as float32 rather than float64
+STACK_FLOAT32 = False
+
+# Coarse-to-fine search: stack every ADAPTIVE_FACTOR'th node of the search
+# grid first, then stack the full grid only within ADAPTIVE_RADIUS coarse
+# cells of peaks reaching ADAPTIVE_HEIGHT_FACTOR * PEAK_HEIGHT. Check it
+# against the full search with generate_images.py --check-adaptive. Windows
+# that would need more than ADAPTIVE_MAX_FRACTION of the grid stacked this way
+# get the full search instead.
+ADAPTIVE_SEARCH = False
+ADAPTIVE_FACTOR = 4
+ADAPTIVE_RADIUS = 2
+ADAPTIVE_HEIGHT_FACTOR = 0.8
+ADAPTIVE_MAX_FRACTION = 0.5
+
+# Combined image output. PNG zlib compression level (0-9), extra formats to
+# write alongside the PNG ('webp' and/or 'jpeg'), their quality, and the width
+# of the JPEG thumbnail used by the web interface (0 for none).
+IMAGE_PNG_COMPRESS = 6
+IMAGE_FORMATS = []
+IMAGE_QUALITY = 85
+IMAGE_THUMB_WIDTH = 700
+
+# The catalog of the images in IMG_DIR, used by the web interface to list
+# them, is kept in the database. Set this to the path of a SQLite file to
+# keep it there instead, when the generator and web interface run on a single
+# host without Postgres. Rebuild it with catalog.py.
+IMAGE_CATALOG = None
+
+# Queue images to be rendered by render.py, rather than rendering them
+# inline, so detections aren't held up by plotting.
+RENDER_QUEUE = False
+RENDER_WORKERS = 2
+# Tries before a job is moved to CACHE_DIR/render/failed, and the delay
+# before the first retry (growing with each attempt), in seconds
+RENDER_ATTEMPTS = 3
+RENDER_RETRY_DELAY = 60
+# Time samples of the stack saved with each queued image: the time slice at
+# the peak of each of this many blocks of time
+RENDER_STACK_SAMPLES = 600
+
+# Work queue for worker.py. Tasks are kept in the PostgreSQL database below,
+# or in this SQLite file if set (single host / development only).
+QUEUE_DB = None
+# Seconds a worker holds a task without a heartbeat before it is re-queued
+QUEUE_LEASE = 120
+
 ##########
 # PostgreSQL DB for storing detections
 ##########
@@ -22,6 +108,49 @@ PG_SERVER = 'myserver.myhost.edu'
 PG_DB = 'MyDBName'
 PG_USER = 'MyUser'
 
+# Detections returned by /getDetections before they are binned, by default
+# and at most (the web interface asks for about one per pixel)
+DETECTION_POINTS = 2000
+DETECTION_MAX_POINTS = 20000
+
+# Rows read from the database at a time by /exportDetections (and the
+# Parquet row group size). Parquet export needs pyarrow.
+EXPORT_BATCH = 10000
+
+# HTTP caching for the JSON API. Browsers may reuse responses for
+# HTTP_MAX_AGE seconds before revalidating. Each web process checks for new
+# detections/images at most every HTTP_CACHE_TTL seconds, and keeps up to
+# HTTP_CACHE_SIZE responses for HTTP_RESPONSE_TTL seconds.
+HTTP_MAX_AGE = 30
+HTTP_CACHE_TTL = 5
+HTTP_CACHE_SIZE = 256
+HTTP_RESPONSE_TTL = 600
+
+# Server-sent events (/events). How often new images are checked for, the
+# keepalive interval, how long a browser stays connected before it is asked
+# to reconnect, and how long it waits to reconnect, all in seconds. Each
+# connected browser holds a uwsgi thread, so each web process allows at most
+# SSE_MAX_CLIENTS (keep it below the uwsgi threads setting); browsers beyond
+# that get a 503 and try again later.
+SSE_POLL = 5
+SSE_KEEPALIVE = 15
+SSE_MAX_CONNECTION = 3600
+SSE_RETRY = 5
+SSE_MAX_CLIENTS = 16
+
+# Save the timing and memory use of every run to the run_stats table (they
+# are always logged, as a "run_stats {...}" line). Served at /metrics and
+# /getRunStats/<volcano>, and deleted after RUN_STATS_DAYS days.
+RUN_STATS = True
+RUN_STATS_DAYS = 30
+
+# Connection pooling (needs psycopg_pool), per process
+DB_POOL = True
+DB_POOL_MIN = 1
+DB_POOL_MAX = 4
+# Backfills write detections once per this many windows
+DB_BATCH_WINDOWS = 36
+
 VOLCS = {
     "pavlof": {
         "lon": -161.893047,  # [deg] Longitude of grid center
@@ -0,0 +1,139 @@
+"""
+Server-sent events for new detections and images.
+
+Each web process runs one background thread that LISTENs for the
+notifications DetectionWriter sends when detections are written, and checks
+the image catalog for new images every SSE_POLL seconds. Events are passed
+to every open /events stream in the process:
+
+    detections  {volc, start, end}   Detections in start-end (UTC) changed
+    image       {volc, time, files}  A new image, as returned by /getImages
+
+The thread is started by the first subscriber, so it runs in the uwsgi
+worker rather than the master it was forked from. Each stream holds a uwsgi
+thread, so only SSE_MAX_CLIENTS are allowed per process, leaving the rest of
+the threads for ordinary requests.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from infrasound import db
+from . import config
+
+
+class EventHub:
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.poll = getattr(config, 'SSE_POLL', 5)  # [s]
+        self.max_subscribers = getattr(config, 'SSE_MAX_CLIENTS', 16)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._image_updates = None  # {volc: catalog update time}
+        self._last_image = {}  # {volc: newest image time published}
+
+    def subscribe(self):
+        """
+        A queue receiving (event, data) tuples, until passed to unsubscribe,
+        or None if there are already max_subscribers
+        """
+        events = queue.Queue(maxsize = 100)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(events)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target = self._run, daemon = True,
+                                                name = 'event-hub')
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, events):
+        with self._lock:
+            self._subscribers.discard(events)
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait((event, data))
+            except queue.Full:
+                pass  # A stalled client only misses events
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                print("Event listener failed, reconnecting:", repr(e))
+                time.sleep(self.poll)
+
+    def _listen(self):
+        import psycopg
+
+        with psycopg.connect(**db.connect_kwargs(), autocommit = True) as conn:
+            conn.execute(f"LISTEN {db.NOTIFY_CHANNEL}")
+            while True:
+                for notify in conn.notifies(timeout = self.poll):
+                    self.publish('detections', json.loads(notify.payload))
+                self._check_images()
+
+    def _check_images(self):
+        updates = self.catalog.updates()
+        if self._image_updates is None:
+            # Only announce images written from now on
+            self._image_updates = updates
+            for volc in updates:
+                newest = self.catalog.before(volc)
+                self._last_image[volc] = newest[0][0] if newest else 0
+            return
+
+        for volc, updated in updates.items():
+            if updated == self._image_updates.get(volc):
+                continue
+
+            last = self._last_image.get(volc, 0)
+            new_images = [image for image in self.catalog.before(volc, limit = 10)
+                          if image[0] > last]
+            for img_time, files in reversed(new_images):
+                self.publish('image', {'volc': volc, 'time': img_time, 'files': files})
+            if new_images:
+                self._last_image[volc] = new_images[0][0]
+
+        self._image_updates = updates
+
+
+_hub = None
+_hub_pid = None
+
+
+def get_hub(catalog):
+    """This process's event hub"""
+    global _hub, _hub_pid
+    if _hub is None or _hub_pid != os.getpid():
+        _hub = EventHub(catalog)
+        _hub_pid = os.getpid()
+    return _hub
+
+
+def event_stream(hub, events):
+    """Server-sent event lines for events, a subscription to hub"""
+    keepalive = getattr(config, 'SSE_KEEPALIVE', 15)  # [s]
+    # Close now and then so the browser reconnects, rather than holding a
+    # worker thread forever (and to stay within proxy timeouts)
+    deadline = time.monotonic() + getattr(config, 'SSE_MAX_CONNECTION', 3600)
+    try:
+        yield f"retry: {getattr(config, 'SSE_RETRY', 5) * 1000}\n\n"
+        while time.monotonic() < deadline:
+            try:
+                event, data = events.get(timeout = keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    finally:
+        hub.unsubscribe(events)
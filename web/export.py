@@ -0,0 +1,116 @@
+"""
+Streaming export of detections, as CSV or Parquet.
+
+Rows are read from Postgres through a server-side cursor, EXPORT_BATCH at a
+time, and each batch is encoded and sent before the next is read, so memory
+use doesn't depend on how many rows are exported. Parquet needs pyarrow,
+and is written with a row group per batch.
+"""
+import csv
+import io
+
+from infrasound import db
+from . import config
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+COLUMNS = ('Date', 'Stack Amplitude', 'Distance (M)', 'Longitude', 'Latitude')
+
+
+def detection_batches(volcano, start = None, end = None):
+    """Lists of (d_time, value, dist, lon, lat) for volcano in start-end, oldest first"""
+    batch_size = getattr(config, 'EXPORT_BATCH', 10000)
+    with db.connection() as conn:
+        # Named, so the rows stay on the server until fetched
+        cur = conn.cursor(name = 'detection_export')
+        cur.itersize = batch_size
+        cur.execute(
+            """SELECT d_time, value, dist, lon, lat FROM detections
+            WHERE volc=%s AND d_time >= COALESCE(%s::timestamptz, '-infinity')
+            AND d_time <= COALESCE(%s::timestamptz, 'infinity')
+            ORDER BY d_time""",
+            (volcano, start, end)
+        )
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator = '\r\n')
+    writer.writerow(COLUMNS)
+    for rows in batches:
+        writer.writerows((d_time.strftime('%Y-%m-%d %H:%M:%S'), *rest) for d_time, *rest in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # Just the header, if there were no rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ChunkSink:
+    """A write-only file collecting what pyarrow writes, until drained"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema():
+    import pyarrow
+
+    return pyarrow.schema([(name, type_) for name, type_ in zip(COLUMNS, (
+        pyarrow.timestamp('us', tz = 'UTC'),
+        pyarrow.float64(),
+        pyarrow.float64(),
+        pyarrow.float64(),
+        pyarrow.float64(),
+    ))])
+
+
+def parquet_chunks(batches):
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in batches:
+        columns = list(zip(*rows))
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type = field.type) for column, field in zip(columns, schema)],
+            schema = schema
+        ))
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
@@ -1,16 +1,21 @@
 import flask
-import glob
 import math
 import os
 import re
 
-import psycopg
-
-from collections import deque
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 from dateutil.parser import parse
 
-from . import app, config
+from infrasound import db
+from infrasound.image_catalog import open_catalog
+
+from . import config, export
+from .caching import cached
+from .events import event_stream, get_hub
+
+app = flask.Flask('web')
+
+_image_catalog = None
 
 
 @app.route('/')
@@ -19,201 +24,361 @@ def index():
     return flask.render_template("index.html", volcs = volcs)
 
 
-@app.route('/getDetections/<volcano>')
-def detections(volcano):
-    with psycopg.connect(host = config.PG_SERVER, dbname = config.PG_DB,
-                         user = config.PG_USER, password = config.PG_PASS) as db_conn:
-        cur = db_conn.cursor()
-        cur.execute("SELECT TO_CHAR(d_time AT TIME ZONE 'UTC','YYYY-MM-DD HH24:MI:SS'),value,dist FROM detections WHERE volc=%s", (volcano, ))
-        detections = cur.fetchall()
-
-    x_dist = config.VOLCS[volcano]['x_radius_search']
-    y_dist = config.VOLCS[volcano]['y_radius_search']
-    max_dist = math.sqrt(x_dist ** 2 + y_dist ** 2)
-    detections = tuple(zip(*detections))
-    ret = {'max_dist': max_dist,
-           'detections': detections, }
-    return flask.jsonify(ret)
+def parse_time(value) -> datetime:
+    """A request time argument, as either a timestamp or a date string, in UTC"""
+    try:
+        return datetime.fromtimestamp(float(value), timezone.utc)
+    except ValueError:
+        pass
 
+    value = parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo = timezone.utc)
+    return value
 
-@app.route("/getImages")
-def get_images():
-    volcano = flask.request.args['volc']
-    count = int(flask.request.args.get('count', 1))
-    return flask.jsonify(list_images(volcano, count))
 
+def time_arg(args, name):
+    """The time request argument name, or None if it isn't given. Aborts with a 400 if it isn't a time."""
+    if not args.get(name):
+        return None
+    try:
+        return parse_time(args[name])
+    except (ValueError, OverflowError):
+        flask.abort(400, f"{name} must be a timestamp or a date")
 
-def parse_file_time(file):
-    parts = file.name.split("_")
-    file_date = parts[1]
-    file_time = parts[2]
 
-    file_time = datetime.strptime(f"{file_date}T{file_time}",
-                                  "%Y%m%dT%H%M")
-    file_time = file_time.replace(tzinfo = timezone.utc)
-    return file_time.timestamp()
+def int_arg(args, name, default):
+    """The integer request argument name, or default. Aborts with a 400 if it isn't a whole number."""
+    try:
+        return int(args.get(name, default))
+    except ValueError:
+        flask.abort(400, f"{name} must be a whole number")
 
 
-def decompose_date(date: datetime):
-    year = date.strftime("%Y")
-    month = date.strftime("%m")
-    day = date.strftime("%d")
-    return (year, month, day)
+def detections_updated(volcano):
+    return db.last_update(volcano)
 
 
-def get_img_times_listing(base_dir, dir_date: datetime) -> set:
-    year, month, day = decompose_date(dir_date)
-    img_dir = os.path.join(base_dir, year, month, day)
+@app.route('/getDetections/<volcano>')
+@cached(detections_updated)
+def detections(volcano):
+    """
+    Detections for volcano, optionally limited to start-end. If there are
+    more than points detections in the range, they are binned in time and
+    the detection with the highest value in each bin is returned, along with
+    the number of detections in each bin.
+    """
+    args = flask.request.args
+    start = time_arg(args, 'start')
+    end = time_arg(args, 'end')
+    points = int_arg(args, 'points', getattr(config, 'DETECTION_POINTS', 2000))
+    points = max(1, min(points, getattr(config, 'DETECTION_MAX_POINTS', 20000)))
+
+    range_filter = """volc=%s AND d_time >= COALESCE(%s::timestamptz, '-infinity')
+                   AND d_time <= COALESCE(%s::timestamptz, 'infinity')"""
+    range_args = (volcano, start, end)
+
+    with db.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute(f"SELECT min(d_time), max(d_time), count(*) FROM detections WHERE {range_filter}",
+                    range_args)
+        first, last, count = cur.fetchone()
+
+        bin_seconds = None
+        if count <= points:
+            cur.execute(
+                f"""SELECT TO_CHAR(d_time AT TIME ZONE 'UTC','YYYY-MM-DD HH24:MI:SS'),value,dist
+                FROM detections WHERE {range_filter} ORDER BY d_time""",
+                range_args
+            )
+            detections = cur.fetchall()
+            counts = None
+        else:
+            bin_seconds = max(1, math.ceil((last - first).total_seconds() / points))
+            cur.execute(
+                f"""SELECT DISTINCT ON (bin)
+                    TO_CHAR(d_time AT TIME ZONE 'UTC','YYYY-MM-DD HH24:MI:SS'), value, dist,
+                    count(*) OVER (PARTITION BY bin)
+                FROM (
+                    SELECT floor(extract(epoch FROM d_time) / %s) AS bin, d_time, value, dist
+                    FROM detections WHERE {range_filter}
+                ) binned
+                ORDER BY bin, value DESC""",
+                (bin_seconds, *range_args)
+            )
+            rows = cur.fetchall()
+            detections = [row[:3] for row in rows]
+            counts = [row[3] for row in rows]
 
-    try:
-        # Get a listing for the current day
-        listing = {(img_dir, parse_file_time(x)) for x in os.scandir(img_dir)}
-    except FileNotFoundError:
-        listing = set()
+    x_dist = config.VOLCS[volcano]['x_radius_search']
+    y_dist = config.VOLCS[volcano]['y_radius_search']
+    max_dist = math.sqrt(x_dist ** 2 + y_dist ** 2)
+    detections = tuple(zip(*detections))
+    ret = {'max_dist': max_dist,
+           'detections': detections,
+           'counts': counts,
+           'total': count,
+           'bin_seconds': bin_seconds, }
+    return flask.jsonify(ret)
 
-    return listing
 
+@app.route('/getRollups/<volcano>')
+@cached(detections_updated)
+def rollups(volcano):
+    """
+    Hourly or daily (period=hour|day) detection counts, max values and mean
+    distances for volcano, optionally limited to buckets starting in start-end.
+    """
+    args = flask.request.args
+    period = args.get('period', 'hour')
+    tables = {unit: table for table, unit in db.ROLLUPS.items()}
+    if period not in tables:
+        flask.abort(400, f"period must be one of {', '.join(tables)}")
 
-def get_img_times(base_dir, dir_date: datetime):
-    listing = get_img_times_listing(base_dir, dir_date)
+    start = time_arg(args, 'start')
+    end = time_arg(args, 'end')
 
-    # and *one* entry for the next day, so we don't get stuck
-    dir_date += timedelta(days = 1)
+    with db.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute(
+            f"""SELECT TO_CHAR(bucket AT TIME ZONE 'UTC','YYYY-MM-DD HH24:MI:SS'),
+                count, max_value, mean_dist
+            FROM {tables[period]}
+            WHERE volc=%s AND bucket >= COALESCE(%s::timestamptz, '-infinity')
+            AND bucket <= COALESCE(%s::timestamptz, 'infinity')
+            ORDER BY bucket""",
+            (volcano, start, end)
+        )
+        rows = cur.fetchall()
+
+    ret = {'period': period, }
+    for idx, key in enumerate(('buckets', 'counts', 'max_values', 'mean_dists')):
+        ret[key] = [row[idx] for row in rows]
+    return flask.jsonify(ret)
 
-    try:
-        listing2 = sorted(get_img_times_listing(base_dir, dir_date),
-                          key = lambda x: x[1])[0]
 
-        listing.add(listing2)
-    except IndexError:
-        # No next day. No problem.
-        pass
+@app.route('/exportDetections/<volcano>')
+def export_detections(volcano):
+    """
+    Download the detections for volcano, optionally limited to start-end, as
+    format csv (the default) or parquet. Streamed, so any range can be
+    exported.
+    """
+    args = flask.request.args
+    start = time_arg(args, 'start')
+    end = time_arg(args, 'end')
+    fmt = args.get('format', 'csv').lower()
+    if fmt not in export.FORMATS:
+        flask.abort(400, f"format must be one of {', '.join(export.FORMATS)}")
+
+    if fmt == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            flask.abort(501, "Parquet export needs pyarrow")
+        chunks = export.parquet_chunks(export.detection_batches(volcano, start, end))
+    else:
+        chunks = export.csv_chunks(export.detection_batches(volcano, start, end))
+
+    first = start.strftime('%Y-%m-%d %H%M') if start else 'start'
+    last = end.strftime('%Y-%m-%d %H%M') if end else 'end'
+    mimetype, extension = export.FORMATS[fmt]
+    file_name = f"{volcano} events {first} to {last}.{extension}"
+    return flask.Response(chunks, mimetype = mimetype, headers = {
+        'Content-Disposition': f'attachment; filename="{file_name}"',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+RUN_METRICS = (
+    # (column, metric, help, scale)
+    ('wall', 'infrasound_run_seconds', "Wall time of the latest run", 1),
+    ('cpu', 'infrasound_run_cpu_seconds', "CPU time of the latest run", 1),
+    ('max_rss_mb', 'infrasound_run_max_rss_bytes', "Peak resident memory of the latest run", 2 ** 20),
+    ('stations', 'infrasound_run_stations', "Stations in the latest run", 1),
+    ('grid_nodes', 'infrasound_run_grid_nodes', "Search grid nodes in the latest run", 1),
+    ('samples', 'infrasound_run_samples', "Processed samples per station per window in the latest run", 1),
+    ('detections', 'infrasound_run_detections', "Detections found by the latest run", 1),
+)
+
+STAGE_METRICS = (
+    ('wall', 'infrasound_stage_seconds', "Wall time of each stage of the latest run", 1),
+    ('cpu', 'infrasound_stage_cpu_seconds', "CPU time of each stage of the latest run", 1),
+    ('max_rss_mb', 'infrasound_stage_max_rss_bytes',
+     "Peak resident memory of the latest run up to the end of each stage", 2 ** 20),
+)
+
+
+def _labels(**labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    The latest run of each volcano, and run counts, over the last day, in the
+    Prometheus text format. Volcanoes with no runs in that time are left out.
+    """
+    with db.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute(
+            f"""SELECT DISTINCT ON (volc, kind) volc, kind, extract(epoch FROM started), status,
+                {', '.join(column for column, *_ in RUN_METRICS)}, stages
+            FROM run_stats WHERE started > now() - interval '1 day'
+            ORDER BY volc, kind, started DESC"""
+        )
+        latest = cur.fetchall()
+        cur.execute(
+            """SELECT volc, kind, status, count(*) FROM run_stats
+            WHERE started > now() - interval '1 day' GROUP BY volc, kind, status
+            ORDER BY volc, kind, status"""
+        )
+        counts = cur.fetchall()
+
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            if value is not None:
+                lines.append(f"{name}{{{labels}}} {float(value)!r}")
+
+    metric('infrasound_run_timestamp_seconds', "Start time of the latest run",
+           [(_labels(volc = row[0], kind = row[1]), row[2]) for row in latest])
+    metric('infrasound_run_success', "Whether the latest run finished without error",
+           [(_labels(volc = row[0], kind = row[1]), row[3] == 'ok') for row in latest])
+    for idx, (_, name, help_text, scale) in enumerate(RUN_METRICS):
+        metric(name, help_text, [(_labels(volc = row[0], kind = row[1]),
+                                  None if row[4 + idx] is None else row[4 + idx] * scale)
+                                 for row in latest])
+
+    for key, name, help_text, scale in STAGE_METRICS:
+        samples = []
+        for row in latest:
+            for stage, stats in (row[-1] or {}).items():
+                if stats.get(key) is not None:
+                    samples.append((_labels(volc = row[0], kind = row[1], stage = stage),
+                                    stats[key] * scale))
+        metric(name, help_text, samples)
+
+    metric('infrasound_runs_last_day', "Runs started in the last 24 hours, by status",
+           [(_labels(volc = volc, kind = kind, status = status), count)
+            for volc, kind, status, count in counts])
+
+    return flask.Response('\n'.join(lines) + '\n', mimetype = 'text/plain; version=0.0.4')
+
+
+@app.route('/getRunStats/<volcano>')
+def run_history(volcano):
+    """
+    The most recent runs for volcano, newest first, optionally limited to
+    runs started in start-end and of one kind (window or range).
+    """
+    args = flask.request.args
+    start = time_arg(args, 'start')
+    end = time_arg(args, 'end')
+    limit = max(1, min(int_arg(args, 'limit', 100), 10000))
+
+    with db.connection() as db_conn:
+        cur = db_conn.cursor()
+        cur.execute(
+            """SELECT volc, kind, window_end, window_len, started, status, error, wall, cpu,
+                max_rss_mb, stations, grid_nodes, samples, windows, detections, stages, host
+            FROM run_stats
+            WHERE volc=%s AND started >= COALESCE(%s::timestamptz, '-infinity')
+            AND started <= COALESCE(%s::timestamptz, 'infinity')
+            AND kind = COALESCE(%s, kind)
+            ORDER BY started DESC LIMIT %s""",
+            (volcano, start, end, args.get('kind'), limit)
+        )
+        columns = [col.name for col in cur.description]
+        runs = [dict(zip(columns, row)) for row in cur.fetchall()]
 
-    listing = sorted(listing, key = lambda x: x[1], reverse = True)
-    return listing
+    for run in runs:
+        for key in ('window_end', 'started'):
+            run[key] = run[key].isoformat()
 
+    return flask.jsonify({'runs': runs})
 
-def get_img_list(base_dir, dir_date: datetime):
-    year = dir_date.strftime("%Y")
-    month = dir_date.strftime("%m")
-    day = dir_date.strftime("%d")
-    img_dir = os.path.join(base_dir, year, month, day)
 
-    try:
-        listing = [(x, parse_file_time(x)) for x in os.scandir(img_dir)]
-    except FileNotFoundError:
-        return []
+def image_catalog():
+    global _image_catalog
+    if _image_catalog is None:
+        _image_catalog = open_catalog()
+    return _image_catalog
 
-    listing.sort(key = lambda x: x[1], reverse = True)
-    return listing
 
+def images_updated(volcano):
+    return image_catalog().last_update(volcano)
 
-def get_prev(img_dir, img_dir_time, listing):
-    try:
-        day_dir, file_mtime = listing.pop(0)
-    except IndexError:
-        # Look at the previous day
-        img_dir_time -= timedelta(days = 1)
-        listing = get_img_times(img_dir, img_dir_time)
-        try:
-            # Discard the first entry, as it is for the next day.
-            listing.pop(0)
-            day_dir, file_mtime = listing.pop(0)
-        except IndexError:
-            return None, None, []
 
-    return day_dir, file_mtime, listing
+@app.route("/getImages")
+@cached(images_updated)
+def get_images():
+    volcano = flask.request.args['volc']
+    count = int_arg(flask.request.args, 'count', 1)
+    return flask.jsonify(list_images(volcano, count))
 
 
 def list_images(volcano, count, stop_time: datetime = None):
-    # stop_time is inclusive, any files equal to said stop time will be included.
-    if stop_time is None:
-        img_dir_time = datetime.utcnow() + timedelta(minutes = 10)
-    else:
-        img_dir_time = stop_time
-        stop_time = stop_time.timestamp()
-
-    img_dir = os.path.join(config.IMG_DIR, volcano)
-
-    file_dates = []
-    if count > 1:
-        prev_time_opts = deque(maxlen = count - 1)
-    else:
-        prev_time_opts = None
-
-    next_time = None
-    prev_time = None
-
-    listing = get_img_times(img_dir, img_dir_time)
-
-    while len(file_dates) < count:
-        day_dir, file_mtime, listing = get_prev(img_dir, img_dir_time, listing)
-        if file_mtime is None:
-            # No previous day. Out of images.
-            break  # No more files to be had
-
-        if stop_time is not None:
-            # Start counting files once they are *older* than the stop_time
-            # That is, do nothing (continue) as long as the file is as new
-            # as or newer than the stop time.
-            if file_mtime > stop_time:
-                next_time = file_mtime
-                continue
-
-        if prev_time_opts is not None:
-            prev_time_opts.appendleft(file_mtime)
-
-        # Get a listing of files for this time
-        time_obj = datetime.utcfromtimestamp(file_mtime).replace(tzinfo = timezone.utc)
-        time_str = time_obj.strftime('%Y%m%d_%H%M')
-        glob_pattern = f"{day_dir}/{volcano}_{time_str}_*.png"
-        file_group = [os.path.basename(x) for x in glob.glob(glob_pattern)]
-
-        # See if we have a combined image. if so, only return that
-        for filename in file_group:
-            if filename.endswith('_combined.png'):
-                file_group = [filename, ]
-                break
-
-        file_dates.append(file_group)
-
-    # if file_mtime is none, we ran out of files while navigating backward before we
-    # even had as many as we wanted, so clearly no previous files are available.
-    if file_mtime is None:
-        prev_time = None
-    else:
-        # Get what would be the next file back if we kept going.
-        # Will return None for prev_time if there is no previous file
-        day_dir, prev_time, listing = get_prev(img_dir, img_dir_time, listing)
-
-        # If there is no next file back, then leave prev_time as None.
-        # If there is, but we are only showing 1 image, then the next
-        # file back is the "target" file for navigating back, and we
-        # can just leave the prev_time value as-is.
-        if prev_time is not None and count > 1:
-            # if count>1, then we want to use the previously stored
-            # "opt" value for prev_time.
-            try:
-                prev_time = prev_time_opts.pop()
-            except:
-                prev_time = None
+    """
+    The file groups for the count newest image times at or before stop_time
+    (inclusive), newest first. next is the time of the first image after
+    stop_time, if one was given. prev is where to stop when navigating back
+    (the second image shown, or with count 1 the next one back), or None if
+    there are no older images.
+    """
+    catalog = image_catalog()
+    stop = None if stop_time is None else stop_time.timestamp()
+
+    # One extra, to see if there is anything further back
+    images = catalog.before(volcano, stop, count + 1)
+
+    next_time = None if stop is None else catalog.after(volcano, stop)
+    prev_time = images[1][0] if len(images) > count else None
+    file_dates = [files for _, files in images[:count]]
 
     return {"files": file_dates, "prev": prev_time, 'next': next_time}
 
 
 @app.route("/imageBrowse")
+@cached(images_updated)
 def browse_images():
     volcano = flask.request.args['volc']
-    count = int(flask.request.args.get('count', 1))
+    count = int_arg(flask.request.args, 'count', 1)
     try:
         stop = float(flask.request.args['stop'])
         stop = datetime.utcfromtimestamp(stop).replace(tzinfo = timezone.utc)
     except ValueError:
-        stop = parse(flask.request.args['stop']).replace(tzinfo = timezone.utc)
+        try:
+            stop = parse(flask.request.args['stop']).replace(tzinfo = timezone.utc)
+        except (ValueError, OverflowError):
+            flask.abort(400, "stop must be a timestamp or a date")
 
     return flask.jsonify(list_images(volcano, count, stop))
 
 
+@app.route('/events')
+def events():
+    """
+    Server-sent events announcing new detections and images, for all
+    volcanoes. 503 if this process already has SSE_MAX_CLIENTS streams open.
+    """
+    hub = get_hub(image_catalog())
+    events = hub.subscribe()
+    if events is None:
+        return flask.Response("Too many event streams open", status = 503,
+                              headers = {'Retry-After': str(getattr(config, 'SSE_RETRY', 5))})
+
+    response = flask.Response(event_stream(hub, events), mimetype = 'text/event-stream',
+                              headers = {'Cache-Control': 'no-cache',
+                                         'X-Accel-Buffering': 'no'})
+    # Also unsubscribes if the stream is closed before it starts
+    response.call_on_close(lambda: hub.unsubscribe(events))
+    return response
+
+
 @app.route('/getImage/<volc>/<year>/<month>/<day>/<image>')
 def get_image(volc, year, month, day, image):
     # This should not be used in production. Rather, Nginx
@@ -19,6 +19,8 @@ $(document).ready(function(){
     $(document).on('mouseleave','.volcDetections',hideDownload);
     $(document).on('click','.volcDetections .download',downloadCSV);
 
+    subscribeEvents();
+
 
     $(window).resize(function(){
         const count=getImageCount();
@@ -33,24 +35,17 @@ $(document).ready(function(){
 })
 
 function downloadCSV(){
-    const data=$('.volcDetections:visible').get(0).data[0]
-    const x=data.x
-    const y=data.y
-    const z=data.z
-
-    let csvContent="data:text/csv;charset=utf-8,"
-    csvContent+="Date,Stack Amplitude,Distance (M)\r\n"
-    for(let i=0;i<x.length;i++){
-        csvContent+=`${x[i]},${y[i]},${z[i]}\r\n`
-    }
-
-    const encodedUri=encodeURI(csvContent);
+    //Download the detections in the visible range (all of them if not zoomed)
+    const dest=$('.volcDetections:visible').get(0);
     const volc=$('.volcWrapper:visible').data('volc');
-    const file_name=`${volc} events ${x[0]} to ${x[x.length-1]}.csv`
+    let args={'format':'csv'};
+    if(dest.zoomRange){
+        args['start']=dest.zoomRange[0];
+        args['end']=dest.zoomRange[1];
+    }
 
     $('#downloadLink')
-    .attr('download',file_name)
-    .attr('href',encodedUri)
+    .attr('href',`exportDetections/${volc}?${$.param(args)}`)
     .get(0)
     .click()
 }
@@ -111,26 +106,54 @@ function displayVolc(){
     getImages();
 }
 
-function getDetections(){
+let detectionsRequest=null;
+function getDetections(start,end){
+    //Fetch only the visible time range (everything if not given), at about
+    //one point per pixel. Denser ranges come back binned, with the largest
+    //detection in each bin.
     const volc=$('#volcs button.current').data('volc');
-    $.getJSON(`getDetections/${volc}`)
+    const dest=$('div.volcDetections:visible')[0];
+    const zoomed=typeof start!=='undefined';
+
+    let args={'points':Math.max(Math.round($(dest).width()),100)};
+    if(zoomed){
+        args['start']=start;
+        args['end']=end;
+    }
+
+    if(detectionsRequest!==null){
+        detectionsRequest.abort();
+    }
+
+    detectionsRequest=$.getJSON(`getDetections/${volc}`,args)
     .done(function(data){
         let times,values,dist;
         [times,values,dist]=data['detections'];
         color_max=data['max_dist']
 
+        const text=detectionText(data);
+        dest.zoomRange=zoomed ? [start,end] : null;
+
         //kludge to always show current date for max value
         const currDate=new Date();
         const currDateStr=currDate.toISOString();
 
-        const dest=$('div.volcDetections:visible')[0]
-        Plotly.newPlot(
+        let xaxis={
+            tickangle: 0,
+            gridcolor:"rgba(0,0,0,.25)",
+        };
+        if(zoomed){
+            xaxis['range']=[start,end];
+        }
+
+        Plotly.react(
             dest,
             [
                 {
                     x:times,
                     y:values,
                     z:dist,
+                    text:text,
                     mode:"markers",
                     marker:{
                         color:dist,
@@ -167,11 +190,7 @@ function getDetections(){
                     b:30,
                     r:0
                 },
-                xaxis:{
-                    tickangle: 0,
-                    gridcolor:"rgba(0,0,0,.25)",
-
-                },
+                xaxis:xaxis,
                 yaxis:{
                     range:[.75,1.075],
                     title:"Stack Amp",
@@ -181,16 +200,177 @@ function getDetections(){
             {responsive: true}
         )
 
-        dest.on('plotly_click',tsClicked);
+        if(!dest.detectionHandlers){
+            dest.on('plotly_click',tsClicked);
+            dest.on('plotly_relayout',detectionsZoomed);
+            dest.detectionHandlers=true;
+        }
+    })
+    .always(function(){
+        detectionsRequest=null;
     })
 }
 
+function detectionText(data){
+    //Hover text for binned detections (undefined if not binned)
+    if(data['counts']===null){
+        return undefined;
+    }
+    return data['counts'].map(function(count){
+        return `${count} detection${count==1 ? '' : 's'} in ${data['bin_seconds']}s`;
+    });
+}
+
+function detectionsZoomed(evt){
+    //Re-fetch the detections for the new visible range
+    if('xaxis.range[0]' in evt){
+        getDetections(evt['xaxis.range[0]'],evt['xaxis.range[1]']);
+    }
+    else if('xaxis.range' in evt){
+        getDetections(evt['xaxis.range'][0],evt['xaxis.range'][1]);
+    }
+    else if(evt['xaxis.autorange']){
+        getDetections();
+    }
+}
+
 function tsClicked(data){
     const pt=data.points[0];
     $('#endDateTime').val(pt.x).change().blur();
     console.log(pt);
 }
 
+function subscribeEvents(retrying){
+    //Listen for new detections and images, and add them as they come in
+    if(typeof EventSource==='undefined'){
+        return;
+    }
+
+    let connected=retrying===true;
+    const source=new EventSource('events');
+    source.addEventListener('open',function(){
+        //Catch up on anything missed while reconnecting
+        if(connected){
+            refreshCurrent();
+        }
+        connected=true;
+    });
+    source.addEventListener('error',function(){
+        //Refused, when the server has as many streams open as it allows. The
+        //browser won't retry that by itself.
+        if(source.readyState===EventSource.CLOSED){
+            setTimeout(function(){
+                subscribeEvents(true);
+            },60000);
+        }
+    });
+    source.addEventListener('detections',newDetections);
+    source.addEventListener('image',newImage);
+}
+
+function refreshCurrent(){
+    const dest=$('div.volcDetections:visible')[0];
+    if(typeof dest!=='undefined' && dest.zoomRange){
+        getDetections(dest.zoomRange[0],dest.zoomRange[1]);
+    }
+    else{
+        getDetections();
+    }
+
+    if($(document).data('stopTime')===null){
+        getImages();
+    }
+}
+
+function newDetections(evt){
+    //Replace the detections in the updated time range with the new ones
+    const update=JSON.parse(evt.data);
+    const volc=$('#volcs button.current').data('volc');
+    const dest=$('div.volcDetections:visible')[0];
+    if(update['volc']!==volc || typeof dest==='undefined' || !dest.data){
+        return;
+    }
+
+    const args={
+        'start':update['start'],
+        'end':update['end'],
+        'points':Math.max(Math.round($(dest).width()),100)
+    };
+    $.getJSON(`getDetections/${volc}`,args)
+    .done(function(data){
+        let times,values,dist;
+        [times=[],values=[],dist=[]]=data['detections'];
+        const newText=detectionText(data);
+
+        const trace=dest.data[0];
+        const keep=[];
+        for(let i=0;i<trace.x.length;i++){
+            if(trace.x[i]<update['start'] || trace.x[i]>update['end']){
+                keep.push(i);
+            }
+        }
+        const pick=function(arr){
+            return keep.map(function(i){return arr[i];});
+        }
+
+        const x=pick(trace.x).concat(times);
+        const y=pick(trace.y).concat(values);
+        const z=pick(trace.z).concat(dist);
+        let text;
+        if(Array.isArray(trace.text) || typeof newText!=='undefined'){
+            const oldText=Array.isArray(trace.text) ? pick(trace.text) : keep.map(function(){return '';});
+            text=oldText.concat(newText || times.map(function(){return '';}));
+        }
+
+        Plotly.restyle(dest,{x:[x],y:[y],z:[z],text:[text],'marker.color':[z]},[0]);
+        //Move the transparent end marker up to now
+        Plotly.restyle(dest,{x:[[new Date().toISOString()]]},[1]);
+    })
+}
+
+function newImage(evt){
+    //Add a new image to the strip, if it is showing the latest images
+    const image=JSON.parse(evt.data);
+    const volc=$('#volcs button.current').data('volc');
+    if(image['volc']!==volc || $(document).data('stopTime')!==null){
+        return;
+    }
+
+    const dest=$(`#${volc}Tab div.infrasoundImages`);
+    let groups=dest.children('.imageGroup');
+    if(groups.length>0 && groups.last().data('time')>=image['time']){
+        return;
+    }
+    if(groups.length==0){
+        dest.empty(); //No Images Found
+    }
+
+    dest.append(createImageDiv(image['files']));
+    groups=dest.children('.imageGroup');
+
+    //Same target /getImages would give: the second newest image
+    if(groups.length>1){
+        $(`#${volc}Tab div.nav.prev button`)
+        .data('target',groups.eq(-2).data('time'))
+        .attr('disabled',false);
+    }
+    groups.slice(0,Math.max(groups.length-imageCount,0)).remove();
+}
+
+function imageTime(imageName){
+    //The image time, in seconds, from a <volc>_<YYYYmmdd>_<HHMM>_<type> file name
+    const parts=imageName.split('_');
+    const date=parts[1];
+    const time=parts[2];
+    return Date.UTC(
+        Number(date.slice(0,4)),
+        Number(date.slice(4,6))-1,
+        Number(date.slice(6,8)),
+        Number(time.slice(0,2)),
+        Number(time.slice(2,4))
+    )/1000;
+}
+
 function getImageCount(){
     const destDiv=$('div.tabDiv:visible');
     //can use any nav div here, as they should all be the same width
@@ -271,6 +451,7 @@ function displayImages(images,volc){
 
 function createImageDiv(images){
     let div=$('<div class="imageGroup">')
+    div.data('time',imageTime(images[0]));
     const imageTypes=['slice','wfs','combined'];
     for(const type of imageTypes ){
         //pull out the images in order
@@ -293,6 +474,16 @@ function createImageDiv(images){
 
         let imgObj=$('<img class=ifsImage>');
         imgObj.prop('src',`getImage/${img_path}`);
+
+        //Use the smaller thumbnail, if there is one, unless the screen needs the full resolution
+        const thumb=img.replace('_combined.png','_thumb.jpg');
+        if(type=='combined' && images.includes(thumb)){
+            const thumb_path=`${img_volc}/${img_year}/${img_month}/${img_day}/${thumb}`;
+            imgObj.prop('src',`getImage/${thumb_path}`);
+            imgObj.attr('srcset',`getImage/${thumb_path} 1x, getImage/${img_path} 2x`);
+            imgObj=$('<a target="_blank">').prop('href',`getImage/${img_path}`).append(imgObj);
+        }
+
         div.append(imgObj);
     }
     div.append('<div class=highlight style="display:none">')
@@ -0,0 +1,83 @@
+"""
+Queue worker. Pulls (volcano, window) tasks from the shared work queue and
+runs gen_volc_image for each one. Run as many of these as needed, on as many
+hosts as needed; tasks are added by generate_images.py --enqueue (live
+windows) and regen.py --queue (backfills).
+"""
+import argparse
+import signal
+import threading
+
+from obspy import UTCDateTime
+
+from generate_images import infrasound_location, preload
+from infrasound.runner import FINISHED, run_volcanoes
+from infrasound.work_queue import Heartbeat, open_queue, worker_id
+from web import config
+
+
+class QueueWorker:
+    def __init__(self, queue, timeout = None, idle = 10):
+        self.queue = queue
+        self.timeout = timeout  # [s] Longest a single task may run
+        self.idle = idle  # [s] How long to wait when the queue is empty
+        self.owner = worker_id()
+        self.stopping = threading.Event()
+
+    def stop(self, *args):
+        print("Stopping after the current task")
+        self.stopping.set()
+
+    def run(self):
+        print(f"Worker {self.owner} started")
+        while not self.stopping.is_set():
+            job = self.queue.claim(self.owner)
+            if job is None:
+                self.stopping.wait(self.idle)
+                continue
+
+            self.process(job)
+
+    def process(self, job):
+        window_end = UTCDateTime(job.window_end)
+        volc_info = config.VOLCS.get(job.volc)
+        if volc_info is None:
+            self.queue.fail(job, self.owner, f"Unknown volcano {job.volc}")
+            return
+
+        heartbeat = Heartbeat(self.queue, job, self.owner, self.timeout)
+        heartbeat.start()
+
+        generator = infrasound_location(window_end, window_end - job.window_len)
+        try:
+            # In a child process, so a crash or hang only costs this task
+            [(_, status, elapsed)] = run_volcanoes(generator, {job.volc: volc_info},
+                                                   timeout = self.timeout,
+                                                   SAVE_DB = job.save_db)
+        finally:
+            heartbeat.stop()
+
+        if status == FINISHED:
+            self.queue.complete(job, self.owner)
+        else:
+            self.queue.fail(job, self.owner, status)
+
+        print(f"{job.volc} {window_end} (attempt {job.attempts}) {status} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Process infrasound location tasks from the work queue")
+    parser.add_argument('--timeout', type = float, default = getattr(config, 'VOLC_TIMEOUT', None),
+                        help = "Wall-clock limit, in seconds, for each task")
+    parser.add_argument('--lease', type = float, default = getattr(config, 'QUEUE_LEASE', 120),
+                        help = "Seconds a task stays leased without a heartbeat")
+    parser.add_argument('--idle', type = float, default = 10,
+                        help = "Seconds to wait before checking an empty queue again")
+    args = parser.parse_args()
+
+    # Each task runs in a forked process, which inherits these
+    preload()
+    worker = QueueWorker(open_queue(args.lease), args.timeout, args.idle)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()